@@ -8,137 +8,228 @@ import sys
 from collections import defaultdict
 from router import Router
 from packet import Packet
-from json import dumps, loads
+from codec import dumps, loads
+from fib import ForwardingTable, ABSENT
 
 COST_MAX = 16
-class DVrouter(Router):
-    """Distance vector routing protocol implementation."""
+# route flap damping: every withdrawal of a route adds FLAP_PENALTY, the
+# penalty halves every half-life, and a route whose penalty exceeds
+# SUPPRESS_LIMIT is not re-installed until it decays below REUSE_LIMIT
+FLAP_PENALTY = 1000
+SUPPRESS_LIMIT = 2500
+REUSE_LIMIT = 750
 
-    def __init__(self, addr, heartbeatTime):
-        """class fields and initialization code here"""
+class DVrouter(Router):
+    """Distance vector routing protocol implementation.  Each routing packet
+       carries a whole distance vector (or the entries that changed) from
+       one router to one neighbor, with poisoned reverse applied per
+       neighbor"""
+
+    def __init__(self, addr, heartbeatTime, triggerDelay=None, holdDownTime=None,
+                 dampingHalfLife=None):
+        """class fields and initialization code here.  triggerDelay is the
+           window (ms) over which triggered updates are collected before
+           being flushed, holdDownTime how long (ms) a withdrawn route ignores
+           advertisements that are worse than the route it replaced, and
+           dampingHalfLife the half-life (ms) of route flap penalties.
+           All default to multiples of the heartbeat; 0 disables"""
         Router.__init__(self, addr)  # initialize superclass - don't remove
-        self.routersNext = {}  
-        self.routersCost = {} 
-        self.routersPort = {} 
-        self.routersAddr = {}  
+        self.routersPort = {}  # port towards each neighbor
+        self.routersAddr = {}  # neighbor at the end of each port
+        self.fib = ForwardingTable(self.routersPort)
+        self.routersNext = self.fib.next
+        self.routersCost = self.fib.cost
+        self.routersNext[self.addr] = self.addr
+        self.routersCost[self.addr] = 0
+        self.linkCost = {}     # cost of the direct link to each neighbor
         self.heartbeat = heartbeatTime
         self.lasttime = None
+        self.now = 0
+
+        self.triggerDelay = heartbeatTime/10 if triggerDelay is None else triggerDelay
+        self.holdDownTime = heartbeatTime if holdDownTime is None else holdDownTime
+        self.dampingHalfLife = 5*heartbeatTime if dampingHalfLife is None else dampingHalfLife
+        self.pendingUpdates = set()  # changed destinations not yet advertised
+        self.pendingSince = None
+        self.holdDown = {}     # dst -> (hold-down end time, cost before withdrawal)
+        self.penalty = {}      # dst -> (flap penalty, time it was last updated)
+        self.suppressed = set()
 
     def handlePacket(self, port, packet):
         """process incoming packet"""
         # deal with traceroute packet
         if packet.isTraceroute():
-            if packet.dstAddr in self.routersNext:
-                next_nb = self.routersNext[packet.dstAddr]
-                self.send(self.routersPort[next_nb], packet)
+            port = self.fib.portFor(packet.dstAddr)
+            if port is not None:
+                self.send(port, packet)
 
         # deal with routing packet
         if packet.isRouting():
-            rtn = self.updateNode(packet.content)
-            # if rtn=None, irrelevant Routing Information
-            if rtn != None:
-                # routing table updated, need to be broadcast
-                for port in self.routersAddr:  # this port is diff from input port
-                    content = {}
-                    content["src"] = self.addr
-                    content["dst"] = rtn[1]  # packet dst
-                    content["cost"] = rtn[2] # cost
-                    if self.routersAddr[port] != self.routersNext[rtn[1]]:   # split horizon 
-                        content_str = dumps(content)
-                        # send the update route tb to neighbour node (ending point of port)
-                        packet = Packet(Packet.ROUTING, self.addr, self.routersAddr[port], content_str)
-                        self.send(port, packet)
-
-    def updateNode(self, content):
-        """update node with routing packet"""
-        data = loads(content)
-        src = data["src"]
-        dst = data["dst"]
-        cost = data["cost"]
-        # build the src-dst link
-        if dst not in self.routersCost and dst != self.addr:
-            if src in self.routersCost:
-                self.routersCost[dst] = self.routersCost[src] + cost
-                self.routersNext[dst] = src
-                return True, dst, self.routersCost[dst]
-
-        # choose the less cost or new info
-        if dst in self.routersCost:
-            if src in self.routersCost:
-                if (self.routersCost[dst] > self.routersCost[src] + cost) or (self.routersNext[dst] == src and src != dst):
-                    self.routersCost[dst] = self.routersCost[src] + cost
-                    self.routersNext[dst] = src
-                    # set COST_MAX as infinity
-                    if self.routersCost[dst] >  COST_MAX:
-                        self.routersCost[dst] =  COST_MAX
-                    return True, dst, self.routersCost[dst]
-
-        return None
+            data = loads(packet.content)
+            changed = self.updateVector(data["src"], data["vector"])
+            # routing table updated, broadcast the changed entries
+            if changed:
+                self.triggerUpdate(changed)
+
+    def updateVector(self, src, vector):
+        """update the routing table with the distance vector of neighbor src
+           in one pass, returns the destinations whose entry changed"""
+        if src not in self.linkCost:
+            return []
+        linkCost = self.linkCost[src]
+        # work on the table columns directly, indexed by address ID
+        fib = self.fib
+        intern = fib.addresses.intern
+        srcId = intern(src)
+        changed = []
+        for dst, cost in vector.items():
+            if dst == self.addr:
+                continue
+            # set COST_MAX as infinity
+            cost = min(linkCost + cost, COST_MAX)
+            if dst in self.suppressed or (self.holdDown and self.heldDown(dst, cost)):
+                continue
+            dstId = intern(dst)
+            if dstId >= len(fib.costs):
+                fib.grow(len(fib.addresses))
+            oldCost = fib.costs[dstId]
+            if oldCost == ABSENT or cost < oldCost or \
+                    (fib.nexts[dstId] == srcId and cost != oldCost):
+                if cost == COST_MAX:
+                    self.withdraw(dst)
+                fib.costs[dstId] = cost
+                fib.setNext(dstId, srcId)
+                changed.append(dst)
+        return changed
+
+    def withdraw(self, dst):
+        """a reachable route to dst is about to become unreachable: start its
+           hold-down timer and charge it a flap penalty"""
+        if self.routersCost.get(dst, COST_MAX) == COST_MAX:
+            return
+        if self.holdDownTime > 0:
+            self.holdDown[dst] = (self.now + self.holdDownTime, self.routersCost[dst])
+        if self.dampingHalfLife > 0:
+            penalty = self.currentPenalty(dst) + FLAP_PENALTY
+            self.penalty[dst] = (penalty, self.now)
+            if penalty > SUPPRESS_LIMIT:
+                self.suppressed.add(dst)
+
+    def heldDown(self, dst, cost):
+        """True if an advertisement of cost for dst must be ignored because
+           the route is in hold-down and cost is worse than before"""
+        if dst not in self.holdDown:
+            return False
+        until, oldCost = self.holdDown[dst]
+        if self.now >= until:
+            del self.holdDown[dst]
+            return False
+        return cost > oldCost
+
+    def currentPenalty(self, dst):
+        """flap penalty of dst decayed to the current time"""
+        if dst not in self.penalty:
+            return 0
+        penalty, since = self.penalty[dst]
+        return penalty * 0.5 ** ((self.now - since)/float(self.dampingHalfLife))
+
+    def triggerUpdate(self, dsts):
+        """queue changed destinations; they are flushed together once the
+           triggered update window has passed"""
+        if not self.pendingUpdates:
+            self.pendingSince = self.now
+        self.pendingUpdates.update(dsts)
+        if self.triggerDelay <= 0:
+            self.flushUpdates()
+
+    def flushUpdates(self):
+        """advertise all pending changes in one packet per neighbor"""
+        if self.pendingUpdates:
+            dsts = self.pendingUpdates
+            self.pendingUpdates = set()
+            self.broadcast(dsts)
+
+    def vectorFor(self, neighbor, entries):
+        """distance vector for (dst, cost, next hop) entries as advertised
+           to neighbor: routes through neighbor are poisoned (poisoned
+           reverse)"""
+        vector = {}
+        for dst, cost, nextHop in entries:
+            if nextHop == neighbor and dst != neighbor:
+                vector[dst] = COST_MAX
+            else:
+                vector[dst] = cost
+        return vector
+
+    def sendVector(self, port, entries):
+        """send (dst, cost, next hop) entries to the neighbor on port in one
+           packet"""
+        neighbor = self.routersAddr[port]
+        content = {}
+        content["src"] = self.addr
+        content["vector"] = self.vectorFor(neighbor, entries)
+        packet = Packet(Packet.ROUTING, self.addr, neighbor, dumps(content))
+        self.send(port, packet)
+
+    def broadcast(self, dsts=None):
+        """send the entries for dsts (default: the whole table) to every
+           neighbor"""
+        entries = self.fib.entries(dsts)
+        for port in self.routersAddr:
+            self.sendVector(port, entries)
 
 
     def handleNewLink(self, port, endpoint, cost):
         """handle new link"""
-        for router in self.routersPort:
-            # endpoint maybe connect to router via other nodes, now the new link connects them directly.
-            if (endpoint not in self.routersCost) or (self.routersCost[endpoint] > cost):
-                content = {}
-                content["src"] = self.addr
-                content["dst"] = endpoint
-                content["cost"] = cost
-                content_str = dumps(content)
-                packet = Packet(Packet.ROUTING, self.addr, router, content_str)
-                # send the new router info to other routers
-                self.send(self.routersPort[router], packet)
-
-                content1 = {}
-                content1["src"] = self.addr
-                content1["dst"] = router
-                content1["cost"] = self.routersCost[router]
-                content1_str = dumps(content1)
-                packet1 = Packet(Packet.ROUTING, self.addr,
-                                 endpoint, content1_str)
-                # send other router infos to the new router
-                self.send(port, packet1)
-        # update the routing table at self
         self.routersPort[endpoint] = port
         self.routersAddr[port] = endpoint
-        if (endpoint not in self.routersCost) or (self.routersCost[endpoint] > cost):
+        self.linkCost[endpoint] = cost
+        self.fib.refreshPorts()
+        # endpoint maybe connect to router via other nodes, now the new link connects them directly.
+        if (endpoint not in self.routersCost) or (self.routersCost[endpoint] > cost) or \
+                (self.routersNext[endpoint] == endpoint):
             self.routersCost[endpoint] = cost
             self.routersNext[endpoint] = endpoint
+            self.holdDown.pop(endpoint, None)
+            self.suppressed.discard(endpoint)
+            self.triggerUpdate([endpoint])
+        # send the whole table to the new neighbor
+        self.sendVector(port, self.fib.entries())
 
 
     def handleRemoveLink(self, port):
         """handle removed link"""
-        addr = self.routersAddr[port]
-        self.routersCost[addr] =  COST_MAX
-        for addr1 in self.routersNext:
-            if self.routersNext[addr1] == addr:
-                self.routersCost[addr1] =  COST_MAX
-        if addr == self.addr:
-            self.routersCost[addr] = 0
-            self.routersNext[addr] = addr
+        addr = self.routersAddr.pop(port)
+        del self.routersPort[addr]
+        del self.linkCost[addr]
+        self.fib.refreshPorts()
+        changed = []
+        for dst in self.routersNext:
+            if self.routersNext[dst] == addr and self.routersCost[dst] != COST_MAX:
+                self.withdraw(dst)
+                self.routersCost[dst] = COST_MAX
+                changed.append(dst)
+        if changed:
+            self.triggerUpdate(changed)
 
 
     def handleTime(self, timeMillisecs):
         """handle current time"""
+        self.now = timeMillisecs
+        for dst in list(self.suppressed):
+            if self.currentPenalty(dst) < REUSE_LIMIT:
+                self.suppressed.discard(dst)
+                del self.penalty[dst]
         if (self.lasttime == None) or (timeMillisecs - self.lasttime > self.heartbeat):
             self.lasttime = timeMillisecs
-
-            for addr1 in self.routersPort:
-                for dst1 in self.routersCost:
-                    content1 = {}
-                    content1["src"] = self.addr
-                    content1["dst"] = dst1
-                    content1["cost"] = self.routersCost[dst1]
-                    content1_str = dumps(content1)
-                    packet1 = Packet(Packet.ROUTING, self.addr,
-                                     addr1, content1_str)
-                    # send DV to neighbor nodes
-                    self.send(self.routersPort[addr1], packet1)
+            # send the whole DV to each neighbor, this covers pending updates
+            self.pendingUpdates = set()
+            self.broadcast()
+        elif self.pendingUpdates and timeMillisecs - self.pendingSince >= self.triggerDelay:
+            self.flushUpdates()
 
 
     def debugString(self):
         """generate a string for debugging in network visualizer"""
         out = str(self.routersNext) + "\n" + str(self.routersCost) + "\n" 
         return out
-
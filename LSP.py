@@ -1,18 +1,105 @@
+import zlib
+
+
 class LSP(object):
+    """Link state packet of one router: the cost to each of its neighbors,
+       its sequence number, a checksum of the costs and the time it was
+       installed in the local LSDB (to compute its age).  Slotted: an
+       LSDB holds one per router"""
+
+    __slots__ = ("addr", "seqnum", "nbcost", "checksum", "installed")
 
-    def __init__(self, addr, seqnum, nbcost):
+    def __init__(self, addr, seqnum, nbcost, installed=0):
         self.addr = addr
         self.seqnum = seqnum
         self.nbcost = nbcost
+        self.checksum = LSP.checksumOf(nbcost)
+        self.installed = installed
+
+    @staticmethod
+    def checksumOf(nbcost):
+        """Checksum of the neighbor costs, independent of dict order"""
+        return zlib.crc32(",".join("{}:{}".format(addr, cost)
+                                   for addr, cost in sorted(nbcost.items())))
+
+    def age(self, now):
+        """Time since the LSP was last installed or refreshed"""
+        return now - self.installed
 
     def updateLSP(self, packetIn):
+        """Install a newer LSP.  Returns True if the neighbor costs changed,
+           False if it is older or only refreshes the seqnum"""
         if self.seqnum >= packetIn["seqnum"]:
             return False
         self.seqnum = packetIn["seqnum"]
-        if self.nbcost == packetIn["nbcost"]:
+        checksum = LSP.checksumOf(packetIn["nbcost"])
+        if self.checksum == checksum:
             return False
-        if self.nbcost != packetIn["nbcost"]:
-            self.nbcost = packetIn["nbcost"]
-            return True
+        self.nbcost = packetIn["nbcost"]
+        self.checksum = checksum
+        return True
+
+    def __repr__(self):
+        return "LSP({}, seq={}, {})".format(self.addr, self.seqnum, self.nbcost)
+
+
+class LSDB(object):
+    """Link state database: the newest LSP of every origin router, indexed
+       by origin with its (seqnum, age, checksum).  receive classifies every
+       arriving LSP so the router only refloods new information, and newer
+       LSPs arriving less than minLSArrival after the previous one from the
+       same origin are held back (not dropped) until the interval passed"""
+
+    NEW = "new"                # first LSP from this origin
+    CHANGED = "changed"        # newer seqnum, different neighbor costs
+    REFRESH = "refresh"        # newer seqnum, same neighbor costs
+    DUPLICATE = "duplicate"    # same seqnum as the installed LSP
+    OLD = "old"                # older seqnum than the installed LSP
+    DEFERRED = "deferred"      # newer, but within minLSArrival
+
+    def __init__(self, minLSArrival=0):
+        self.lsps = {}         # origin -> LSP
+        self.deferred = {}     # origin -> (seqnum, item) held back by minLSArrival
+        self.minLSArrival = minLSArrival
+
+    def receive(self, addr, seqnum, nbcost, now):
+        """Classify and, if newer, install an LSP.  Returns one of the
+           result constants above"""
+        lsp = self.lsps.get(addr)
+        if lsp is None:
+            self.lsps[addr] = LSP(addr, seqnum, nbcost, now)
+            return LSDB.NEW
+        if seqnum < lsp.seqnum:
+            return LSDB.OLD
+        if seqnum == lsp.seqnum:
+            return LSDB.DUPLICATE
+        if lsp.age(now) < self.minLSArrival:
+            return LSDB.DEFERRED
+        changed = lsp.updateLSP({"seqnum": seqnum, "nbcost": nbcost})
+        lsp.installed = now
+        return LSDB.CHANGED if changed else LSDB.REFRESH
+
+    def defer(self, addr, seqnum, item):
+        """Hold back item (whatever the caller needs to receive the LSP
+           again later); only the newest deferred LSP per origin is kept"""
+        if addr not in self.deferred or self.deferred[addr][0] < seqnum:
+            self.deferred[addr] = (seqnum, item)
 
+    def dueDeferred(self, now):
+        """Remove and return the deferred items whose origin's minLSArrival
+           interval has passed"""
+        due = []
+        for addr, (seqnum, item) in self.deferred.items():
+            if addr not in self.lsps or self.lsps[addr].age(now) >= self.minLSArrival:
+                due.append(item)
+                del self.deferred[addr]
+        return due
 
+    def expire(self, now, maxAge, keep=None):
+        """Purge the LSPs older than maxAge (except the one of origin keep),
+           returns the purged origins"""
+        expired = [addr for addr, lsp in self.lsps.items()
+                   if addr != keep and lsp.age(now) > maxAge]
+        for addr in expired:
+            del self.lsps[addr]
+        return expired
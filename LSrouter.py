@@ -5,131 +5,386 @@
 #####################################################
 
 import sys
+import zlib
 from collections import defaultdict
 from router import Router
 from packet import Packet
-from json import dumps, loads
-from LSP import LSP
-from Queue import PriorityQueue
+from codec import dumps, loads
+from LSP import LSP, LSDB
+from fib import ForwardingTable, flowHash
+from heapq import heappush, heappop
 
 COST_MAX = 16
 class LSrouter(Router):
     """Link state routing protocol implementation."""
 
-    def __init__(self, addr, heartbeatTime):
-        """class fields and initialization code here"""
+    def __init__(self, addr, heartbeatTime, minLSInterval=None, minLSArrival=None,
+                 refreshInterval=None, maxAge=None, spf=None, ecmp=False):
+        """class fields and initialization code here.  minLSInterval is the
+           minimum time (ms) between two originations of our own LSP,
+           minLSArrival the minimum time between two accepted LSPs from the
+           same origin, refreshInterval how often an unchanged LSP is
+           re-originated and maxAge after how long an LSP that was not
+           refreshed is purged.  All default to multiples of the heartbeat.
+           spf is an optional SPFService (see spf.py) shared by the routers
+           of an in-process simulation that computes the shortest paths
+           in place of calPath/updatePath.  With ecmp (off by default),
+           traceroute packets
+           are spread over all equal-cost next hops by a hash of their
+           (source, destination), so every flow keeps one path"""
         Router.__init__(self, addr)  # initialize superclass - don't remove
-        self.routersLSP = {}  ### 
-        self.routersAddr = {} ###
-        self.routersPort = {} ### 
-        self.routersNext = {} ### 
-        self.routersCost = {} ### 
-        self.seqnum = 0 ###  
+        self.heartbeat = heartbeatTime
+        self.minLSInterval = heartbeatTime/5 if minLSInterval is None else minLSInterval
+        self.refreshInterval = 10*heartbeatTime if refreshInterval is None else refreshInterval
+        self.maxAge = 3*self.refreshInterval if maxAge is None else maxAge
+        self.lsdb = LSDB(heartbeatTime/10 if minLSArrival is None else minLSArrival)
+        self.routersLSP = self.lsdb.lsps
+        self.routersAddr = {} # neighbor at the end of each port
+        self.routersPort = {} # port towards each neighbor
+        self.fib = ForwardingTable(self.routersPort)
+        self.routersNext = self.fib.next # next hop towards each router
+        self.routersCost = self.fib.cost # path cost to each router
+        self.seqnum = 0       # seqnum of our latest LSP
         self.routersLSP[self.addr] = LSP(self.addr, 0, {}) 
+        self.routersParent = self.fib.parent # parent of each router in the shortest path tree
+        self.spfEdges = {}      # edges (origin -> {addr: cost}) the tree was computed from
+        self.spfChildren = defaultdict(set)
+        self.spfHops = {}       # hop count of the path to each router in the tree
+        self.topologyDirty = True
+        self.changedLSPs = set()
+        self.spf = spf
+        self.ecmp = ecmp
+        self.flowSeed = zlib.crc32(str(addr))
+
+        self.now = 0              # time of the latest handleTime (see startClock)
+        self.lastOriginated = None
+        self.originatePending = False
+        self.floodsSent = 0       # LSP packets sent (originated or reflooded)
+        self.floodsSuppressed = 0 # received LSPs not reflooded (duplicate or old)
+        self.lspsDeferred = 0     # received LSPs held back by minLSArrival
 
         self.lasttime = None
-        self.heartbeat = heartbeatTime
 
     def handlePacket(self, port, packet):
         """process incoming packet"""
         # deal with traceroute packet
         if packet.isTraceroute():
-            if packet.dstAddr in self.routersNext:
-                next_nb = self.routersNext[packet.dstAddr]
-                self.send(self.routersPort[next_nb], packet)
+            if self.ecmp:
+                port = self.fib.portFor(packet.dstAddr,
+                                        flowHash(packet.srcAddr, packet.dstAddr, self.flowSeed))
+            else:
+                port = self.fib.portFor(packet.dstAddr)
+            if port is not None:
+                self.send(port, packet)
         # deal with routing packet
-        transfer = False
         if packet.isRouting():
             if packet.dstAddr == packet.srcAddr:
                 return
+            self.receiveLSP(port, packet.content)
+
+
+    def receiveLSP(self, port, content):
+        """install an LSP received on port and reflood it if it is new"""
+        packetIn = loads(content)
+        addr = packetIn["addr"]
+        seqnum = packetIn["seqnum"]
+        if addr == self.addr:
+            # our own LSP coming back; a newer one is left over from before
+            # a restart, so jump past its seqnum
+            if seqnum > self.seqnum:
+                self.seqnum = seqnum
+                self.originate(force=True)
+            self.floodsSuppressed += 1
+            return
+        result = self.lsdb.receive(addr, seqnum, packetIn["nbcost"], self.now)
+        if result == LSDB.DEFERRED:
+            self.lsdb.defer(addr, seqnum, (port, content))
+            self.lspsDeferred += 1
+            return
+        if result in (LSDB.DUPLICATE, LSDB.OLD):
+            self.floodsSuppressed += 1
+            return
+        if result in (LSDB.NEW, LSDB.CHANGED):
+            self.markChanged(addr)
+        self.flood(content, exceptPort=port)
 
-            packetIn = loads(packet.content)
-            addr = packetIn["addr"]
-            seqnum = packetIn["seqnum"]
-            nbcost = packetIn["nbcost"]
-            if addr not in self.routersLSP:
-                self.routersLSP[addr] = LSP(addr, seqnum, nbcost)
-                transfer = True
-            if self.routersLSP[addr].updateLSP(packetIn):
-                transfer = True
 
-            if transfer:
-                for portNext in self.routersAddr:
-                    if portNext != port:
-                        packet.srcAddr = self.addr
-                        packet.dstAddr = self.routersAddr[portNext]
-                        self.send(portNext, packet)
+    def flood(self, content, exceptPort=None):
+        """send LSP content to every neighbor except the one on exceptPort"""
+        for port, addr in self.routersAddr.items():
+            if port != exceptPort:
+                self.send(port, Packet(Packet.ROUTING, self.addr, addr, content))
+                self.floodsSent += 1
+
+
+    def originate(self, force=False):
+        """flood a new version of our own LSP, at most once per minLSInterval;
+           a request inside the interval is remembered and served by
+           handleTime once the interval has passed"""
+        if not force and self.lastOriginated is not None and \
+                self.now - self.lastOriginated < self.minLSInterval:
+            self.originatePending = True
+            return
+        self.originatePending = False
+        self.lastOriginated = self.now
+        self.seqnum += 1 # update the sequence number
+        own = self.routersLSP[self.addr]
+        own.seqnum = self.seqnum
+        own.checksum = LSP.checksumOf(own.nbcost)
+        own.installed = self.now
+        content = {}
+        content["addr"] = self.addr
+        content["seqnum"] = self.seqnum
+        content["nbcost"] = own.nbcost
+        self.flood(dumps(content))
 
 
     def handleNewLink(self, port, endpoint, cost):
         """handle new link"""
         self.routersAddr[port] = endpoint
         self.routersPort[endpoint] = port
+        self.fib.refreshPorts()
         self.routersLSP[self.addr].nbcost[endpoint] = cost
-
-        content = {}
-        content["addr"] = self.addr
-        content["seqnum"] = self.seqnum   
-        content["nbcost"] = self.routersLSP[self.addr].nbcost
-        self.seqnum += 1 # update the sequence number
-        for port in self.routersAddr:
-            packet = Packet(Packet.ROUTING, self.addr, self.routersAddr[port], dumps(content))
-            self.send(port, packet)
+        self.markChanged(self.addr)
+        # database exchange: bring the new neighbor up to date
+        for addr, lsp in self.routersLSP.items():
+            if addr != self.addr:
+                content = {}
+                content["addr"] = addr
+                content["seqnum"] = lsp.seqnum
+                content["nbcost"] = lsp.nbcost
+                self.send(port, Packet(Packet.ROUTING, self.addr, endpoint, dumps(content)))
+                self.floodsSent += 1
+        self.originate()
 
     
+    def markChanged(self, addr):
+        """Record that the LSP of addr changed since the last SPF run"""
+        self.changedLSPs.add(addr)
+        self.topologyDirty = True
+
+
+    def liveEdges(self, addr):
+        """Links of the LSP of addr that are up (removed links are
+           advertised with cost COST_MAX)"""
+        if addr not in self.routersLSP:
+            return {}
+        return {nb: cost for nb, cost in self.routersLSP[addr].nbcost.items()
+                if cost < COST_MAX}
+
+
     def calPath(self):
-        # Dijkstra Algorithm for LS routing
-        self.setCostMax()
-        # put LSP info into a queue for operatisons
-        Q = PriorityQueue()
-        ListN = [self.addr]
-        for addr, nbcost in self.routersLSP[self.addr].nbcost.items():
-	        Q.put((nbcost, addr, addr)) 
-        while not Q.empty():
-            Cost, Addr, Next = Q.get(False)
-            """TODO: write your codes here to build the routing table"""
-            if Addr not in self.routersCost or self.routersCost[Addr] >= Cost:
-                self.routersCost[Addr] = Cost
-                self.routersNext[Addr] = Next
-                ListN = ListN + [Addr]
-                if Addr in self.routersLSP:
-                    for addr, nbcost in self.routersLSP[Addr].nbcost.items():
-                        if addr not in ListN:
-                            Q.put((nbcost + Cost, addr, Next)) 
-
-    def setCostMax(self):
-        # intializtion for routing table 
-        for addr in self.routersCost:
-            self.routersCost[addr] = COST_MAX
+        """Full Dijkstra over the whole LSDB: rebuild the shortest path
+           tree from scratch"""
+        self.fib.clear()
         self.routersCost[self.addr] = 0
         self.routersNext[self.addr] = self.addr
+        self.spfChildren = defaultdict(set)
+        self.spfHops = {self.addr: 0}
+        self.spfEdges = {addr: self.liveEdges(addr) for addr in self.routersLSP}
+        self.changedLSPs = set()
+        self.topologyDirty = False
+        heap = []
+        for addr, cost in self.spfEdges[self.addr].items():
+            heappush(heap, (cost, 1, addr, self.addr))
+        self.runSPF(heap)
+
+
+    def updatePath(self):
+        """Incremental SPF: only recompute the part of the shortest path
+           tree affected by the LSPs that changed since the last run.
+           Subtrees hanging off links whose cost went up (or that went
+           down) are detached and re-attached from their unaffected
+           neighbours; links whose cost went down are relaxed directly.
+           Both then propagate with the usual Dijkstra ordering"""
+        if not self.spfEdges:
+            self.calPath()
+            return
+        changed = self.changedLSPs
+        self.changedLSPs = set()
+        self.topologyDirty = False
+        detached = set()
+        improved = []
+        for origin in changed:
+            old = self.spfEdges.get(origin, {})
+            new = self.liveEdges(origin)
+            self.spfEdges[origin] = new
+            for addr, cost in old.items():
+                if (addr not in new or new[addr] > cost) and self.routersParent.get(addr) == origin:
+                    detached.add(addr)
+            for addr, cost in new.items():
+                if addr not in old or cost < old[addr]:
+                    improved.append((origin, addr))
+
+        # detach the affected subtrees
+        stack = list(detached)
+        while stack:
+            addr = stack.pop()
+            stack.extend(self.spfChildren.pop(addr, ()))
+            detached.add(addr)
+            self.routersCost.pop(addr, None)
+            self.routersNext.pop(addr, None)
+            self.spfHops.pop(addr, None)
+            parent = self.routersParent.pop(addr, None)
+            if parent is not None:
+                self.spfChildren[parent].discard(addr)
+
+        heap = []
+        if detached:
+            # re-attach detached routers through any router still in the tree
+            for origin, edges in self.spfEdges.items():
+                if origin in self.routersCost:
+                    for addr, cost in edges.items():
+                        if addr in detached:
+                            heappush(heap, (self.routersCost[origin] + cost,
+                                            self.spfHops[origin] + 1, addr, origin))
+        for origin, addr in improved:
+            if origin in self.routersCost:
+                cost = self.routersCost[origin] + self.spfEdges[origin][addr]
+                hops = self.spfHops[origin] + 1
+                if self.preferred(addr, cost, hops, origin):
+                    heappush(heap, (cost, hops, addr, origin))
+        self.runSPF(heap)
+
+
+    def sharedPath(self):
+        """Fill the forwarding table from the shared SPF service.  The
+           shortest path tree is not kept, so a later updatePath starts
+           over with calPath"""
+        paths = self.spf.paths(self)
+        self.fib.clear()
+        self.spfEdges = {}
+        self.spfChildren = defaultdict(set)
+        self.spfHops = {}
+        self.changedLSPs = set()
+        self.topologyDirty = False
+        for addr, cost, nextHop in paths:
+            self.routersCost[addr] = cost
+            self.routersNext[addr] = nextHop
+
+
+    def recomputePaths(self):
+        """Bring the forwarding table up to date with the LSDB"""
+        if self.spf is not None:
+            self.sharedPath()
+        else:
+            self.updatePath()
+        if self.ecmp:
+            self.calGroups()
+
+
+    def calGroups(self):
+        """Equal-cost next hop groups from the path costs: a router reached
+           at its lowest cost through several neighbours on the tree's
+           links inherits the first hops of all of them.  Routers are taken
+           in order of cost, so every group is complete before it is
+           inherited.  Only links with a positive cost count: a packet could
+           bounce between two routers joined by a zero-cost link, as each
+           reaches the destination as cheaply through the other.  A router
+           reached through zero-cost links only passes on its own next hop"""
+        costs = dict(self.routersCost.items())
+        groups = {}
+        for cost, addr in sorted((cost, addr) for addr, cost in costs.items()):
+            for nb, nbcost in self.liveEdges(addr).items():
+                if nbcost > 0 and costs.get(nb) == cost + nbcost:
+                    hops = [nb] if addr == self.addr else groups.get(addr) or [self.routersNext[addr]]
+                    groups.setdefault(nb, set()).update(hops)
+        self.fib.setGroups(groups)
+
+
+    def preferred(self, addr, cost, hops, parent):
+        """Whether reaching addr at cost in hops through parent beats its
+           current place in the tree: cheaper, or as cheap in fewer hops, or
+           both the same through a lower parent address, so ties break the
+           same way in calPath and updatePath.  Every link adds a hop, so
+           zero-cost links still make paths strictly longer and a router
+           never takes one of its descendants as parent"""
+        current = self.routersCost.get(addr)
+        if current is None:
+            return True
+        return ((cost, hops, parent) <
+                (current, self.spfHops[addr], self.routersParent.get(addr)))
+
+
+    def runSPF(self, heap):
+        """Dijkstra main loop shared by calPath and updatePath.  heap holds
+           (cost, hops, addr, parent) candidates; a router moves to a new
+           parent if that is shorter, or as short with a lower address (see
+           preferred).
+           Its subtree takes on its new next hop right away; the children
+           are not pushed again unless their cost changes"""
+        while heap:
+            cost, hops, addr, parent = heappop(heap)
+            if not self.preferred(addr, cost, hops, parent):
+                continue
+            oldParent = self.routersParent.get(addr)
+            if oldParent is not None:
+                self.spfChildren[oldParent].discard(addr)
+            self.routersParent[addr] = parent
+            self.spfChildren[parent].add(addr)
+            self.routersCost[addr] = cost
+            self.spfHops[addr] = hops
+            self.routersNext[addr] = addr if parent == self.addr else self.routersNext[parent]
+            self.passNextHop(addr)
+            for nb, nbcost in self.spfEdges.get(addr, {}).items():
+                if nb != self.addr and self.preferred(nb, cost + nbcost, hops + 1, addr):
+                    heappush(heap, (cost + nbcost, hops + 1, nb, addr))
+
+
+    def passNextHop(self, addr):
+        """Give the subtree of addr the next hop of addr"""
+        nextHop = self.routersNext[addr]
+        stack = list(self.spfChildren.get(addr, ()))
+        while stack:
+            child = stack.pop()
+            if self.routersNext.get(child) != nextHop:
+                self.routersNext[child] = nextHop
+                stack.extend(self.spfChildren.get(child, ()))
 
 
     def handleRemoveLink(self, port):
         """handle removed link"""
-        addr = self.routersAddr[port]
+        addr = self.routersAddr.pop(port)
+        del self.routersPort[addr]
+        self.fib.refreshPorts()
         self.routersLSP[self.addr].nbcost[addr] = COST_MAX
-        self.calPath()
+        self.markChanged(self.addr)
+        self.recomputePaths()
+        self.originate()
+
+
+    def startClock(self, timeMillisecs):
+        """First handleTime: LSPs installed before it were stamped with
+           time 0.  The clock may be wall time (threaded mode), so restamp
+           them with the current time, or the first expire would purge them
+           as ancient"""
+        for lsp in self.routersLSP.values():
+            lsp.installed = timeMillisecs
 
-        content = {}
-        content["addr"] = self.addr
-        content["seqnum"] = self.seqnum + 1 
-        content["nbcost"] = self.routersLSP[self.addr].nbcost
-        self.seqnum += 1
-        for port1 in self.routersAddr:
-            if port1 != port:
-                packet = Packet(Packet.ROUTING, self.addr, self.routersAddr[port1], dumps(content))
-                self.send(port1, packet)
-        pass
 
     def handleTime(self, timeMillisecs):
         """handle current time"""
+        if self.lasttime is None:
+            self.startClock(timeMillisecs)
+        self.now = timeMillisecs
+        for port, content in self.lsdb.dueDeferred(timeMillisecs):
+            self.receiveLSP(port, content)
+        if self.originatePending:
+            self.originate()
         if (self.lasttime == None) or (timeMillisecs - self.lasttime > self.heartbeat):
             self.lasttime = timeMillisecs
-            self.calPath()
+            if self.lastOriginated is None or timeMillisecs - self.lastOriginated >= self.refreshInterval:
+                self.originate()
+            for addr in self.lsdb.expire(timeMillisecs, self.maxAge, keep=self.addr):
+                self.markChanged(addr)
+            if self.topologyDirty:
+                self.recomputePaths()
       
 
     def debugString(self):
         """TODO: generate a string for debugging in network visualizer"""
         out = str(self.routersNext) + "\n" + str(self.routersCost) + "\n" + str(self.routersLSP)
+        if self.fib.groups:
+            out += "\n" + str({dst: self.fib.group(dst) for dst in self.routersCost
+                               if len(self.fib.group(dst)) > 1})
         return out
@@ -0,0 +1,38 @@
+class AddressTable:
+    """Interns router/client addresses as dense integer IDs.  One table is
+       shared by everything in the process, so an ID means the same address
+       to every router of a simulated network.  Each Network starts it
+       over (see codec.resetAddresses)"""
+
+    def __init__(self):
+        self.ids = {}          # address -> id
+        self.addrs = []        # id -> address
+
+
+    def intern(self, addr):
+        """Return the ID of addr, allocating the next free one if needed"""
+        try:
+            return self.ids[addr]
+        except KeyError:
+            self.ids[addr] = len(self.addrs)
+            self.addrs.append(addr)
+            return self.ids[addr]
+
+
+    def reset(self):
+        """Forget every address.  IDs handed out before are meaningless
+           afterwards; see codec.resetAddresses"""
+        self.ids.clear()
+        del self.addrs[:]
+
+
+    def lookup(self, addrId):
+        """Return the address with ID addrId"""
+        return self.addrs[addrId]
+
+
+    def __len__(self):
+        return len(self.addrs)
+
+
+addressTable = AddressTable()
@@ -0,0 +1,420 @@
+import sys
+import os
+import json
+import struct
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from itertools import izip
+from packet import Packet
+from tracelog import (TraceReader, SEND, DELIVER, TIME, NEW_LINK, REMOVE_LINK, LINK_CHANGE,
+                      ADDRESS, NAMES, SEND_HEAD, PACKET, PORT, LINK_CHANGE_BODY)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def groupBy(keys, weights=None):
+    """{key: count} of a column of integer keys, or {key: sum of weights}
+       with a parallel weights column.  Vectorized with numpy when it is
+       available"""
+    if numpy is not None and len(keys):
+        uniq, inverse = numpy.unique(numpy.asarray(keys), return_inverse=True)
+        sums = numpy.bincount(inverse, None if weights is None else numpy.asarray(weights),
+                              minlength=len(uniq))
+        return dict(izip(uniq.tolist(), (int(s) for s in sums.tolist())))
+    sums = defaultdict(int)
+    if weights is None:
+        for key in keys:
+            sums[key] += 1
+    else:
+        for key, weight in izip(keys, weights):
+            sums[key] += weight
+    return dict(sums)
+
+
+def groundTruthFor(reader):
+    """GroundTruth of the network a trace was recorded from, if its config
+       can be found (as recorded, or next to the trace), else None"""
+    from groundtruth import GroundTruth
+    from netconfig import loadConfig
+    path = reader.meta.get("network")
+    if not path:
+        return None
+    if not os.path.exists(path):
+        path = os.path.join(os.path.dirname(reader.filepath), os.path.basename(path))
+        if not os.path.exists(path):
+            return None
+    config = loadConfig(path)
+    return GroundTruth(config.routers, config.clients, config.links(), config.changes(),
+                       reader.meta.get("latencyMultiplier", 100))
+
+
+class TraceAnalysis(object):
+    """Offline statistics of a trace (see tracelog.py).  One pass over the
+       mapped file extracts columns (time, source, destination, kind and
+       size of every packet sent; routing packets received; handler
+       calls), decoding only record headers, plus the traceroutes that
+       reached a client and the link changes.  The statistics are group-bys
+       over these columns:
+         linkUtilization        per directed link
+         controlLoad            per router
+         routeTimelines         per (src, dst) client pair
+         convergenceIntervals   after the start and after every link change"""
+
+    def __init__(self, reader, truth=None, bucketSize=1000):
+        """truth is the GroundTruth used to tell correct routes (see
+           groundTruthFor); bucketSize the width in ms of the time buckets
+           of peak link load"""
+        self.reader = reader
+        self.truth = truth
+        self.bucketSize = bucketSize
+        self.addresses = reader.addresses
+        self.sendTimes = array('d')        # ms; exact for any trace time, unlike a 32-bit 'l'
+        self.sendSrcs = array('i')
+        self.sendDsts = array('i')
+        self.sendKinds = array('b')
+        self.sendSizes = array('i')
+        self.sendLatencies = array('i')
+        self.sendPacketDsts = array('i')   # final destination of the packet
+        self.sendLinks = array('i')        # dense id of the directed link of every send
+        self.links = {}                    # (src, dst) node ids -> link id
+        self.receivedRouting = array('i')  # receiving router of every routing packet
+        self.receivedSizes = array('i')
+        self.handlerKeys = array('i')      # node << 3 | record type
+        self.traceroutes = []  # (time, src, dst, route, isGood) delivered to a client
+        self.changes = []      # (time, "up"|"down", addr1, addr2, c12, c21)
+        self.endTime = 0
+        self.scan()
+
+
+    def scan(self):
+        """Extract the columns from the trace"""
+        reader, data = self.reader, self.reader.data
+        addresses = self.addresses
+        links = self.links
+        now = 0
+        for kind, now, node, offset, length in reader.headers(reader.start):
+            if kind == SEND:
+                dst, latency = SEND_HEAD.unpack_from(data, offset)
+                packetKind, _, packetDst, size, _ = PACKET.unpack_from(data, offset + SEND_HEAD.size)
+                self.sendTimes.append(now)
+                self.sendSrcs.append(node)
+                self.sendDsts.append(dst)
+                self.sendKinds.append(packetKind)
+                self.sendSizes.append(size)
+                self.sendLatencies.append(latency)
+                self.sendPacketDsts.append(packetDst)
+                link = links.get((node, dst))
+                if link is None:
+                    link = links[(node, dst)] = len(links)
+                self.sendLinks.append(link)
+            elif kind == DELIVER:
+                port = PORT.unpack_from(data, offset)[0]
+                packetKind, src, dst, size, routeLength = PACKET.unpack_from(data, offset + PORT.size)
+                if port != -1:
+                    self.handlerKeys.append(node << 3 | DELIVER)
+                if packetKind == Packet.ROUTING:
+                    self.receivedRouting.append(node)
+                    self.receivedSizes.append(size)
+                elif port == -1:
+                    route = struct.unpack_from("<{}i".format(routeLength), data,
+                                               offset + PORT.size + PACKET.size + size)
+                    self.traceroutes.append((now, src, dst, route, self.isCorrect(now, src, dst, route)))
+            elif kind in (TIME, NEW_LINK, REMOVE_LINK):
+                self.handlerKeys.append(node << 3 | kind)
+            elif kind == LINK_CHANGE:
+                up, addr1, addr2, c12, c21 = LINK_CHANGE_BODY.unpack_from(data, offset)
+                self.changes.append((now, "up" if up else "down",
+                                     addresses[addr1], addresses[addr2], c12, c21))
+            elif kind == ADDRESS:
+                reader.address(node, offset, length)
+        self.endTime = now
+
+
+    def isCorrect(self, now, src, dst, route):
+        """Whether a traceroute delivered at now took a lowest cost route,
+           None without ground truth"""
+        if self.truth is None:
+            return None
+        addresses = self.addresses
+        return self.truth.isCorrect(addresses[src], addresses[dst],
+                                    [addresses[hop] for hop in route], self.truth.phaseAt(now))
+
+
+    def linkUtilization(self):
+        """{(src, dst): stats} of every directed link that carried packets:
+           packets, bytes, routing packets, packets per second over the
+           run and the peak packets in one time bucket"""
+        packets = groupBy(self.sendLinks)
+        sizes = groupBy(self.sendLinks, self.sendSizes)
+        routing = groupBy(array('i', (link for link, kind in izip(self.sendLinks, self.sendKinds)
+                                      if kind == Packet.ROUTING)))
+        # (link, time bucket) keys as link * buckets + bucket, in 64 bits
+        # with numpy (links and buckets both fit in 31) or as Python longs
+        buckets = int(self.endTime) // self.bucketSize + 1
+        if numpy is not None:
+            keys = (numpy.asarray(self.sendLinks, dtype=numpy.int64) * buckets +
+                    numpy.asarray(self.sendTimes, dtype=numpy.int64) // self.bucketSize)
+        else:
+            keys = [link * buckets + int(now) // self.bucketSize
+                    for link, now in izip(self.sendLinks, self.sendTimes)]
+        peaks = defaultdict(int)
+        for key, count in groupBy(keys).items():
+            link = key // buckets
+            peaks[link] = max(peaks[link], count)
+        seconds = max(self.endTime, 1)/1000.0
+        addresses = self.addresses
+        return {(addresses[src], addresses[dst]): {
+                    "packets": packets[link],
+                    "bytes": sizes[link],
+                    "routingPackets": routing.get(link, 0),
+                    "packetsPerSecond": packets[link]/seconds,
+                    "peakPacketsPerBucket": peaks[link]}
+                for (src, dst), link in self.links.items()}
+
+
+    def controlLoad(self):
+        """{router: stats} of the routing packets and bytes every router
+           sent and received and its handler calls by kind"""
+        routingSrcs = array('i', (src for src, kind in izip(self.sendSrcs, self.sendKinds)
+                                  if kind == Packet.ROUTING))
+        routingSizes = array('i', (size for size, kind in izip(self.sendSizes, self.sendKinds)
+                                   if kind == Packet.ROUTING))
+        sent, sentBytes = groupBy(routingSrcs), groupBy(routingSrcs, routingSizes)
+        received = groupBy(self.receivedRouting)
+        receivedBytes = groupBy(self.receivedRouting, self.receivedSizes)
+        calls = groupBy(self.handlerKeys)
+        load = {}
+        for node, addr in enumerate(self.addresses):
+            if self.reader.roles.get(addr) != "r":
+                continue
+            load[addr] = {
+                "routingPacketsSent": sent.get(node, 0),
+                "routingBytesSent": sentBytes.get(node, 0),
+                "routingPacketsReceived": received.get(node, 0),
+                "routingBytesReceived": receivedBytes.get(node, 0),
+                "handlerCalls": {NAMES[kind]: calls.get(node << 3 | kind, 0)
+                                 for kind in (DELIVER, TIME, NEW_LINK, REMOVE_LINK)}}
+        return load
+
+
+    def routeTimelines(self):
+        """{(src, dst): [(time, route), ...]} of the traceroute routes of
+           every client pair, each entry a change of route"""
+        timelines = defaultdict(list)
+        addresses = self.addresses
+        for now, src, dst, route, _ in self.traceroutes:
+            timeline = timelines[(addresses[src], addresses[dst])]
+            route = [addresses[hop] for hop in route]
+            if not timeline or timeline[-1][1] != route:
+                timeline.append((now, route))
+        return dict(timelines)
+
+
+    def phases(self):
+        """(start, end, change) of the start of the run and of every link
+           change, change being None for the start"""
+        starts = [(0, None)] + [(change[0], change) for change in self.changes]
+        ends = [start for start, _ in starts[1:]] + [self.endTime + 1]
+        return [(start, end, change) for (start, change), end in zip(starts, ends)]
+
+
+    def convergenceIntervals(self):
+        """[(start, change, convergedAt)] for the start of the run and every
+           link change.  With ground truth, convergedAt is the delivery
+           time from which every traceroute of the phase was correct and
+           every reachable client pair had a correct one, None if the phase
+           ended first.  Without, it is the last change of any route in
+           the phase (the start if none changed)"""
+        times = [traceroute[0] for traceroute in self.traceroutes]
+        intervals = []
+        for start, end, change in self.phases():
+            first, last = bisect_left(times, start), bisect_left(times, end)
+            window = self.traceroutes[first:last]
+            if self.truth is not None:
+                convergedAt = self.convergedAt(window, self.truth.phaseAt(start))
+            else:
+                convergedAt = start
+                previous = {}
+                for now, src, dst, route, _ in window:
+                    if previous.get((src, dst), route) != route:
+                        convergedAt = now
+                    previous[(src, dst)] = route
+            intervals.append((start, change, convergedAt))
+        return intervals
+
+
+    def convergedAt(self, window, phase):
+        """Time since which the traceroutes of window are correct"""
+        lastIncorrect = max([i for i, traceroute in enumerate(window) if not traceroute[4]] or [-1])
+        firstCorrect = {}
+        for now, src, dst, _, _ in window[lastIncorrect + 1:]:
+            firstCorrect.setdefault((self.addresses[src], self.addresses[dst]), now)
+        expected = self.truth.reachablePairs(phase)
+        if not expected or any(pair not in firstCorrect for pair in expected):
+            return None
+        return max(firstCorrect[pair] for pair in expected)
+
+
+    def toDict(self):
+        """Every statistic as a JSON-able dict"""
+        pairKey = lambda pair: "{}->{}".format(*pair)
+        return {
+            "endTime": self.endTime,
+            "linkUtilization": {pairKey(link): stats for link, stats in self.linkUtilization().items()},
+            "controlLoad": self.controlLoad(),
+            "routeTimelines": {pairKey(pair): timeline for pair, timeline in self.routeTimelines().items()},
+            "convergence": [{"time": start, "change": change and list(change[1:]),
+                             "convergedAt": convergedAt,
+                             "interval": None if convergedAt is None else convergedAt - start}
+                            for start, change, convergedAt in self.convergenceIntervals()],
+        }
+
+
+class PlaybackNode(object):
+    """Stand-in for a router or client of a TracePlayback"""
+
+    def __init__(self, playback, addr):
+        self.playback = playback
+        self.addr = addr
+
+
+    def debugString(self):
+        """Routing packets sent and received up to the playback position"""
+        sent, received = self.playback.routingCountsAt(self.addr)
+        return "{} at {} ms: {} routing packets sent, {} received".format(
+            self.addr, int(self.playback.position), sent, received)
+
+
+class TracePlayback(object):
+    """A recorded run played back in the visualizer instead of a live
+       Network (see App): what App needs of a Network (routers, clients,
+       getRouteString) as of a playback position that App advances or
+       seeks"""
+
+    def __init__(self, analysis):
+        self.analysis = analysis
+        self.routers, self.clients = {}, {}
+        for addr, role in analysis.reader.roles.items():
+            nodes = self.routers if role == "r" else self.clients
+            nodes[addr] = PlaybackNode(self, addr)
+        self.endTime = analysis.endTime
+        self.position = 0
+        self.changeTimes = [change[0] for change in analysis.changes]
+        self.tracerouteTimes = [traceroute[0] for traceroute in analysis.traceroutes]
+        self.routingSent = defaultdict(list)  # addr -> times
+        self.routingReceived = defaultdict(list)
+        addresses = analysis.addresses
+        for now, src, dst, kind in izip(analysis.sendTimes, analysis.sendSrcs,
+                                        analysis.sendDsts, analysis.sendKinds):
+            if kind == Packet.ROUTING:
+                self.routingSent[addresses[src]].append(now)
+                self.routingReceived[addresses[dst]].append(now)
+
+
+    def sends(self, start, end):
+        """(time, src, dst, kind, packet destination, latency) of the
+           packets sent in [start, end)"""
+        a = self.analysis
+        addresses = a.addresses
+        first, last = bisect_left(a.sendTimes, start), bisect_left(a.sendTimes, end)
+        return [(int(a.sendTimes[i]), addresses[a.sendSrcs[i]], addresses[a.sendDsts[i]],
+                 a.sendKinds[i], addresses[a.sendPacketDsts[i]], a.sendLatencies[i])
+                for i in range(first, last)]
+
+
+    def linkChanges(self, start, end):
+        """(change, target) of the link changes in [start, end), target as
+           in network configs (ports are not recorded)"""
+        first, last = bisect_left(self.changeTimes, start), bisect_left(self.changeTimes, end)
+        return [(change, (addr1, addr2, None, None, c12, c21) if change == "up" else (addr1, addr2))
+                for _, change, addr1, addr2, c12, c21 in self.analysis.changes[first:last]]
+
+
+    def routingCountsAt(self, addr):
+        """(sent, received) routing packets of addr up to the position"""
+        return (bisect_right(self.routingSent[addr], self.position),
+                bisect_right(self.routingReceived[addr], self.position))
+
+
+    def getRoutes(self):
+        """{(src, dst): (route, isGood, time)} of the latest traceroutes
+           delivered up to the position"""
+        routes = {}
+        addresses = self.analysis.addresses
+        last = bisect_right(self.tracerouteTimes, self.position)
+        for now, src, dst, route, isGood in self.analysis.traceroutes[:last]:
+            routes[(addresses[src], addresses[dst])] = (
+                [addresses[hop] for hop in route], isGood is not False, now)
+        return routes
+
+
+    def getRouteString(self, labelIncorrect=True):
+        """Routes at the position, formatted like Network.getRouteString"""
+        routes = self.getRoutes()
+        routeStrings = sorted("{} -> {}: {} {}".format(src, dst, route,
+                              "" if (isGood or not labelIncorrect) else "Incorrect Route")
+                              for (src, dst), (route, isGood, _) in routes.items())
+        if routes and all(isGood for _, isGood, _ in routes.values()):
+            routeStrings.append("\nSUCCESS: All Routes correct!")
+        else:
+            routeStrings.append("\nFAILURE: Not all routes are correct")
+        return "\n".join(routeStrings)
+
+
+def printReport(analysis, top=10):
+    """Print the busiest links and routers and the convergence intervals"""
+    links = sorted(analysis.linkUtilization().items(), key=lambda item: -item[1]["bytes"])
+    print "{:<12} {:>10} {:>12} {:>10} {:>10} {:>10}".format(
+        "link", "packets", "bytes", "routing", "pkts/s", "peak")
+    for (src, dst), stats in links[:top]:
+        print "{:<12} {:>10} {:>12} {:>10} {:>10.1f} {:>10}".format(
+            "{}->{}".format(src, dst), stats["packets"], stats["bytes"], stats["routingPackets"],
+            stats["packetsPerSecond"], stats["peakPacketsPerBucket"])
+    print
+    print "{:<8} {:>10} {:>12} {:>10} {:>12}".format(
+        "router", "sent", "sent bytes", "received", "handleTime")
+    routers = sorted(analysis.controlLoad().items(), key=lambda item: -item[1]["routingBytesSent"])
+    for addr, stats in routers[:top]:
+        print "{:<8} {:>10} {:>12} {:>10} {:>12}".format(
+            addr, stats["routingPacketsSent"], stats["routingBytesSent"],
+            stats["routingPacketsReceived"], stats["handlerCalls"]["time"])
+    print
+    timelines = analysis.routeTimelines()
+    print "{} client pairs, {} route changes".format(
+        len(timelines), sum(len(timeline) - 1 for timeline in timelines.values()))
+    print
+    print "{:>10} {:<24} {:>14} {:>14}".format("time", "change", "converged at", "interval")
+    for start, change, convergedAt in analysis.convergenceIntervals():
+        name = "start" if change is None else "{} {}-{}".format(change[1], change[2], change[3])
+        print "{:>10} {:<24} {:>14} {:>14}".format(
+            start, name, "-" if convergedAt is None else convergedAt,
+            "-" if convergedAt is None else convergedAt - start)
+
+
+def main():
+    """Analyze a trace"""
+    parser = argparse.ArgumentParser(description="Statistics of a simulation trace")
+    parser.add_argument("trace", help="trace file written by simulator.py")
+    parser.add_argument("-b", "--bucket", type=int, default=1000,
+                        help="time bucket of the peak link load in ms (default: 1000)")
+    parser.add_argument("-n", "--top", type=int, default=10,
+                        help="busiest links and routers to print (default: 10)")
+    parser.add_argument("-o", "--out", default=None,
+                        help="write every statistic to this JSON file instead")
+    args = parser.parse_args()
+    reader = TraceReader(args.trace)
+    analysis = TraceAnalysis(reader, groundTruthFor(reader), args.bucket)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(analysis.toDict(), f, indent=1, sort_keys=True)
+    else:
+        printReport(analysis, args.top)
+
+
+if __name__ == "__main__":
+    main()
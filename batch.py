@@ -0,0 +1,127 @@
+import sys
+import os
+import csv
+import glob
+import json
+import time
+import argparse
+import traceback
+from multiprocessing import Pool, cpu_count
+
+
+FIELDS = ["file", "algorithm", "allCorrect", "correct", "incorrect", "convergenceTime",
+          "stoppedEarly", "packetsSent", "routingPacketsSent", "simulatedTime", "wallTime", "error"]
+
+
+def networkFiles(patterns):
+    """Network files matching patterns: directories stand for the .json
+       and .ndjson files in them, anything else is a glob"""
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files.extend(sorted(glob.glob(os.path.join(pattern, "*.json")) +
+                                glob.glob(os.path.join(pattern, "*.ndjson"))))
+        else:
+            files.extend(sorted(glob.glob(pattern)))
+    return files
+
+
+def runScenario(job):
+    """Run one (network file, algorithm, options) job headless on the
+       simulator and return its report row.  options are extra Network
+       arguments (latencyMultiplier, stopAfterRounds, sharedSPF, vectorized).  Errors are reported
+       in the row instead of aborting the whole batch"""
+    from visualize_network import Network, routerClassFromName
+    netJsonFilepath, algorithm, options = job
+    row = {"file": netJsonFilepath, "algorithm": algorithm, "error": ""}
+    startTime = time.time()
+    try:
+        net = Network(netJsonFilepath, routerClassFromName(algorithm), simulated=True, **options)
+        net.runSimulated()
+        routes = net.getRoutes()
+        correct = sum(1 for _, isGood, _ in routes.values() if isGood)
+        row.update(correct=correct, incorrect=len(routes) - correct,
+                   allCorrect=correct == len(routes) > 0,
+                   convergenceTime=net.convergenceTime(),
+                   stoppedEarly=net.stoppedAt is not None,
+                   packetsSent=net.simulator.packetsSent,
+                   routingPacketsSent=net.simulator.routingPacketsSent,
+                   simulatedTime=net.simulator.now)
+    except Exception:
+        row.update(allCorrect=False, error=traceback.format_exc().strip().splitlines()[-1])
+    row["wallTime"] = round(time.time() - startTime, 3)
+    return row
+
+
+def runBatch(files, algorithms, workers=None, **options):
+    """Run every file with every algorithm on a pool of workers processes
+       (default: one per core).  options are passed on to every Network.
+       Returns the rows in file, algorithm order"""
+    jobs = [(path, algorithm, options) for path in files for algorithm in algorithms]
+    pool = Pool(workers or cpu_count())
+    try:
+        rows = pool.map(runScenario, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return rows
+
+
+def writeReport(rows, outFilepath):
+    """Write rows as JSON lines if outFilepath ends in .jsonl, as CSV
+       otherwise ("-" is stdout)"""
+    out = sys.stdout if outFilepath == "-" else open(outFilepath, "wb")
+    try:
+        if outFilepath.endswith(".jsonl"):
+            for row in rows:
+                out.write(json.dumps(row, sort_keys=True) + "\n")
+        else:
+            writer = csv.DictWriter(out, FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def main():
+    """Parse the command line, run the batch and write the report"""
+    parser = argparse.ArgumentParser(
+        description="Run network files headless with several routing algorithms in parallel")
+    parser.add_argument("networks", nargs="+",
+                        help="network files, globs or directories of .json files")
+    parser.add_argument("-a", "--algorithms", default="DV,LS",
+                        help="comma separated router classes: DV, LS, Router (default: DV,LS)")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("-o", "--out", default="-",
+                        help="report file, .jsonl for JSON lines, CSV otherwise (default: stdout)")
+    parser.add_argument("-k", "--stop-after-rounds", type=int, default=None,
+                        help="end each run once all routes were correct for this many "
+                             "traceroute rounds after the last link change")
+    parser.add_argument("-m", "--latency-multiplier", type=int, default=100,
+                        help="ms of latency per unit of link cost (default: 100)")
+    parser.add_argument("--shared-spf", action="store_true",
+                        help="link state routers share one SPF service (see spf.py)")
+    parser.add_argument("--vectorized", action="store_true",
+                        help="the shared SPF service computes the paths of every origin in "
+                             "one numpy pass (implies --shared-spf, needs numpy)")
+    args = parser.parse_args()
+    files = networkFiles(args.networks)
+    if not files:
+        print "No network files match {}".format(" ".join(args.networks))
+        return 1
+    startTime = time.time()
+    rows = runBatch(files, args.algorithms.split(","), args.workers,
+                    latencyMultiplier=args.latency_multiplier,
+                    stopAfterRounds=args.stop_after_rounds,
+                    sharedSPF=args.shared_spf or args.vectorized, vectorized=args.vectorized)
+    writeReport(rows, args.out)
+    failed = sum(1 for row in rows if not row["allCorrect"])
+    sys.stderr.write("{} runs in {:.1f} s, {} not all correct\n".format(
+        len(rows), time.time() - startTime, failed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,498 @@
+import sys
+import time
+import thread
+import threading
+import json
+import os
+import tempfile
+import subprocess
+from copy import deepcopy
+from functools import partial
+from collections import defaultdict
+from packet import Packet
+from link import Link, DeliveryScheduler
+import codec
+
+
+def threadCount():
+    """Number of OS threads in this process (falls back to the threads
+       known to the threading module outside Linux)"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return threading.active_count()
+
+
+def legacySend(link, packet, src):
+    """The original Link.send: one sleeping thread per packet"""
+    def helper(p):
+        time.sleep(link.l12/float(1000))
+        link.q12.put(p)
+    thread.start_new_thread(helper, (packet.copy(),))
+
+
+def benchLinkDelivery(numPackets=5000, latency=50):
+    """Send numPackets back to back over one link, once with a thread per
+       packet and once with the shared DeliveryScheduler.  Reports delivered
+       packets/sec and the peak number of OS threads"""
+    results = []
+    for name in ("thread-per-packet", "delivery-scheduler"):
+        link = Link("A", "B", latency, latency, 1, scheduler=DeliveryScheduler())
+        send = legacySend if name == "thread-per-packet" else Link.send
+        baseThreads = threadCount()
+        peakThreads = baseThreads
+        startTime = time.time()
+        for i in range(numPackets):
+            try:
+                send(link, Packet(Packet.ROUTING, "A", "B", str(i)), "A")
+            except thread.error:
+                break
+            if i % 100 == 0:
+                peakThreads = max(peakThreads, threadCount())
+        received = []
+        while len(received) < numPackets and time.time() - startTime < 30:
+            packet = link.recv("B")
+            if packet:
+                received.append(int(packet.content))
+            else:
+                peakThreads = max(peakThreads, threadCount())
+                time.sleep(0.001)
+        elapsed = time.time() - startTime - latency/float(1000)
+        results.append((name, len(received), len(received)/max(elapsed, 1e-9),
+                        peakThreads - baseThreads, received == sorted(received)))
+    print "{:<20} {:>9} {:>12} {:>12} {:>6}".format(
+        "mode", "delivered", "packets/s", "peakThreads", "fifo")
+    for name, delivered, rate, threads, fifo in results:
+        print "{:<20} {:>9} {:>12.0f} {:>12} {:>6}".format(name, delivered, rate, threads, fifo)
+
+
+def netMessages(netJsonFilepath="0_net.json"):
+    """LSPs and distance vectors for the routers of a network file: one
+       of each per router, the vector covering every router and client"""
+    netJson = json.load(open(netJsonFilepath))
+    nbcost = defaultdict(dict)
+    for addr1, addr2, p1, p2, c12, c21 in netJson["links"]:
+        nbcost[addr1][addr2] = c12
+        nbcost[addr2][addr1] = c21
+    routers = netJson["routers"]
+    lsps = [{"addr": addr, "seqnum": 42, "nbcost": nbcost[addr]} for addr in routers]
+    dvs = [{"src": src, "vector": {dst: 3 for dst in routers + netJson["clients"]}}
+           for src in routers]
+    return lsps, dvs
+
+
+def benchCodec(rounds=2000):
+    """Encode/decode throughput and encoded size of every codec for the
+       routing messages of 0_net.json"""
+    lsps, dvs = netMessages()
+    print "{:<8} {:<6} {:>14} {:>14} {:>14}".format(
+        "codec", "kind", "encode msg/s", "decode msg/s", "bytes/update")
+    for name in ("json", "binary"):
+        c = codec.CODECS[name]
+        for kind, msgs in (("LSP", lsps), ("DV", dvs)):
+            startTime = time.time()
+            for _ in range(rounds):
+                encoded = [c.dumps(msg) for msg in msgs]
+            encodeRate = rounds*len(msgs)/(time.time() - startTime)
+            startTime = time.time()
+            for _ in range(rounds):
+                for data in encoded:
+                    c.loads(data)
+            decodeRate = rounds*len(msgs)/(time.time() - startTime)
+            size = sum(len(data) for data in encoded)/float(len(encoded))
+            print "{:<8} {:<6} {:>14.0f} {:>14.0f} {:>14.1f}".format(
+                name, kind, encodeRate, decodeRate, size)
+
+
+def gridNetwork(side, endTime=300):
+    """Write a side x side grid of routers (unit link costs, no clients) to
+       a temporary network file and return its path"""
+    from topogen import Grid, writeNetwork
+    fd, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        writeNetwork(f, Grid(side), numClients=0, minCost=1, maxCost=1, endTime=endTime)
+    return path
+
+
+def convergenceRun(netJsonFilepath, routerClass, window=10000):
+    """Run a network on the simulator, sampling every routing table each
+       tick.  Returns (network, time the tables last changed, routing
+       packets sent per second over the final window ms, list of
+       (time, routing packets sent so far) samples)"""
+    from visualize_network import Network
+    net = Network(netJsonFilepath, routerClass, simulated=True)
+    sim = net.simulator
+    state = {"last": None, "converged": 0, "windowStart": 0, "windowEnd": 0}
+    samples = []
+    def sample():
+        samples.append((sim.now, sim.routingPacketsSent))
+        tables = [sorted(r.routersCost.items()) for r in net.routers.values()]
+        if tables != state["last"]:
+            state["last"], state["converged"] = tables, sim.now
+        if sim.now <= net.endTime - window:
+            state["windowStart"] = sim.routingPacketsSent
+        if sim.now <= net.endTime:
+            state["windowEnd"] = sim.routingPacketsSent
+        sim.schedule(sim.tickTime, sample)
+    sim.schedule(0, sample)
+    net.runSimulated()
+    rate = (state["windowEnd"] - state["windowStart"])*1000.0/window
+    return net, state["converged"], rate, samples
+
+
+def benchDVScale(sides=(3, 5, 7, 10)):
+    """Routing packets per heartbeat and convergence time of DVrouter on
+       growing grids.  "per-entry" is what one packet per (neighbor,
+       destination) pair would cost for the same tables"""
+    from DVrouter import DVrouter
+    print "{:>8} {:>8} {:>14} {:>12} {:>14} {:>8}".format(
+        "routers", "links", "pkts/heartbeat", "per-entry", "converged(ms)", "wall(s)")
+    for side in sides:
+        path = gridNetwork(side)
+        startTime = time.time()
+        net, converged, rate, _ = convergenceRun(path, DVrouter)
+        wall = time.time() - startTime
+        os.remove(path)
+        router = net.routers.values()[0]
+        period = (router.heartbeat + net.simulator.tickTime)/1000.0
+        perEntry = sum(len(r.routersAddr)*len(r.routersCost) for r in net.routers.values())
+        print "{:>8} {:>8} {:>14.0f} {:>12} {:>14} {:>8.2f}".format(
+            len(net.routers), len(net.links), rate*period, perEntry, converged, wall)
+
+
+def benchDVDamping(netJsonFilepath="0_net_events.json"):
+    """Convergence time against control-plane packets after the link
+       failure of 0_net_events.json for several triggered-update windows,
+       hold-down times and flap damping settings"""
+    from DVrouter import DVrouter
+    netJson = json.load(open(netJsonFilepath))
+    settings = [
+        ("immediate", dict(triggerDelay=0, holdDownTime=0, dampingHalfLife=0)),
+        ("coalesce 100ms", dict(triggerDelay=100, holdDownTime=0, dampingHalfLife=0)),
+        ("coalesce 300ms", dict(triggerDelay=300, holdDownTime=0, dampingHalfLife=0)),
+        ("defaults", dict()),
+        ("hold-down 3s", dict(holdDownTime=3000)),
+    ]
+    print "{:<16} {:>14} {:>14} {:>14}".format(
+        "setting", "converged(ms)", "failure pkts", "peak pkts/s")
+    for name, kwargs in settings:
+        net, converged, _, samples = convergenceRun(netJsonFilepath, partial(DVrouter, **kwargs))
+        changeTime = min(c[0] for c in netJson["changes"])*net.latencyMultiplier
+        counts = [count for t, count in samples if changeTime <= t <= max(converged, changeTime)]
+        perSecond = [count for t, count in samples if t % 1000 == 0]
+        peak = max(b - a for a, b in zip(perSecond, perSecond[1:]))
+        print "{:<16} {:>14} {:>14} {:>14}".format(
+            name, converged - changeTime, counts[-1] - counts[0], peak)
+
+
+def benchTableMemory(sizes=(1000, 5000)):
+    """Memory of one router's routing table with an entry for every router,
+       as separate string-keyed dicts (cost, next hop, port, parent) and as
+       a ForwardingTable, and projected to a network where every router
+       holds a full table.  Address strings are shared by all tables in
+       both layouts and are not counted"""
+    from fib import ForwardingTable
+    from addresses import AddressTable
+    print "{:>8} {:>16} {:>16} {:>14} {:>14}".format(
+        "routers", "dict bytes/rtr", "array bytes/rtr", "dict net MB", "array net MB")
+    for size in sizes:
+        addrs = ["R{}".format(i) for i in range(size)]
+        dicts = [{addr: i % 16 for i, addr in enumerate(addrs)},
+                 {addr: addrs[i % 4] for i, addr in enumerate(addrs)},
+                 {addr: i % 4 for i, addr in enumerate(addrs)},
+                 {addr: addrs[i // 2] for i, addr in enumerate(addrs)}]
+        dictBytes = sum(sys.getsizeof(d) for d in dicts)
+        fib = ForwardingTable({addrs[i]: i for i in range(4)}, table=AddressTable())
+        fib.refreshPorts()
+        for i, addr in enumerate(addrs):
+            fib.cost[addr] = i % 16
+            fib.next[addr] = addrs[i % 4]
+            fib.parent[addr] = addrs[i // 2]
+        arrayBytes = sum(sys.getsizeof(column) for column in
+                         (fib.costs, fib.nexts, fib.ports, fib.parents))
+        print "{:>8} {:>16} {:>16} {:>14.1f} {:>14.1f}".format(
+            size, dictBytes, arrayBytes, dictBytes*size/1e6, arrayBytes*size/1e6)
+
+
+def startupRun(netJsonFilepath):
+    """Build a Network from a config in a fresh interpreter.  Returns
+       (seconds, peak RSS in MB) of the construction"""
+    script = ("import time, resource\n"
+              "startTime = time.time()\n"
+              "from visualize_network import Network\n"
+              "from router import Router\n"
+              "net = Network({!r}, Router, simulated=True)\n"
+              "print time.time() - startTime, "
+              "resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n").format(netJsonFilepath)
+    output = subprocess.check_output([sys.executable, "-c", script])
+    seconds, maxrss = output.split()
+    return float(seconds), int(maxrss)/1024.0
+
+
+def benchStartup(side=30, numChanges=200000, numRoutes=200000):
+    """Startup time and peak RSS of Network for a grid config carrying
+       numChanges link changes and numRoutes correct routes, as one JSON
+       document and in the line-delimited format of netconfig.py"""
+    from topogen import Grid, writeNetwork
+    from netconfig import convert
+    fd, jsonPath = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        writeNetwork(f, Grid(side), numClients=side, endTime=numChanges + 10)
+    netJson = json.load(open(jsonPath))
+    links = [link for link in netJson["links"] if not link[0].startswith("c")]
+    netJson["changes"] = [[t + 1, links[t % len(links)] if t % 2 else links[t % len(links)][:2],
+                           "up" if t % 2 else "down"] for t in range(numChanges)]
+    clients = netJson["clients"]
+    netJson["correctRoutes"] = [[clients[i % len(clients)], netJson["routers"][i % side],
+                                 clients[(i // len(clients)) % len(clients)]]
+                                for i in range(numRoutes)]
+    with open(jsonPath, "w") as f:
+        json.dump(netJson, f)
+    ndjsonPath = jsonPath[:-len(".json")] + ".ndjson"
+    convert(jsonPath, ndjsonPath)
+    del netJson
+    print "{:<8} {:>10} {:>12} {:>14}".format("format", "file MB", "startup(s)", "peak RSS MB")
+    for name, path in (("json", jsonPath), ("ndjson", ndjsonPath)):
+        seconds, rss = startupRun(path)
+        print "{:<8} {:>10.1f} {:>12.2f} {:>14.1f}".format(
+            name, os.path.getsize(path)/1e6, seconds, rss)
+        os.remove(path)
+
+
+class UnslottedPacket(Packet):
+    """Packet with an instance __dict__, like before it was slotted"""
+
+
+def legacyCopy(packet):
+    """The original Packet.copy: deepcopy of the content and of the route
+       list, returned as (packet, route list)"""
+    p = UnslottedPacket(packet.kind, packet.srcAddr, packet.dstAddr, content=deepcopy(packet.content))
+    return p, list(packet.getRoute())
+
+
+def benchPerHop(hops=(1, 8, 32), rounds=20000):
+    """Time and bytes allocated per hop for a packet carrying a 1 KB LSP
+       that has already travelled a given number of hops: the original
+       deepcopy of content and route list against the shared-content copy
+       with a persistent route"""
+    content = "x"*1024
+    print "{:>6} {:>18} {:>18} {:>18} {:>18}".format(
+        "hops", "legacy us/hop", "shared us/hop", "legacy bytes/hop", "shared bytes/hop")
+    for numHops in hops:
+        packet = Packet(Packet.ROUTING, "A", "B", content)
+        for i in range(numHops):
+            packet.addToRoute("R{}".format(i))
+        startTime = time.time()
+        for _ in range(rounds):
+            p, route = legacyCopy(packet)
+            route.append("B")
+        legacyTime = (time.time() - startTime)*1e6/rounds
+        legacyBytes = sys.getsizeof(p) + sys.getsizeof(p.__dict__) + sys.getsizeof(route)
+        startTime = time.time()
+        for _ in range(rounds):
+            p = packet.copy()
+            p.addToRoute("B")
+        sharedTime = (time.time() - startTime)*1e6/rounds
+        sharedBytes = sys.getsizeof(p) + sys.getsizeof(p.routeTail)
+        print "{:>6} {:>18.2f} {:>18.2f} {:>18} {:>18}".format(
+            numHops, legacyTime, sharedTime, legacyBytes, sharedBytes)
+
+
+def allocatedBytes(make, count):
+    """Bytes allocated per object by make(i), measured with tracemalloc
+       where available (Python 3) and otherwise as the sys.getsizeof of
+       each object and of the containers it references directly"""
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if tracemalloc:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [make(i) for i in range(count)]
+        used = tracemalloc.get_traced_memory()[0] - before - sys.getsizeof(objects)
+        tracemalloc.stop()
+        return used/float(count)
+    total = 0
+    for obj in [make(i) for i in range(count)]:
+        total += sys.getsizeof(obj)
+        for value in [getattr(obj, "__dict__", None)] + [
+                getattr(obj, name, None) for name in getattr(type(obj), "__slots__", ())]:
+            if isinstance(value, (dict, tuple, list)):
+                total += sys.getsizeof(value)
+        if hasattr(obj, "__dict__"):
+            total += sum(sys.getsizeof(v) for v in obj.__dict__.values()
+                         if isinstance(v, (dict, tuple, list)))
+    return total/float(count)
+
+
+def benchObjectMemory(count=20000):
+    """Bytes per in-flight packet (one hop into its route) and per LSDB
+       entry (an LSP with four neighbors), for the slotted classes and for
+       subclasses of them that have an instance __dict__ again"""
+    from LSP import LSP
+    class UnslottedLSP(LSP):
+        pass
+    content = "x"*64
+    nbcost = {"A": 1, "B": 2, "C": 3, "D": 4}
+    def packet(cls):
+        def make(i):
+            p = cls(Packet.ROUTING, "A", "B", content)
+            p.addToRoute("B")
+            return p
+        return make
+    def lsp(cls):
+        return lambda i: cls("R{}".format(i % 100), i, dict(nbcost))
+    print "{:<8} {:>14} {:>14}".format("object", "__dict__ B", "__slots__ B")
+    print "{:<8} {:>14.0f} {:>14.0f}".format(
+        "Packet", allocatedBytes(packet(UnslottedPacket), count), allocatedBytes(packet(Packet), count))
+    print "{:<8} {:>14.0f} {:>14.0f}".format(
+        "LSP", allocatedBytes(lsp(UnslottedLSP), count), allocatedBytes(lsp(LSP), count))
+
+
+def spfRun(netJsonFilepath, sharedSPF, vectorized=False):
+    """Run LSrouter on a network on the simulator, timing the route
+       computations.  Returns (network, seconds in recomputePaths, wall
+       seconds)"""
+    from LSrouter import LSrouter
+    from visualize_network import Network
+    net = Network(netJsonFilepath, LSrouter, simulated=True, sharedSPF=sharedSPF,
+                  vectorized=vectorized)
+    spent = [0.0]
+    for router in net.routers.values():
+        def timed(recompute=router.recomputePaths):
+            startTime = time.time()
+            recompute()
+            spent[0] += time.time() - startTime
+        router.recomputePaths = timed
+    startTime = time.time()
+    net.runSimulated()
+    return net, spent[0], time.time() - startTime
+
+
+def benchSPF(sides=(5, 10, 15)):
+    """Time spent computing shortest paths by every LSrouter on its own
+       and through the shared SPF service (vectorized too if numpy is
+       available) on growing grids.  Counts the routers whose final costs
+       and next hops differ from the routers' own SPF"""
+    from spf import numpy
+    modes = [("shared", False)] + ([("vectorized", True)] if numpy is not None else [])
+    print "{:>8} {:>11} {:>11} {:>7} {:>8} {:>9} {:>10} {:>10}".format(
+        "routers", "mode", "time (s)", "graphs", "lookups", "computed", "cost diff", "next diff")
+    for side in sides:
+        path = gridNetwork(side, endTime=100)
+        reference, ownTime, _ = spfRun(path, False)
+        size = len(reference.routers)
+        print "{:>8} {:>11} {:>11.3f}".format(size, "own", ownTime)
+        for mode, vectorized in modes:
+            shared, sharedTime, _ = spfRun(path, True, vectorized)
+            costDiff = nextDiff = 0
+            for addr, router in reference.routers.items():
+                mine, theirs = router.fib.entries(), shared.routers[addr].fib.entries()
+                costDiff += [e[:2] for e in mine] != [e[:2] for e in theirs]
+                nextDiff += mine != theirs
+            print "{:>8} {:>11} {:>11.3f} {:>7} {:>8} {:>9} {:>10} {:>10}".format(
+                size, mode, sharedTime, shared.spf.builds, shared.spf.lookups,
+                shared.spf.computed, costDiff, nextDiff)
+        os.remove(path)
+
+
+def benchIncrementalSPF(seeds=range(4)):
+    """Compare every incremental SPF run (updatePath) of LSrouter with a
+       full one (calPath) over the same LSDB, on generated networks with
+       link failures and recoveries, including zero-cost links.  Counts
+       the runs whose costs or next hops differ"""
+    from topogen import Grid, FatTree, writeNetwork
+    from LSrouter import LSrouter
+    from visualize_network import Network
+    mismatches = [0, 0]  # [runs, differing runs]
+
+    class CheckedLSrouter(LSrouter):
+        def updatePath(self):
+            LSrouter.updatePath(self)
+            full = LSrouter(self.addr, self.heartbeat)
+            full.routersLSP = self.routersLSP
+            full.calPath()
+            mismatches[0] += 1
+            mismatches[1] += full.fib.entries() != self.fib.entries()
+
+    cases = [("grid 8, costs 1-3", Grid(8), 1, 3), ("grid 8, costs 0-2", Grid(8), 0, 2),
+             ("fat-tree 4, costs 0-1", FatTree(4), 0, 1)]
+    print "{:>22} {:>5} {:>8} {:>11} {:>8}".format("network", "seed", "runs", "mismatches", "correct")
+    for name, family, minCost, maxCost in cases:
+        for seed in seeds:
+            fd, path = tempfile.mkstemp(suffix=".json")
+            with os.fdopen(fd, "w") as f:
+                writeNetwork(f, family, numClients=6, minCost=minCost, maxCost=maxCost, failures=6,
+                             failureStart=20, failureEnd=80, recovery=30, endTime=160, seed=seed)
+            mismatches[:] = [0, 0]
+            net = Network(path, CheckedLSrouter, simulated=True)
+            net.runSimulated()
+            os.remove(path)
+            routes = net.getRoutes()
+            print "{:>22} {:>5} {:>8} {:>11} {:>8}".format(
+                name, seed, mismatches[0], mismatches[1],
+                "{}/{}".format(sum(1 for _, isGood, _ in routes.values() if isGood), len(routes)))
+
+
+def benchECMP(side=6, numClients=16):
+    """Traceroute load on the router-to-router links of LSrouter with and
+       without ECMP on a grid with unit costs (many equal-cost paths):
+       links used, the busiest link and the coefficient of variation of
+       the loads, unused links counting as 0"""
+    from topogen import Grid, writeNetwork
+    from LSrouter import LSrouter
+    from metrics import MetricsCollector
+    from visualize_network import Network
+    fd, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        writeNetwork(f, Grid(side), numClients=numClients, minCost=1, maxCost=1, endTime=200)
+    print "{:>6} {:>10} {:>10} {:>10} {:>8}".format("ecmp", "links used", "max load", "load cv", "correct")
+    for ecmp in (False, True):
+        net = Network(path, partial(LSrouter, ecmp=ecmp), simulated=True)
+        metrics = MetricsCollector(net).attach()
+        net.runSimulated()
+        loads = [metrics.linkLoad.get((addr, nb), 0) for addr, router in net.routers.items()
+                 for nb in router.routersAddr.values() if nb in net.routers]
+        mean = sum(loads) / float(len(loads))
+        cv = (sum((load - mean)**2 for load in loads) / len(loads))**.5 / mean
+        routes = net.getRoutes()
+        print "{:>6} {:>10} {:>10} {:>10.3f} {:>8}".format(
+            str(ecmp), "{}/{}".format(sum(1 for load in loads if load), len(loads)), max(loads), cv,
+            "{}/{}".format(sum(1 for _, isGood, _ in routes.values() if isGood), len(routes)))
+    os.remove(path)
+
+
+BENCHMARKS = {
+    "link": benchLinkDelivery,
+    "codec": benchCodec,
+    "dvscale": benchDVScale,
+    "dvdamping": benchDVDamping,
+    "tablememory": benchTableMemory,
+    "startup": benchStartup,
+    "perhop": benchPerHop,
+    "objectmemory": benchObjectMemory,
+    "spf": benchSPF,
+    "incrementalspf": benchIncrementalSPF,
+    "ecmp": benchECMP,
+}
+
+
+def main():
+    """Run the benchmarks named on the command line (default: all)"""
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print "Unknown benchmark {}, choose from: {}".format(name, ", ".join(sorted(BENCHMARKS)))
+            return
+    for name in names:
+        print "== {} ==".format(name)
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import time
 import sys
 import Queue
 from packet import Packet
+from link import deliveryScheduler
 
 
 class Client:
@@ -15,31 +16,35 @@ class Client:
         self.allClients = allClients
         self.sendRate = sendRate
         self.lastTime = 0
+        self.now = 0           # time of the latest handleTime
         self.link = None
         self.updateFunction = updateFunction
         self.sending = True
-        self.linkChanges = Queue.Queue()
+        self.inbox = Queue.Queue()
+        self.tickTime = 100    # ms between handleTime calls
         self.keepRunning = True
 
 
     def changeLink(self, change):
         """Add a link to the client.
            The change argument should be a tuple ('add', link)"""
-        self.linkChanges.put(change)
+        self.inbox.put(("change", change))
 
 
     def handlePacket(self, packet):
         """Handle receiving a packet.  If it's a routing packet, ignore.
            If it's a "traceroute" packet, update the network object with it's
-           route"""
+           route and the time it was sent"""
         if packet.kind == Packet.TRACEROUTE:
-            self.updateFunction(packet.srcAddr, packet.dstAddr, packet.route)
+            self.updateFunction(packet.srcAddr, packet.dstAddr, packet.getRoute(),
+                                int(packet.content) if packet.content else None)
 
 
     def sendTraceroutes(self):
-        """Send traceroute packets to every other client in the network"""
+        """Send traceroute packets to every other client in the network.
+           Their content is the send time, for convergence metrics"""
         for dstClient in self.allClients:
-            packet = Packet(Packet.TRACEROUTE, self.addr, dstClient)
+            packet = Packet(Packet.TRACEROUTE, self.addr, dstClient, str(self.now))
             if self.link:
                 self.link.send(packet, self.addr)
             self.updateFunction(packet.srcAddr, packet.dstAddr, [])
@@ -47,27 +52,53 @@ class Client:
 
     def handleTime(self, timeMillisecs):
         """Send traceroute packets regularly"""
+        self.now = timeMillisecs
         if self.sending and (timeMillisecs - self.lastTime > self.sendRate):
             self.sendTraceroutes()
             self.lastTime = timeMillisecs
 
 
+    def handleLinkChange(self, change):
+        """Apply a link change tuple as queued by changeLink"""
+        if change[0] == "add":
+            self.link = change[1]
+            self.link.attach(self.addr, self.inbox)
+
+
     def runClient(self):
-        """Main loop of client"""
+        """Main loop of client.  Like Router.runRouter, sleeps on the inbox
+           and handles everything pending when woken"""
+        self.scheduleTick()
         while self.keepRunning:
-            time.sleep(0.1)
-            timeMillisecs = int(round(time.time() * 1000))
+            items = [self.inbox.get()]
             try:
-                change = self.linkChanges.get_nowait()
-                if change[0] == "add":
-                    self.link = change[1]
+                while True:
+                    items.append(self.inbox.get_nowait())
             except Queue.Empty:
                 pass
-            if self.link:
-                packet = self.link.recv(self.addr)
-                if packet:
-                    self.handlePacket(packet)
-            self.handleTime(timeMillisecs)
+            for item in items:
+                self.handleInboxItem(item)
+
+
+    def scheduleTick(self):
+        """Post the next handleTime deadline to the inbox"""
+        deliveryScheduler.callAt(time.time() + self.tickTime/float(1000),
+                                 self.inbox.put, ("time",))
+
+
+    def handleInboxItem(self, item):
+        """Dispatch one inbox item: ("change", change), ("packet", link)
+           or ("time",)"""
+        if item[0] == "change":
+            self.handleLinkChange(item[1])
+        elif item[0] == "packet":
+            packet = item[1].recv(self.addr)
+            if packet:
+                self.handlePacket(packet)
+        elif item[0] == "time":
+            if self.keepRunning:
+                self.handleTime(int(round(time.time() * 1000)))
+                self.scheduleTick()
 
 
     def lastSend(self):
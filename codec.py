@@ -0,0 +1,164 @@
+import json
+import struct
+from addresses import addressTable
+
+
+class JsonCodec:
+    """Human readable codec for routing packet content (debugging)"""
+
+    name = "json"
+
+    def dumps(self, msg):
+        """Encode a routing message dict as a JSON string"""
+        return json.dumps(msg)
+
+
+    def loads(self, data):
+        """Decode a JSON string into a routing message dict"""
+        return json.loads(data)
+
+
+class BinaryCodec:
+    """Compact struct-packed codec for routing packet content.  Addresses
+       are varints indexing the shared AddressTable, costs are signed and
+       seqnums unsigned 32-bit big-endian integers.  The first byte tags the
+       message kind:
+         DV:       {"src", "vector": {addr: cost}}
+         LSP:      {"addr", "seqnum", "nbcost": {addr: cost}}"""
+
+    name = "binary"
+
+    LSP = 2
+    DV = 3
+
+    COST = struct.Struct("!i")
+    SEQNUM = struct.Struct("!I")
+
+    def __init__(self, table=addressTable):
+        self.table = table
+        self.packedAddrs = {}  # address -> encoded varint of its ID
+
+
+    def dumps(self, msg):
+        """Encode a routing message dict as a binary string"""
+        if "nbcost" in msg:
+            out = [chr(BinaryCodec.LSP), self.packAddr(msg["addr"]),
+                   BinaryCodec.SEQNUM.pack(msg["seqnum"]),
+                   self.packVarint(len(msg["nbcost"]))]
+            for addr, cost in msg["nbcost"].items():
+                out.append(self.packAddr(addr))
+                out.append(BinaryCodec.COST.pack(cost))
+        elif "vector" in msg:
+            out = [chr(BinaryCodec.DV), self.packAddr(msg["src"]),
+                   self.packVarint(len(msg["vector"]))]
+            for addr, cost in msg["vector"].items():
+                out.append(self.packAddr(addr))
+                out.append(BinaryCodec.COST.pack(cost))
+        else:
+            raise ValueError("Unknown routing message: {}".format(msg))
+        return "".join(out)
+
+
+    def loads(self, data):
+        """Decode a binary string into a routing message dict"""
+        kind = ord(data[0])
+        if kind == BinaryCodec.LSP:
+            addr, pos = self.unpackAddr(data, 1)
+            seqnum, = BinaryCodec.SEQNUM.unpack_from(data, pos)
+            count, pos = self.unpackVarint(data, pos + 4)
+            nbcost = {}
+            for _ in range(count):
+                nb, pos = self.unpackAddr(data, pos)
+                nbcost[nb], = BinaryCodec.COST.unpack_from(data, pos)
+                pos += 4
+            return {"addr": addr, "seqnum": seqnum, "nbcost": nbcost}
+        elif kind == BinaryCodec.DV:
+            src, pos = self.unpackAddr(data, 1)
+            count, pos = self.unpackVarint(data, pos)
+            vector = {}
+            for _ in range(count):
+                dst, pos = self.unpackAddr(data, pos)
+                vector[dst], = BinaryCodec.COST.unpack_from(data, pos)
+                pos += 4
+            return {"src": src, "vector": vector}
+        raise ValueError("Unknown routing message kind {}".format(kind))
+
+
+    def reset(self):
+        """Forget the encoded addresses, after the address table was reset"""
+        self.packedAddrs = {}
+
+
+    def packAddr(self, addr):
+        """Encode an address as the varint of its interned ID"""
+        try:
+            return self.packedAddrs[addr]
+        except KeyError:
+            packed = self.packedAddrs[addr] = self.packVarint(self.table.intern(addr))
+            return packed
+
+
+    def unpackAddr(self, data, pos):
+        """Decode an address at pos, returns (addr, next pos)"""
+        if data[pos] < "\x80":
+            return self.table.lookup(ord(data[pos])), pos + 1
+        addrId, pos = self.unpackVarint(data, pos)
+        return self.table.lookup(addrId), pos
+
+
+    def packVarint(self, n):
+        """LEB128: 7 bits per byte, high bit set on all but the last byte"""
+        out = []
+        while n >= 0x80:
+            out.append(chr((n & 0x7f) | 0x80))
+            n >>= 7
+        out.append(chr(n))
+        return "".join(out)
+
+
+    def unpackVarint(self, data, pos):
+        """Decode a varint at pos, returns (value, next pos)"""
+        n = shift = 0
+        while True:
+            byte = ord(data[pos])
+            pos += 1
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n, pos
+            shift += 7
+
+
+CODECS = {
+    "json": JsonCodec(),
+    "binary": BinaryCodec(),
+}
+
+# codec used by dumps/loads, binary unless switched with setCodec
+current = CODECS["binary"]
+
+
+def setCodec(name):
+    """Select the codec (json|binary) used for all routing packets"""
+    global current
+    current = CODECS[name]
+
+
+def resetAddresses(addrs=()):
+    """Start over with an empty address table (and no cached encodings),
+       then intern addrs in order.  Called for every network, so a process
+       that runs several does not carry the addresses of the earlier ones
+       in every ForwardingTable"""
+    addressTable.reset()
+    CODECS["binary"].reset()
+    for addr in addrs:
+        addressTable.intern(addr)
+
+
+def dumps(msg):
+    """Encode a routing message with the current codec"""
+    return current.dumps(msg)
+
+
+def loads(data):
+    """Decode a routing message with the current codec"""
+    return current.loads(data)
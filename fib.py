@@ -0,0 +1,209 @@
+import zlib
+from array import array
+from addresses import addressTable
+
+ABSENT = -1
+
+
+class ForwardingTable(object):
+    """Compact routing table shared by DVrouter and LSrouter.  Destinations
+       are interned to dense IDs (see addresses.py) that index parallel
+       array('i') columns: path cost, next hop ID, outgoing port and, for
+       link state, parent ID in the shortest path tree.  A missing entry is
+       stored as ABSENT (-1).  The cost, next and parent columns are also
+       available as dict-like views indexed by address.  Destinations with
+       several equal-cost next hops also have a next hop group, used to
+       spread flows over them (see portFor)"""
+
+    def __init__(self, neighborPorts, table=addressTable):
+        """neighborPorts is the router's {neighbor: port} dict, used to keep
+           the port column in step with the next hop column.  Call
+           refreshPorts whenever it changes"""
+        self.addresses = table
+        self.neighborPorts = neighborPorts
+        self.nextPorts = {}    # neighbor ID -> port
+        self.costs = array('i')
+        self.nexts = array('i')
+        self.ports = array('i')
+        self.parents = array('i')
+        self.cost = Column(self, self.costs, isAddr=False)
+        self.next = Column(self, self.nexts, isAddr=True)
+        self.parent = Column(self, self.parents, isAddr=True)
+        self.groups = {}       # dst ID -> tuple of next hop IDs, if more than one
+
+
+    def grow(self, size):
+        """Make every column at least size entries long"""
+        missing = size - len(self.costs)
+        if missing > 0:
+            filler = array('i', [ABSENT]) * missing
+            for column in (self.costs, self.nexts, self.ports, self.parents):
+                column.extend(filler)
+
+
+    def setNext(self, dstId, nextId):
+        """Set the next hop of dstId and the matching outgoing port"""
+        self.nexts[dstId] = nextId
+        self.ports[dstId] = self.nextPorts.get(nextId, ABSENT)
+
+
+    def refreshPorts(self):
+        """Recompute the port column after neighbors were added or removed"""
+        self.nextPorts = {self.addresses.intern(addr): port
+                          for addr, port in self.neighborPorts.items()}
+        for dstId, nextId in enumerate(self.nexts):
+            if nextId != ABSENT:
+                self.setNext(dstId, nextId)
+
+
+    def portFor(self, dst, flowHash=None):
+        """Outgoing port towards dst, or None if there is no route.  With
+           a flowHash (see flowHash) and a next hop group for dst, the port
+           of the group member picked by the hash"""
+        dstId = self.addresses.ids.get(dst)
+        if dstId is None or dstId >= len(self.ports) or self.ports[dstId] == ABSENT:
+            return None
+        if flowHash is not None and dstId in self.groups:
+            ports = [self.nextPorts[nextId] for nextId in self.groups[dstId]
+                     if nextId in self.nextPorts]
+            if ports:
+                return ports[flowHash % len(ports)]
+        return self.ports[dstId]
+
+
+    def setGroups(self, groups):
+        """Replace the next hop groups with groups, {dst: next hops}"""
+        intern = self.addresses.intern
+        self.groups = {intern(dst): tuple(sorted(intern(nextHop) for nextHop in nextHops))
+                       for dst, nextHops in groups.items() if len(nextHops) > 1}
+
+
+    def group(self, dst):
+        """Equal-cost next hops towards dst"""
+        dstId = self.addresses.ids.get(dst)
+        if dstId in self.groups:
+            return [self.addresses.lookup(nextId) for nextId in self.groups[dstId]]
+        nextHop = self.next.get(dst)
+        return [] if nextHop is None else [nextHop]
+
+
+    def entries(self, dsts=None):
+        """(dst, cost, next hop) of every entry, or of the entries for dsts"""
+        lookup = self.addresses.lookup
+        if dsts is None:
+            dstIds = [dstId for dstId, cost in enumerate(self.costs) if cost != ABSENT]
+        else:
+            dstIds = [self.addresses.ids[dst] for dst in dsts]
+        return [(lookup(dstId), self.costs[dstId],
+                 None if self.nexts[dstId] == ABSENT else lookup(self.nexts[dstId]))
+                for dstId in dstIds]
+
+
+    def clear(self):
+        """Remove every entry"""
+        filler = array('i', [ABSENT]) * len(self.costs)
+        for column in (self.costs, self.nexts, self.ports, self.parents):
+            column[:] = filler
+        self.groups = {}
+
+
+def flowHash(src, dst, seed=0):
+    """Stable hash of the flow (src, dst): the same in every run and
+       process, so a flow always takes the same member of a next hop group.
+       Routers use their own seed so that they do not all pick the same
+       member position.  CRC32 is affine, so a seed fed to it (as initial
+       value or as part of the key) shifts every flow's hash by the same
+       XOR and all routers still choose alike; the seed is mixed in with
+       the murmur3 finalizer instead"""
+    h = (zlib.crc32("{}>{}".format(src, dst)) ^ seed) & 0xffffffff
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    return h ^ (h >> 16)
+
+
+class Column(object):
+    """Dict-like view of one ForwardingTable column, indexed by address.
+       Values of address columns (next hop, parent) are addresses too"""
+
+    def __init__(self, fib, values, isAddr):
+        self.fib = fib
+        self.values = values
+        self.isAddr = isAddr
+
+
+    def __getitem__(self, addr):
+        addrId = self.fib.addresses.ids.get(addr)
+        if addrId is None or addrId >= len(self.values) or self.values[addrId] == ABSENT:
+            raise KeyError(addr)
+        value = self.values[addrId]
+        return self.fib.addresses.lookup(value) if self.isAddr else value
+
+
+    def __setitem__(self, addr, value):
+        addrId = self.fib.addresses.intern(addr)
+        if addrId >= len(self.values):
+            self.fib.grow(len(self.fib.addresses))
+        if self.isAddr:
+            value = self.fib.addresses.intern(value)
+        if self.values is self.fib.nexts:
+            self.fib.setNext(addrId, value)
+        else:
+            self.values[addrId] = value
+
+
+    def __delitem__(self, addr):
+        self[addr]
+        if self.values is self.fib.nexts:
+            self.fib.setNext(self.fib.addresses.ids[addr], ABSENT)
+        else:
+            self.values[self.fib.addresses.ids[addr]] = ABSENT
+
+
+    def __contains__(self, addr):
+        addrId = self.fib.addresses.ids.get(addr)
+        return addrId is not None and addrId < len(self.values) and self.values[addrId] != ABSENT
+
+
+    def get(self, addr, default=None):
+        """Value for addr, or default if there is no entry"""
+        try:
+            return self[addr]
+        except KeyError:
+            return default
+
+
+    def pop(self, addr, *default):
+        """Remove the entry for addr and return its value"""
+        try:
+            value = self[addr]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[addr]
+        return value
+
+
+    def keys(self):
+        """Addresses that have an entry, in ID order"""
+        lookup = self.fib.addresses.lookup
+        return [lookup(addrId) for addrId, value in enumerate(self.values) if value != ABSENT]
+
+
+    def items(self):
+        """(address, value) pairs, in ID order"""
+        return [(addr, self[addr]) for addr in self.keys()]
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        return sum(1 for value in self.values if value != ABSENT)
+
+
+    def __repr__(self):
+        return repr(dict(self.items()))
@@ -0,0 +1,301 @@
+import sys
+import json
+import heapq
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from netconfig import loadConfig
+
+UNREACHABLE = -1
+
+
+class Topology(object):
+    """Directed link costs of one phase of a network, as CSR adjacency:
+       the out-edges of node i are targets[offsets[i]:offsets[i+1]] with
+       the matching costs, and the in-edges likewise in reverse order"""
+
+    def __init__(self, numNodes, costs):
+        """costs maps (u, v) node indexes to the cost of the link u -> v"""
+        self.numNodes = numNodes
+        self.costs = costs
+        self.offsets, self.targets, self.weights = self.csr(
+            sorted((u, v, c) for (u, v), c in costs.items()))
+        self.inOffsets, self.inSources, self.inWeights = self.csr(
+            sorted((v, u, c) for (u, v), c in costs.items()))
+
+
+    def csr(self, edges):
+        """(offsets, targets, weights) arrays of edges sorted by source"""
+        offsets = array('i', [0]) * (self.numNodes + 1)
+        for u, _, _ in edges:
+            offsets[u + 1] += 1
+        for i in range(self.numNodes):
+            offsets[i + 1] += offsets[i]
+        return (offsets, array('i', [v for _, v, _ in edges]),
+                array('i', [c for _, _, c in edges]))
+
+
+    def outEdges(self, u):
+        """(v, cost) of every link leaving u"""
+        start, end = self.offsets[u], self.offsets[u + 1]
+        return zip(self.targets[start:end], self.weights[start:end])
+
+
+class GroundTruth(object):
+    """Correct routes of a network config, for the topology at the start
+       and after each of its changes (one phase each).  Distances to a
+       destination are computed on demand by a Dijkstra run over the
+       reversed links, and cached; clients are never used as transit.
+       A route is correct if every hop is a link of the phase, every
+       intermediate node is a router and its cost is the lowest possible,
+       so every equal-cost alternative is accepted.  Only the links of the
+       first phase are kept, and for every later phase the links its
+       change sets or removes; the Topology of a phase (and its distances)
+       is built when the phase is first queried, and the latest
+       maxTopologies of them are cached"""
+
+    def __init__(self, routers, clients, links, changes=(), latencyMultiplier=100,
+                 maxTopologies=8):
+        """links and changes are in the network config format"""
+        self.nodes = list(routers) + list(clients)
+        self.index = {addr: i for i, addr in enumerate(self.nodes)}
+        self.numRouters = len(routers)
+        self.clients = list(clients)
+        self.latencyMultiplier = latencyMultiplier
+        self.maxTopologies = maxTopologies
+        self.baseCosts = {}
+        for addr1, addr2, _, _, c12, c21 in links:
+            self.addLink(self.baseCosts, addr1, addr2, c12, c21)
+        self.times = [0]       # start time of every phase, in ms
+        self.deltas = [[]]     # phase -> [(u, v, cost or None if removed)]
+        for changeTime, target, change in sorted(changes):
+            delta = []
+            if change == "up":
+                addr1, addr2, _, _, c12, c21 = target
+                u, v = self.index[addr1], self.index[addr2]
+                delta = [(u, v, c12), (v, u, c21)]
+            elif change == "down":
+                u, v = self.index[target[0]], self.index[target[1]]
+                delta = [(u, v, None), (v, u, None)]
+            self.times.append(changeTime*latencyMultiplier)
+            self.deltas.append(delta)
+        self.phases = OrderedDict()  # phase -> (Topology, {dst: distances}), LRU
+        self.loaded = {}       # phase -> {dst: distances} read by load
+        self.cursor = (0, dict(self.baseCosts))  # link costs of the latest phase built
+        self.lock = threading.Lock()
+
+
+    @classmethod
+    def fromConfig(cls, config, latencyMultiplier=100):
+        """Ground truth of a network config (see netconfig.py), with phase
+           times in ms for the given latencyMultiplier"""
+        return cls(config.routers, config.clients, config.links(), config.changes(),
+                   latencyMultiplier)
+
+
+    def addLink(self, costs, addr1, addr2, c12, c21):
+        """Add both directions of a link, keeping the cheaper of parallel links"""
+        u, v = self.index[addr1], self.index[addr2]
+        costs[(u, v)] = min(c12, costs.get((u, v), c12))
+        costs[(v, u)] = min(c21, costs.get((v, u), c21))
+
+
+    def phaseAt(self, timeMillisecs):
+        """Phase of the topology at simulated time timeMillisecs"""
+        return max(bisect_right(self.times, timeMillisecs) - 1, 0)
+
+
+    def phase(self, phase):
+        """(Topology, {dst: distances} cache) of phase, built from the link
+           changes on first use.  Phases are mostly asked for in time
+           order, so the link costs roll forward from the latest phase
+           built"""
+        phase %= len(self.times)
+        with self.lock:
+            if phase in self.phases:
+                self.phases[phase] = entry = self.phases.pop(phase)
+                return entry
+            built, costs = self.cursor
+            if phase < built:
+                built, costs = 0, dict(self.baseCosts)
+            for delta in self.deltas[built + 1:phase + 1]:
+                for u, v, cost in delta:
+                    if cost is None:
+                        costs.pop((u, v), None)
+                    else:
+                        costs[(u, v)] = min(cost, costs.get((u, v), cost))
+            self.cursor = (phase, costs)
+            entry = (Topology(len(self.nodes), dict(costs)), dict(self.loaded.get(phase, {})))
+            self.phases[phase] = entry
+            while len(self.phases) > self.maxTopologies:
+                self.phases.popitem(last=False)
+            return entry
+
+
+    def topology(self, phase=-1):
+        """Topology of phase"""
+        return self.phase(phase)[0]
+
+
+    def distancesTo(self, dst, phase=-1):
+        """array of the lowest cost from every node to node index dst"""
+        topology, cache = self.phase(phase)
+        if dst not in cache:
+            cache[dst] = self.dijkstra(topology, dst)
+        return cache[dst]
+
+
+    def dijkstra(self, topology, dst):
+        """Lowest costs to dst over the reversed links of topology"""
+        dist = array('i', [UNREACHABLE]) * topology.numNodes
+        dist[dst] = 0
+        heap = [(0, dst)]
+        while heap:
+            d, v = heapq.heappop(heap)
+            if d > dist[v] or (v != dst and v >= self.numRouters):
+                continue
+            for i in range(topology.inOffsets[v], topology.inOffsets[v + 1]):
+                u, c = topology.inSources[i], topology.inWeights[i]
+                if dist[u] == UNREACHABLE or d + c < dist[u]:
+                    dist[u] = d + c
+                    heapq.heappush(heap, (d + c, u))
+        return dist
+
+
+    def bestCost(self, src, dst, phase=-1):
+        """Lowest cost of a route from src to dst (node indexes) that leaves
+           src, or None.  For src == dst that is the cheapest round trip"""
+        dist = self.distancesTo(dst, phase)
+        best = None
+        for v, c in self.topology(phase).outEdges(src):
+            if dist[v] != UNREACHABLE and (v == dst or v < self.numRouters):
+                if best is None or c + dist[v] < best:
+                    best = c + dist[v]
+        return best
+
+
+    def nextHops(self, node, dst, phase=-1):
+        """Neighbors of node on a lowest cost route to dst (node indexes):
+           the equal-cost next hop group"""
+        dist = self.distancesTo(dst, phase)
+        if node == dst:
+            best = self.bestCost(node, dst, phase)
+        else:
+            best = dist[node]
+        return [v for v, c in self.topology(phase).outEdges(node)
+                if best is not None and dist[v] != UNREACHABLE
+                and (v == dst or v < self.numRouters) and c + dist[v] == best]
+
+
+    def isCorrect(self, src, dst, route, phase=-1):
+        """Whether route (a list of addresses) is a lowest cost route from
+           src to dst"""
+        try:
+            hops = [self.index[addr] for addr in route]
+        except KeyError:
+            return False
+        if len(hops) < 2 or route[0] != src or route[-1] != dst:
+            return False
+        if any(hop >= self.numRouters for hop in hops[1:-1]):
+            return False
+        costs = self.topology(phase).costs
+        try:
+            cost = sum(costs[(u, v)] for u, v in zip(hops, hops[1:]))
+        except KeyError:
+            return False
+        return cost == self.bestCost(hops[0], hops[-1], phase)
+
+
+    def routes(self, src, dst, phase=-1):
+        """Every lowest cost route from src to dst (addresses)"""
+        s, d = self.index[src], self.index[dst]
+        routes = []
+        def walk(node, path):
+            if node == d and len(path) > 1:
+                routes.append([self.nodes[i] for i in path])
+                return
+            for v in self.nextHops(node, d, phase):
+                walk(v, path + [v])
+        walk(s, [s])
+        return routes
+
+
+    def reachablePairs(self, phase=-1):
+        """(src, dst) client pairs that have a route"""
+        return [(src, dst) for dst in self.clients for src in self.clients
+                if self.bestCost(self.index[src], self.index[dst], phase) is not None]
+
+
+    def correctRoutes(self, phase=-1):
+        """All lowest cost client to client routes, in the correctRoutes
+           format of network configs"""
+        return [route for src, dst in sorted(self.reachablePairs(phase))
+                for route in self.routes(src, dst, phase)]
+
+
+    def dump(self, f):
+        """Write the compact indexed form: addresses once, then for every
+           phase its time and, per destination client, the distance of
+           every node (by index) to it"""
+        clientIds = [self.index[addr] for addr in self.clients]
+        json.dump({
+            "nodes": self.nodes,
+            "numRouters": self.numRouters,
+            "latencyMultiplier": self.latencyMultiplier,
+            "phases": [{"time": self.times[phase],
+                        "links": sorted([u, v, c] for (u, v), c in self.topology(phase).costs.items()),
+                        "distances": {str(dst): list(self.distancesTo(dst, phase))
+                                      for dst in clientIds}}
+                       for phase in range(len(self.times))],
+        }, f, separators=(",", ":"))
+
+
+    @classmethod
+    def load(cls, f, latencyMultiplier=None):
+        """Read the compact form written by dump, rescaling its phase
+           times to latencyMultiplier if given"""
+        data = json.load(f)
+        nodes, numRouters = data["nodes"], data["numRouters"]
+        dumped = data.get("latencyMultiplier", 100)
+        if latencyMultiplier is None:
+            latencyMultiplier = dumped
+        truth = cls(nodes[:numRouters], nodes[numRouters:], [], latencyMultiplier=latencyMultiplier)
+        truth.times, truth.deltas = [], []
+        previous = None
+        for i, phase in enumerate(data["phases"]):
+            costs = {(u, v): c for u, v, c in phase["links"]}
+            truth.times.append(phase["time"]*latencyMultiplier//dumped)
+            if previous is None:
+                truth.baseCosts = costs
+                truth.deltas.append([])
+            else:
+                # a changed cost is removed first, as set keeps the cheaper one
+                truth.deltas.append([(u, v, None) for (u, v), c in previous.items()
+                                     if costs.get((u, v)) != c] +
+                                    [(u, v, c) for (u, v), c in costs.items()
+                                     if previous.get((u, v)) != c])
+            truth.loaded[i] = {int(dst): array('i', dist) for dst, dist in phase["distances"].items()}
+            previous = costs
+        truth.cursor = (0, dict(truth.baseCosts))
+        return truth
+
+
+def main():
+    """Print the correct routes of a network file after its last change,
+       or write its ground truth in compact form"""
+    if len(sys.argv) < 2:
+        print "Usage: python groundtruth.py [networkSimulationFile.json] [groundTruth.json (optional)]"
+        return
+    truth = GroundTruth.fromConfig(loadConfig(sys.argv[1]))
+    if len(sys.argv) >= 3:
+        with open(sys.argv[2], "w") as f:
+            truth.dump(f)
+        print "Wrote {} phases for {} nodes to {}".format(
+            len(truth.times), len(truth.nodes), sys.argv[2])
+    else:
+        print json.dumps(truth.correctRoutes())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,53 +1,179 @@
-import thread
 import sys
 import Queue
 import time
 import threading
-from types import StringType
+import atexit
+from heapq import heappush, heappop
 
+MIN_LATENCY = 1  # ms
 
-class Link:
+
+class DeliveryScheduler:
+    """Delivers the packets of every threaded link from a single thread.
+       Packets wait in a heap ordered by due time and are handed to
+       Link.deliver once their latency has elapsed.  The same thread also
+       serves the handleTime timers of routers and clients (callAt)"""
+
+    def __init__(self):
+        """Create the heap and the condition guarding it.  The delivery
+           thread is started on the first transmit"""
+        self.pending = []      # heap of (due time, seqnum, callback, args)
+        self.seqnum = 0        # tie-breaker that keeps equal due times FIFO
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopped = False
+        self.delivered = 0
+
+
+    def transmit(self, link, packet, src):
+        """Called by Link.send: queue packet for delivery at the far end of
+           link.  A packet is never due before the previous packet sent in
+           the same direction, so lowering the latency with changeLatency
+           cannot reorder packets"""
+        endpoint = link.endpointFrom(src)
+        if endpoint is None:
+            return
+        dst, latency = endpoint
+        packet.addToRoute(dst)
+        packet.animateSend(src, dst, latency)
+        with self.cond:
+            due = link.reserveDue(dst, time.time() + latency/float(1000))
+            self.push(due, link.deliver, (packet, dst))
+
+
+    def callAt(self, due, callback, *args):
+        """Call callback(*args) from the delivery thread at time due
+           (seconds since the epoch)"""
+        with self.cond:
+            self.push(due, callback, args)
+
+
+    def push(self, due, callback, args):
+        """Add an event to the heap; the caller holds self.cond"""
+        heappush(self.pending, (due, self.seqnum, callback, args))
+        self.seqnum += 1
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.cond.notify()
+
+
+    def run(self):
+        """Delivery loop: sleep until the earliest event is due, run every
+           event that is due, repeat"""
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                now = time.time()
+                due = []
+                while self.pending and self.pending[0][0] <= now:
+                    due.append(heappop(self.pending))
+                if not due:
+                    self.cond.wait(self.pending[0][0] - now)
+                    continue
+            for _, _, callback, args in due:
+                callback(*args)
+            self.delivered += len(due)
+
+
+    def stop(self):
+        """Stop the delivery thread (at interpreter exit)"""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(1)
+
+
+# all threaded links share one delivery thread
+deliveryScheduler = DeliveryScheduler()
+atexit.register(deliveryScheduler.stop)
+
+
+class Link(object):
     """Link class represents link between two routers/clients
        handles sending and receiving packets using
        threadsafe queues"""
 
-    def __init__(self, e1, e2, l12, l21, latency):
+    __slots__ = ("q12", "q21", "l12", "l21", "latencyMultiplier", "e1", "e2",
+                 "scheduler", "inboxes", "due12", "due21")
+
+    def __init__(self, e1, e2, l12, l21, latency, scheduler=None):
         """Create queues. e1 & e2 are addresses of the 2 endpoints of
            the link. l12 and l21 are the latencies (in ms) in the
-           e1->e2 and e2->e1 directions, respectively"""
+           e1->e2 and e2->e1 directions, respectively, in units of
+           latency ms; a zero-cost link still takes MIN_LATENCY ms, or
+           a routing loop over it would never let time pass.  scheduler
+           delivers sent packets: the shared DeliveryScheduler by default,
+           or a Simulator (see simulator.py)"""
         self.q12 = Queue.Queue()
         self.q21 = Queue.Queue()
-        self.l12 = l12*latency
-        self.l21 = l21*latency
+        self.l12 = max(l12*latency, MIN_LATENCY)
+        self.l21 = max(l21*latency, MIN_LATENCY)
         self.latencyMultiplier = latency
         self.e1 = e1
         self.e2 = e2
+        self.scheduler = scheduler or deliveryScheduler
+        self.inboxes = {}      # endpoint address -> inbox woken on delivery
+        self.due12 = 0         # due time of the last packet sent e1 -> e2
+        self.due21 = 0         # and e2 -> e1 (DeliveryScheduler)
 
 
-    def send_helper(self, packet, src):
-        """Run in a separate thread and sends packet on
-           link FROM src after waiting for the appropriate latency"""
-        if src == self.e1:
-            packet.addToRoute(self.e2)
-            packet.animateSend(self.e1, self.e2, self.l12)
-            time.sleep(self.l12/float(1000))
+    def send(self, packet, src):
+        """Sends packet on link FROM src. Hands a copy to the scheduler
+           for delivery (the content is checked to be a string when the
+           packet is created).  (src must be equal to self.e1 or self.e2)"""
+        p = packet.copy()
+        self.scheduler.transmit(self, p, src)
+
+
+    def attach(self, addr, inbox):
+        """Have every packet delivered to endpoint addr announced on inbox
+           as ("packet", link)"""
+        self.inboxes[addr] = inbox
+
+
+    def detach(self, addr):
+        """Stop announcing deliveries to endpoint addr"""
+        self.inboxes.pop(addr, None)
+
+
+    def reserveDue(self, dst, due):
+        """Due time of a packet sent towards dst that would be due at due:
+           never before the previous packet sent in that direction"""
+        if dst == self.e2:
+            self.due12 = due = max(due, self.due12)
+        else:
+            self.due21 = due = max(due, self.due21)
+        return due
+
+
+    def deliver(self, packet, dst):
+        """Put a packet whose latency has elapsed in the queue of dst and
+           wake dst up if it is attached"""
+        if dst == self.e2:
             self.q12.put(packet)
-        elif src == self.e2:
-            packet.addToRoute(self.e1)
-            packet.animateSend(self.e2, self.e1, self.l21)
-            time.sleep(self.l21/float(1000))
+        elif dst == self.e1:
             self.q21.put(packet)
-        sys.stdout.flush()
+        else:
+            return
+        inbox = self.inboxes.get(dst)
+        if inbox is not None:
+            inbox.put(("packet", self))
 
 
-    def send(self, packet, src):
-        """Sends packet on link FROM src. Checks that packet content is
-           a string and starts a new thread to send it.
-           (src must be equal to self.e1 or self.e2)"""
-        if packet.content:
-            assert type(packet.content) is StringType, "Packet content must be a string"
-        p = packet.copy()
-        thread.start_new_thread(self.send_helper, (p, src))
+    def endpointFrom(self, src):
+        """Returns (dst, latency) for packets sent on the link FROM src,
+           or None if src is not an endpoint of this link"""
+        if src == self.e1:
+            return self.e2, self.l12
+        elif src == self.e2:
+            return self.e1, self.l21
+        return None
 
 
     def recv(self, dst, timeout=None):
@@ -71,6 +197,6 @@ class Link:
     def changeLatency(self, src, c):
         """Update the latency of sending on the link from src"""
         if src == self.e1:
-            self.l12 = c*self.latencyMultiplier
+            self.l12 = max(c*self.latencyMultiplier, MIN_LATENCY)
         elif src == self.e2:
-            self.l21 = c*self.latencyMultiplier
+            self.l21 = max(c*self.latencyMultiplier, MIN_LATENCY)
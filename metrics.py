@@ -0,0 +1,260 @@
+import json
+import time
+import threading
+from collections import defaultdict
+
+
+HANDLERS = ("handlePacket", "handleTime", "handleNewLink", "handleRemoveLink")
+COMPUTATIONS = ("calPath", "updatePath", "sharedPath", "updateVector")
+
+
+class MetricsCollector:
+    """Convergence and control-plane overhead of a Network.  Attach it
+       before running the network; it wraps the routers, clients and
+       Network.applyChange of that one network and records:
+         - routing packets and bytes sent by every router per time bucket
+         - the time after every link change (and after the start) until a
+           traceroute sent since then came back correct for every pair in
+           correctRoutes
+         - route computations per router: full and incremental Dijkstra
+           runs of LSrouter (or its shared SPF lookups), distance vector
+           updates of DVrouter
+         - calls and time spent in every handle... method of every router
+         - traceroute packets forwarded over every directed link, to see
+           how evenly ECMP forwarding spreads flows (see linkBalance)
+       Results export as a JSON dict or in Prometheus text format.  The
+       wrappers run on the router and client threads in threaded mode, so
+       every update takes the collector's lock"""
+
+    def __init__(self, network, bucketSize=1000):
+        """bucketSize is the width of the time buckets in ms"""
+        self.network = network
+        self.bucketSize = bucketSize
+        self.startTime = None
+        self.packets = defaultdict(lambda: defaultdict(int))  # router -> bucket -> count
+        self.bytes = defaultdict(lambda: defaultdict(int))    # router -> bucket -> bytes
+        self.computations = defaultdict(lambda: defaultdict(int))  # router -> kind -> count
+        self.handlerCalls = defaultdict(int)          # (router, handler) -> calls
+        self.handlerSeconds = defaultdict(float)      # (router, handler) -> seconds
+        self.handlerMaxSeconds = defaultdict(float)   # (router, handler) -> longest call
+        self.linkLoad = defaultdict(int)  # (router, neighbor) -> traceroute packets
+        self.expected = network.routeStore.expectedPairs()
+        self.lock = threading.Lock()
+        self.events = []       # convergence events, oldest first
+        self.openEvents = []   # events still waiting for convergence
+
+
+    def attach(self):
+        """Start collecting: wrap every router and client of the network"""
+        self.startTime = self.network.currentTime()
+        self.openEvent("start", None, self.startTime)
+        for router in self.network.routers.values():
+            self.wrapSend(router)
+            for name in HANDLERS:
+                self.wrapHandler(router, name)
+            for name in COMPUTATIONS:
+                if hasattr(router, name):
+                    self.wrapComputation(router, name)
+        for client in self.network.clients.values():
+            self.wrapReceive(client)
+        applyChange = self.network.applyChange
+        def changeWrapper(change, target):
+            with self.lock:
+                self.openEvent(change, target, self.network.currentTime())
+            return applyChange(change, target)
+        self.network.applyChange = changeWrapper
+        return self
+
+
+    def now(self):
+        """Time since attach in ms"""
+        return self.network.currentTime() - self.startTime
+
+
+    def wrapSend(self, router):
+        """Count the routing packets router sends, and the traceroute
+           packets it forwards per link"""
+        send = router.send
+        def wrapper(port, packet):
+            if packet.isRouting():
+                bucket = self.now() // self.bucketSize
+                with self.lock:
+                    self.packets[router.addr][bucket] += 1
+                    self.bytes[router.addr][bucket] += len(packet.content or "")
+            elif port in router.links:
+                endpoint = router.links[port].endpointFrom(router.addr)
+                if endpoint is not None:
+                    with self.lock:
+                        self.linkLoad[(router.addr, endpoint[0])] += 1
+            return send(port, packet)
+        router.send = wrapper
+
+
+    def wrapHandler(self, router, name):
+        """Time calls of router.name"""
+        handler = getattr(router, name)
+        key = (router.addr, name)
+        def wrapper(*args):
+            startTime = time.time()
+            try:
+                return handler(*args)
+            finally:
+                elapsed = time.time() - startTime
+                with self.lock:
+                    self.handlerCalls[key] += 1
+                    self.handlerSeconds[key] += elapsed
+                    self.handlerMaxSeconds[key] = max(self.handlerMaxSeconds[key], elapsed)
+        setattr(router, name, wrapper)
+
+
+    def wrapComputation(self, router, name):
+        """Count calls of router.name"""
+        computation = getattr(router, name)
+        def wrapper(*args):
+            with self.lock:
+                self.computations[router.addr][name] += 1
+            return computation(*args)
+        setattr(router, name, wrapper)
+
+
+    def wrapReceive(self, client):
+        """Watch the traceroutes client receives.  Each carries the time
+           it was sent (see Client.sendTraceroutes)"""
+        handlePacket = client.handlePacket
+        def wrapper(packet):
+            handlePacket(packet)
+            if packet.isTraceroute() and packet.content:
+                route = packet.getRoute()
+                with self.lock:
+                    self.traceroute(packet.srcAddr, packet.dstAddr, route, int(packet.content))
+        client.handlePacket = wrapper
+
+
+    def openEvent(self, change, target, timeMillisecs):
+        """Start waiting for convergence after a link change"""
+        event = {"change": change, "target": target,
+                 "time": timeMillisecs - self.startTime, "convergenceTime": None}
+        event["fresh"] = set()  # pairs correct with a traceroute sent after the event
+        self.events.append(event)
+        self.openEvents.append(event)
+
+
+    def traceroute(self, src, dst, route, sentAt):
+        """Account a completed traceroute, sent at time sentAt, to the
+           open events"""
+        pair = (src, dst)
+        isGood = self.network.routeStore.isCorrect(src, dst, route, self.network.currentTime())
+        sent = sentAt - self.startTime
+        for event in list(self.openEvents):
+            if not isGood:
+                event["fresh"].discard(pair)
+            elif sent >= event["time"]:
+                event["fresh"].add(pair)
+                if self.expected <= event["fresh"]:
+                    event["convergenceTime"] = self.now() - event["time"]
+                    self.openEvents.remove(event)
+
+
+    def linkBalance(self):
+        """Load balance of every router with traffic: the traceroute
+           packets it sent to each neighbor, and the ratio of the busiest
+           link to the mean over its used links (1.0 is perfectly even)"""
+        loads = defaultdict(dict)
+        for (addr, neighbor), count in self.linkLoad.items():
+            loads[addr][neighbor] = count
+        return {addr: {"links": links,
+                       "imbalance": round(max(links.values()) * len(links) /
+                                          float(sum(links.values())), 3)}
+                for addr, links in loads.items()}
+
+
+    def toDict(self):
+        """All metrics as a JSON-serializable dict"""
+        with self.lock:
+            return self.collect()
+
+
+    def collect(self):
+        """toDict without the lock"""
+        handlers = defaultdict(dict)
+        for (addr, name), calls in self.handlerCalls.items():
+            handlers[addr][name] = {"calls": calls,
+                                    "seconds": self.handlerSeconds[(addr, name)],
+                                    "maxSeconds": self.handlerMaxSeconds[(addr, name)]}
+        return {
+            "bucketSize": self.bucketSize,
+            "routingPackets": {addr: dict(buckets) for addr, buckets in self.packets.items()},
+            "routingBytes": {addr: dict(buckets) for addr, buckets in self.bytes.items()},
+            "convergence": [{key: event[key] for key in
+                             ("change", "target", "time", "convergenceTime")}
+                            for event in self.events],
+            "computations": {addr: dict(kinds) for addr, kinds in self.computations.items()},
+            "handlers": dict(handlers),
+            "linkLoad": self.linkBalance(),
+        }
+
+
+    def toJSON(self):
+        """All metrics as a JSON document"""
+        return json.dumps(self.toDict(), sort_keys=True, indent=2)
+
+
+    def toPrometheus(self):
+        """Totals in Prometheus text exposition format: running counters
+           only (the time buckets and the convergence events are in the
+           JSON form), so every run exposes the same series"""
+        with self.lock:
+            return self.exposition()
+
+
+    def exposition(self):
+        """toPrometheus without the lock"""
+        lines = []
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        def metric(name, kind, description, samples):
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                labelString = ",".join('{}="{}"'.format(key, escape(val)) for key, val in labels)
+                lines.append("{}{{{}}} {}".format(name, labelString, value) if labels else
+                             "{} {}".format(name, value))
+        metric("routing_packets_sent_total", "counter", "Routing packets sent per router.",
+               [((("router", addr),), sum(buckets.values()))
+                for addr, buckets in sorted(self.packets.items())])
+        metric("routing_bytes_sent_total", "counter", "Routing packet bytes sent per router.",
+               [((("router", addr),), sum(buckets.values()))
+                for addr, buckets in sorted(self.bytes.items())])
+        metric("route_computations_total", "counter",
+               "Dijkstra runs and distance vector updates per router.",
+               [((("router", addr), ("kind", kind)), count)
+                for addr, kinds in sorted(self.computations.items())
+                for kind, count in sorted(kinds.items())])
+        converged = [event["convergenceTime"] for event in self.events
+                     if event["convergenceTime"] is not None]
+        lines.append("# HELP convergence_time_ms Time from a link change (or the start) until all "
+                     "traceroutes were correct.")
+        lines.append("# TYPE convergence_time_ms summary")
+        lines.append("convergence_time_ms_sum {}".format(sum(converged)))
+        lines.append("convergence_time_ms_count {}".format(len(converged)))
+        metric("convergence_pending", "gauge",
+               "Link changes (or the start) still waiting for all traceroutes to be correct.",
+               [((), len(self.openEvents))])
+        metric("handler_calls_total", "counter", "Calls of each handle method per router.",
+               [((("router", addr), ("handler", name)), count)
+                for (addr, name), count in sorted(self.handlerCalls.items())])
+        metric("handler_seconds_total", "counter", "Time spent in each handle method per router.",
+               [((("router", addr), ("handler", name)), seconds)
+                for (addr, name), seconds in sorted(self.handlerSeconds.items())])
+        metric("link_traceroute_packets_total", "counter",
+               "Traceroute packets forwarded over each directed link.",
+               [((("src", src), ("dst", dst)), count)
+                for (src, dst), count in sorted(self.linkLoad.items())])
+        return "\n".join(lines) + "\n"
+
+
+    def write(self, filepath):
+        """Write the metrics to filepath, in Prometheus format if it ends
+           in .prom and as JSON otherwise"""
+        with open(filepath, "w") as f:
+            f.write(self.toPrometheus() if filepath.endswith(".prom") else self.toJSON())
@@ -0,0 +1,287 @@
+import sys
+import json
+from collections import defaultdict
+
+
+def loadConfig(filepath):
+    """Open a network config: NdjsonConfig for .ndjson files, JsonConfig
+       otherwise"""
+    if filepath.endswith(".ndjson"):
+        return NdjsonConfig(filepath)
+    return JsonConfig(filepath)
+
+
+class JsonConfig:
+    """Network config in the original format: one JSON document with
+       routers, clients, clientSendRate, endTime, links, changes,
+       correctRoutes and visualize"""
+
+    def __init__(self, filepath):
+        with open(filepath) as netJsonFile:
+            self.netJson = json.load(netJsonFile)
+        self.routers = self.netJson["routers"]
+        self.clients = self.netJson["clients"]
+        self.clientSendRate = self.netJson["clientSendRate"]
+        self.endTime = self.netJson["endTime"]
+        self.visualize = self.netJson.get("visualize")
+        self.groundTruth = self.netJson.get("groundTruth")
+
+
+    def links(self):
+        """[addr1, addr2, p1, p2, c12, c21] of every initial link"""
+        return iter(self.netJson["links"])
+
+
+    def changes(self):
+        """[time, target, "up"|"down"] of every link change, in time order"""
+        return iter(sorted(self.netJson.get("changes", [])))
+
+
+    def changeQueue(self):
+        """ChangeQueue of the link changes, or None if there are none"""
+        if "changes" not in self.netJson:
+            return None
+        return ChangeQueue(self.changes())
+
+
+    def lastChangeTime(self):
+        """Time of the last link change, 0 if there are none"""
+        return max([change[0] for change in self.netJson.get("changes", [])] or [0])
+
+
+    def correctRoutes(self):
+        """{(src, dst): [route, ...]} of the correct routes"""
+        correctRoutes = defaultdict(list)
+        for route in self.netJson.get("correctRoutes", []):
+            src, dst = route[0], route[-1]
+            correctRoutes[(src,dst)].append(route)
+        return correctRoutes
+
+
+class NdjsonConfig:
+    """Network config in the sidecar line-delimited format written by
+       convert: a header object with the scalar settings, then one JSON
+       array per line, in sections:
+         ["router", addr]
+         ["client", addr]
+         ["link", addr1, addr2, p1, p2, c12, c21]
+         ["change", time, target, "up"|"down"]     (in time order)
+         ["route", [src, ..., dst]]                (grouped by (src, dst))
+       Only the header, routers and clients are read up front.  Links and
+       changes are streamed from their file offsets when asked for, and
+       correct routes are indexed (by offset) on the first lookup and
+       parsed one pair at a time"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.routers = []
+        self.clients = []
+        self.offsets = {}      # section -> offset of its first line
+        with open(filepath, "rb") as f:
+            header = json.loads(f.readline())
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if line.startswith('["router"'):
+                    self.routers.append(json.loads(line)[1])
+                elif line.startswith('["client"'):
+                    self.clients.append(json.loads(line)[1])
+                else:
+                    self.offsets["link"] = offset
+                    break
+        self.clientSendRate = header["clientSendRate"]
+        self.endTime = header["endTime"]
+        self.visualize = header.get("visualize")
+        self.groundTruth = header.get("groundTruth")
+        self.hasChanges = header.get("hasChanges", True)
+        self.routeIndex = None
+
+
+    def section(self, kind):
+        """Parsed lines of section kind, read lazily"""
+        prefix = '["{}"'.format(kind)
+        with open(self.filepath, "rb") as f:
+            f.seek(self.sectionOffset(kind, f))
+            while True:
+                line = f.readline()
+                if not line.startswith(prefix):
+                    return
+                yield json.loads(line)
+
+
+    def sectionOffset(self, kind, f):
+        """Offset of the first line of section kind, found by skipping the
+           sections before it without parsing them"""
+        if kind not in self.offsets:
+            order = ["link", "change", "route"]
+            previous = order[order.index(kind) - 1]
+            f.seek(self.sectionOffset(previous, f))
+            prefix = '["{}"'.format(previous)
+            while True:
+                offset = f.tell()
+                if not f.readline().startswith(prefix):
+                    break
+            self.offsets[kind] = offset
+        return self.offsets[kind]
+
+
+    def links(self):
+        """[addr1, addr2, p1, p2, c12, c21] of every initial link"""
+        return (line[1:] for line in self.section("link"))
+
+
+    def changes(self):
+        """[time, target, "up"|"down"] of every link change, in time order"""
+        return (line[1:] for line in self.section("change"))
+
+
+    def changeQueue(self):
+        """ChangeQueue of the link changes, or None if there are none"""
+        return ChangeQueue(self.changes()) if self.hasChanges else None
+
+
+    def lastChangeTime(self):
+        """Time of the last link change, 0 if there are none"""
+        last = 0
+        for change in self.changes():
+            last = change[0]
+        return last
+
+
+    def correctRoutes(self):
+        """Lazy {(src, dst): [route, ...]} of the correct routes"""
+        return CorrectRouteIndex(self)
+
+
+class CorrectRouteIndex:
+    """Read-only mapping (src, dst) -> correct routes of an NdjsonConfig.
+       The first lookup records the offset of every pair's routes; the
+       routes of a pair are parsed when it is looked up"""
+
+    def __init__(self, config):
+        self.config = config
+        self.index = None      # (src, dst) -> offset of its first route
+
+
+    def build(self):
+        """Scan the route section once for the offset of every pair"""
+        if self.index is not None:
+            return
+        index = {}
+        with open(self.config.filepath, "rb") as f:
+            f.seek(self.config.sectionOffset("route", f))
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line.startswith('["route"'):
+                    break
+                route = json.loads(line)[1]
+                index.setdefault((route[0], route[-1]), offset)
+        self.index = index
+
+
+    def get(self, pair, default=None):
+        """Correct routes of pair, or default"""
+        self.build()
+        if pair not in self.index:
+            return default
+        routes = []
+        with open(self.config.filepath, "rb") as f:
+            f.seek(self.index[pair])
+            while True:
+                line = f.readline()
+                if not line.startswith('["route"'):
+                    break
+                route = json.loads(line)[1]
+                if (route[0], route[-1]) != pair:
+                    break
+                routes.append(route)
+        return routes
+
+
+    def __getitem__(self, pair):
+        return self.get(pair, [])
+
+
+    def __contains__(self, pair):
+        self.build()
+        return pair in self.index
+
+
+    def __iter__(self):
+        self.build()
+        return iter(self.index)
+
+
+    def __len__(self):
+        self.build()
+        return len(self.index)
+
+
+    def items(self):
+        """(pair, routes) of every pair; parses all routes"""
+        return [(pair, self.get(pair)) for pair in self]
+
+
+class ChangeQueue:
+    """The empty()/get() part of the PriorityQueue interface over link
+       changes that are already in time order, pulled one at a time"""
+
+    def __init__(self, changes):
+        self.changes = iter(changes)
+        self.next = None
+        self.advance()
+
+
+    def advance(self):
+        """Pull the next change"""
+        try:
+            self.next = tuple(next(self.changes))
+        except StopIteration:
+            self.next = None
+
+
+    def empty(self):
+        """Whether all changes were taken"""
+        return self.next is None
+
+
+    def get(self):
+        """Take the earliest change (time, target, change)"""
+        change = self.next
+        self.advance()
+        return change
+
+
+def convert(jsonFilepath, ndjsonFilepath):
+    """Write the NdjsonConfig form of a JSON network config"""
+    config = JsonConfig(jsonFilepath)
+    netJson = config.netJson
+    header = {key: value for key, value in netJson.items()
+              if key not in ("routers", "clients", "links", "changes", "correctRoutes")}
+    header["hasChanges"] = "changes" in netJson
+    dumps = lambda item: json.dumps(item, separators=(",", ":"))
+    with open(ndjsonFilepath, "wb") as f:
+        f.write(dumps(header) + "\n")
+        for addr in config.routers:
+            f.write(dumps(["router", addr]) + "\n")
+        for addr in config.clients:
+            f.write(dumps(["client", addr]) + "\n")
+        for link in config.links():
+            f.write(dumps(["link"] + link) + "\n")
+        for change in config.changes():
+            f.write(dumps(["change"] + change) + "\n")
+        for route in sorted(netJson.get("correctRoutes", []), key=lambda r: (r[0], r[-1])):
+            f.write(dumps(["route", route]) + "\n")
+
+
+def main():
+    """Convert a JSON network config to the line-delimited format"""
+    if len(sys.argv) < 3:
+        print "Usage: python netconfig.py [networkSimulationFile.json] [networkSimulationFile.ndjson]"
+        return
+    convert(sys.argv[1], sys.argv[2])
+
+
+if __name__ == "__main__":
+    main()
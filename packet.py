@@ -1,8 +1,15 @@
-from copy import deepcopy
+from types import StringType
 
-class Packet:
+
+class Packet(object):
     """Packet class defines packets that clients and routers
-       send in the simulated network"""
+       send in the simulated network.  Content is never copied: it is an
+       immutable string shared by every copy of the packet.  The route is
+       a persistent linked list of (addr, previous cell) cells, so a hop
+       adds one cell and copies share the cells before it; getRoute
+       builds the list.  Slotted: no per-instance __dict__"""
+
+    __slots__ = ("kind", "srcAddr", "dstAddr", "content", "routeTail")
 
     # Access these constants from other files
     # as Packet.TRACEROUTE or Packet.ROUTING
@@ -14,18 +21,25 @@ class Packet:
 
     def __init__(self, kind, srcAddr, dstAddr, content=None):
         """create a new packet"""
+        if content:
+            assert type(content) is StringType, "Packet content must be a string"
         self.kind = kind        # either TRACEROUTE or ROUTING
         self.srcAddr = srcAddr  # address of the source of the packet
         self.dstAddr = dstAddr  # address of the destination of the packet
         self.content = content  # content of the packet (must be a string)
-        self.route = [srcAddr]  # DO NOT access from DSrouter or LSrouter
+        self.routeTail = (srcAddr, None)  # DO NOT access from DSrouter or LSrouter
 
 
     def copy(self):
-        """Create a deepcopy of the packet.  This gets called automatically
-           when the packet is sent to avoid aliasing issues"""
-        p = Packet(self.kind, self.srcAddr, self.dstAddr, content=deepcopy(self.content))
-        p.route = list(self.route)
+        """Create a copy of the packet sharing its content and route cells.
+           This gets called automatically when the packet is sent, so
+           every hop extends its own route"""
+        p = Packet.__new__(Packet)
+        p.kind = self.kind
+        p.srcAddr = self.srcAddr
+        p.dstAddr = self.dstAddr
+        p.content = self.content
+        p.routeTail = self.routeTail
         return p
 
 
@@ -46,12 +60,20 @@ class Packet:
 
     def addToRoute(self, addr):
         '''DO NOT CALL from DVrouter or LSrouter'''
-        self.route.append(addr)
+        self.routeTail = (addr, self.routeTail)
 
 
     def getRoute(self):
         '''DO NOT CALL from DVRouter or LSrouter'''
-        return self.route
+        route = []
+        cell = self.routeTail
+        while cell is not None:
+            route.append(cell[0])
+            cell = cell[1]
+        route.reverse()
+        return route
+
+    route = property(getRoute)
 
 
     def animateSend(self, src, dst, latency):
@@ -0,0 +1,246 @@
+import sys
+import time
+from collections import defaultdict
+from multiprocessing import Process, Pipe, cpu_count
+from netconfig import loadConfig
+
+
+def partitionGraph(nodes, edges, parts, passes=8, imbalance=0.05):
+    """Split nodes into parts groups of about equal size with few edges
+       between groups.  edges is a list of (a, b) pairs.  Each group is
+       grown breadth-first from the frontier of the previous one, then
+       boundary nodes are moved to the group holding most of their
+       neighbors as long as that cuts fewer edges and keeps every group
+       within imbalance of the average size.  Returns {node: group}"""
+    adj = defaultdict(list)
+    for a, b in edges:
+        adj[a].append(b)
+        adj[b].append(a)
+    parts = max(1, min(parts, len(nodes)))
+    partOf = {}
+    sizes = [0]*parts
+    remaining = list(nodes)
+    frontier = []
+    for part in range(parts):
+        target = (len(nodes) - sum(sizes)) // (parts - part)
+        queue = [node for node in frontier if node not in partOf]
+        frontier = []
+        head = 0
+        while sizes[part] < target:
+            if head == len(queue):
+                while remaining[-1] in partOf:
+                    remaining.pop()
+                queue.append(remaining[-1])
+            node = queue[head]
+            head += 1
+            if node in partOf:
+                continue
+            partOf[node] = part
+            sizes[part] += 1
+            queue.extend(nb for nb in adj[node] if nb not in partOf)
+        frontier = queue[head:]
+
+    average = len(nodes)/float(parts)
+    maxSize, minSize = average*(1 + imbalance), average*(1 - imbalance)
+    for _ in range(passes):
+        moved = 0
+        for node in nodes:
+            own = partOf[node]
+            counts = defaultdict(int)
+            for nb in adj[node]:
+                counts[partOf[nb]] += 1
+            best = max(counts, key=lambda p: counts[p]) if counts else own
+            if (counts[best] > counts[own] and sizes[best] + 1 <= maxSize
+                    and sizes[own] - 1 >= minSize):
+                partOf[node] = best
+                sizes[own] -= 1
+                sizes[best] += 1
+                moved += 1
+        if not moved:
+            break
+    return partOf
+
+
+def partitionNetwork(config, parts):
+    """Partition the routers of a network config (see netconfig.py), each
+       client going with the router it is linked to.  Links that only come
+       up later count as well.  Returns {address: partition}"""
+    links = [link[:2] for link in config.links()]
+    links += [target[:2] for _, target, change in config.changes() if change == "up"]
+    routers = set(config.routers)
+    edges = [(a, b) for a, b in links if a in routers and b in routers]
+    partOf = partitionGraph(config.routers, edges, parts)
+    for a, b in links:
+        if a in routers and b not in routers:
+            partOf.setdefault(b, partOf[a])
+        elif b in routers and a not in routers:
+            partOf.setdefault(a, partOf[b])
+    for addr in config.clients:
+        partOf.setdefault(addr, 0)
+    return partOf
+
+
+def crossLinks(config, partOf):
+    """(addr1, addr2, c12, c21) of every link, present or coming up later,
+       whose endpoints are in different partitions"""
+    links = [(l[0], l[1], l[4], l[5]) for l in config.links()]
+    links += [(t[0], t[1], t[4], t[5]) for _, t, change in config.changes()
+              if change == "up"]
+    return [link for link in links if partOf[link[0]] != partOf[link[1]]]
+
+
+def partitionWorker(conn, netJsonFilepath, routerClass, partOf, part, options):
+    """Body of a worker process: simulate the routers and clients of one
+       partition, exchanging packets for the other partitions with the
+       coordinator in windows (see PartitionedRun).  options are extra
+       Network arguments"""
+    from visualize_network import Network
+    localNodes = set(addr for addr, p in partOf.items() if p == part)
+    net = Network(netJsonFilepath, routerClass, simulated=True, localNodes=localNodes, **options)
+    sim = net.simulator
+    outbox = []
+    def sendRemote(link, dst, packet, due):
+        outbox.append((partOf[dst], (due, (link.e1, link.e2), dst, packet)))
+    def deliverRemote(key, dst, packet):
+        if key in net.links:
+            sim.deliver(net.links[key][4], dst, packet)
+    sim.remote = sendRemote
+    net.startSimulated()
+    while True:
+        command = conn.recv()
+        if command[0] == "run":
+            _, until, inclusive, incoming = command
+            for due, key, dst, packet in incoming:
+                sim.scheduleAt(due, deliverRemote, key, dst, packet)
+            sim.run(until, inclusive)
+            conn.send(outbox)
+            outbox = []
+        elif command[0] == "lastSend":
+            net.resetRoutes()
+            for client in net.clients.values():
+                client.lastSend()
+            conn.send(None)
+        elif command[0] == "finish":
+            conn.send((net.getRoutes(), sim.packetsSent, sim.routingPacketsSent, sim.eventsHandled))
+            conn.close()
+            return
+
+
+class PartitionedRun:
+    """Runs one network config as several simulator processes.  The routers
+       are partitioned to cut few links, every worker simulates one
+       partition, and packets on links between partitions travel through
+       the coordinator over pipes.  Synchronization is conservative: a
+       packet sent at time t on a cross-partition link arrives no earlier
+       than t + lookahead, lookahead being the lowest latency of those
+       links, so all workers can safely run a window of lookahead ms before
+       exchanging the packets they sent in it.  A link that goes down and
+       comes back up while a cross-partition packet is in flight delivers
+       it on the new link"""
+
+    def __init__(self, netJsonFilepath, routerClass, workers=None, **options):
+        """options are extra Network arguments for the workers (sharedSPF,
+           vectorized)"""
+        self.netJsonFilepath = netJsonFilepath
+        self.routerClass = routerClass
+        self.options = options
+        self.workers = workers or cpu_count()
+        self.config = loadConfig(netJsonFilepath)
+        self.latencyMultiplier = 100
+        self.partOf = partitionNetwork(self.config, self.workers)
+        self.workers = max(self.partOf.values()) + 1 if self.partOf else 1
+        self.cut = crossLinks(self.config, self.partOf)
+        endTime = self.config.endTime*self.latencyMultiplier
+        self.lookahead = min([min(c12, c21)*self.latencyMultiplier
+                              for _, _, c12, c21 in self.cut] or [endTime])
+        self.conns = []
+        self.inboxes = [[] for _ in range(self.workers)]
+        self.rounds = 0
+        self.packetsSent = 0
+        self.routingPacketsSent = 0
+        self.eventsHandled = 0
+
+
+    def run(self):
+        """Run the network up to endTime, then one final batch of traceroutes
+           like Network.finalRoutes.  Returns the merged traceroute routes"""
+        for part in range(self.workers):
+            conn, child = Pipe()
+            process = Process(target=partitionWorker, args=(
+                child, self.netJsonFilepath, self.routerClass, self.partOf, part, self.options))
+            process.daemon = True
+            process.start()
+            self.conns.append(conn)
+        endTime = self.config.endTime*self.latencyMultiplier
+        clientSendRate = self.config.clientSendRate*self.latencyMultiplier
+        self.runWindows(0, endTime)
+        for conn in self.conns:
+            conn.send(("lastSend",))
+        for conn in self.conns:
+            conn.recv()
+        self.runWindows(endTime, endTime + 4*clientSendRate)
+        return self.finish()
+
+
+    def runWindows(self, start, end):
+        """Advance every worker from start to end (inclusive) in lookahead
+           windows"""
+        now = start
+        while now < end:
+            now = min(now + self.lookahead, end)
+            self.advance(now, False)
+        # events at exactly end only send packets arriving after end
+        self.advance(end, True)
+
+
+    def advance(self, until, inclusive):
+        """One synchronization round: hand every worker the packets due in
+           its partition and collect the ones it sends before until"""
+        for conn, incoming in zip(self.conns, self.inboxes):
+            conn.send(("run", until, inclusive, incoming))
+        self.inboxes = [[] for _ in range(self.workers)]
+        for conn in self.conns:
+            for part, item in conn.recv():
+                self.inboxes[part].append(item)
+        self.rounds += 1
+
+
+    def finish(self):
+        """Stop the workers and merge their routes, keeping the newest
+           entry of every (src, dst) pair"""
+        routes = {}
+        for conn in self.conns:
+            conn.send(("finish",))
+            workerRoutes, packets, routingPackets, events = conn.recv()
+            self.packetsSent += packets
+            self.routingPacketsSent += routingPackets
+            self.eventsHandled += events
+            for key, entry in workerRoutes.items():
+                if key not in routes or entry[2] > routes[key][2]:
+                    routes[key] = entry
+        return routes
+
+
+def main():
+    """Run a network file on several processes and print the final routes"""
+    flags = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) < 2 or set(flags) - set(["--shared-spf", "--vectorized"]):
+        print "Usage: python partition.py [networkSimulationFile.json] [DV|LS] [workers (optional)] [--shared-spf] [--vectorized]"
+        return
+    from visualize_network import Network, routerClassFromName
+    routerClass = routerClassFromName(args[1])
+    workers = int(args[2]) if len(args) >= 3 else None
+    vectorized = "--vectorized" in flags
+    startTime = time.time()
+    net = Network(args[0], routerClass, simulated=True, localNodes=(),
+                  sharedSPF=vectorized or "--shared-spf" in flags, vectorized=vectorized)
+    run = net.runPartitioned(workers)
+    sys.stdout.write("\n"+net.getRouteString()+"\n")
+    print "Simulated on {} workers in {:.3f} s ({} cut links, lookahead {} ms, {} rounds, {} events, {} packets)".format(
+        run.workers, time.time() - startTime, len(run.cut), run.lookahead,
+        run.rounds, run.eventsHandled, run.packetsSent)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 import time
 import sys
-import thread
 import Queue
+from link import deliveryScheduler
 
 
 class Router:
@@ -12,10 +12,13 @@ class Router:
 
 
     def __init__(self, addr, heartbeatTime=None):
-        """Initialize Router address and threadsafe queue for link changes"""
+        """Initialize Router address and threadsafe inbox for link changes,
+           packet arrivals and timer events"""
         self.addr = addr       # address/ID of router
         self.links = {}        # links indexed by port
-        self.linkChanges = Queue.Queue()
+        self.linkPorts = {}    # ports indexed by link
+        self.inbox = Queue.Queue()
+        self.tickTime = 100    # ms between handleTime calls
         self.keepRunning = True
 
 
@@ -23,7 +26,7 @@ class Router:
         """Add, remove, or change the cost of a link.
            The change argument is a tuple with first element
            'add', or 'remove' """
-        self.linkChanges.put(change)
+        self.inbox.put(("change", change))
 
 
     def addLink(self, port, endpointAddr, link, cost):
@@ -31,33 +34,65 @@ class Router:
         if port in self.links:
             self.removeLink(port)
         self.links[port] = link
+        self.linkPorts[link] = port
+        link.attach(self.addr, self.inbox)
         self.handleNewLink(port, endpointAddr, cost)
 
 
     def removeLink(self, port):
         """Remove link from router"""
+        link = self.links[port]
         self.links = {p:link for p,link in self.links.iteritems() if p != port}
+        del self.linkPorts[link]
+        link.detach(self.addr)
         self.handleRemoveLink(port)
 
 
+    def handleLinkChange(self, change):
+        """Apply a link change tuple as queued by changeLink"""
+        if change[0] == "add":
+            self.addLink(*change[1:])
+        elif change[0] == "remove":
+            self.removeLink(*change[1:])
+
+
     def runRouter(self):
-        """Main loop of router"""
+        """Main loop of router.  Sleeps on the inbox, which all links of the
+           router feed, and wakes on every packet arrival, link change or
+           handleTime deadline; everything pending is handled in one batch"""
+        self.scheduleTick()
         while self.keepRunning:
-            time.sleep(0.1)
-            timeMillisecs = int(round(time.time() * 1000))
+            items = [self.inbox.get()]
             try:
-                change = self.linkChanges.get_nowait()
-                if change[0] == "add":
-                    self.addLink(*change[1:])
-                elif change[0] == "remove":
-                    self.removeLink(*change[1:])
+                while True:
+                    items.append(self.inbox.get_nowait())
             except Queue.Empty:
                 pass
-            for port in self.links.keys():
-                packet = self.links[port].recv(self.addr)
-                if packet:
-                    self.handlePacket(port, packet)
-            self.handleTime(timeMillisecs)
+            for item in items:
+                self.handleInboxItem(item)
+
+
+    def scheduleTick(self):
+        """Post the next handleTime deadline to the inbox"""
+        deliveryScheduler.callAt(time.time() + self.tickTime/float(1000),
+                                 self.inbox.put, ("time",))
+
+
+    def handleInboxItem(self, item):
+        """Dispatch one inbox item: ("change", change), ("packet", link)
+           or ("time",)"""
+        if item[0] == "change":
+            self.handleLinkChange(item[1])
+        elif item[0] == "packet":
+            link = item[1]
+            packet = link.recv(self.addr)
+            # packets still arriving on a removed link are dropped
+            if packet and link in self.linkPorts:
+                self.handlePacket(self.linkPorts[link], packet)
+        elif item[0] == "time":
+            if self.keepRunning:
+                self.handleTime(int(round(time.time() * 1000)))
+                self.scheduleTick()
 
 
     def send(self, port, packet):
@@ -0,0 +1,149 @@
+import threading
+
+
+class RouteStore(object):
+    """Latest traceroute route of every (src, dst) client pair, written by
+       the client threads.  Routes are sharded per source: each shard is a
+       dict dst -> (route, isGood, timeMillisecs) with its own lock, held
+       only for the compare-and-set of the timestamp (the source client's
+       placeholders and the replies from the destinations race on the same
+       shard).  Readers take a snapshot (dict.items() copies a shard
+       atomically under the GIL) and never block writers.  reset swaps in
+       fresh shards; a write racing with it lands in either generation.
+       Next to the latest route, which may be the placeholder of a
+       traceroute still in flight, every shard keeps the completed route
+       sent last, with its send time (see snapshot).
+       Correct routes are compiled into sets of tuples, one pair at a time
+       when first needed, so checking a route is one hash lookup.  Without
+       correct routes, or with equalCost routers (ECMP forwarding may take
+       any of the equal-cost routes, correctRoutes lists only one), routes
+       not among them are checked against a GroundTruth (see
+       groundtruth.py) if there is one, by the topology at the time the
+       route was recorded"""
+
+    def __init__(self, sources=(), correctRoutes=None, groundTruth=None, equalCost=False):
+        """sources are the client addresses, correctRoutes maps (src, dst)
+           to a list of correct routes (it may be lazy, see netconfig.py).
+           groundTruth is a function returning the GroundTruth to use for
+           routes not in correctRoutes; it is only called when the first
+           such route is checked.  equalCost accepts any equal-cost route
+           even when correctRoutes has the pair"""
+        self.sources = list(sources)
+        self.correctRoutes = correctRoutes if correctRoutes is not None else {}
+        self.correct = {}      # (src, dst) -> set of correct route tuples, or None
+        self.loadGroundTruth = groundTruth
+        self.groundTruth = None
+        self.truthLock = threading.Lock()
+        self.equalCost = equalCost
+        self.expected = None
+        self.startedAt = 0     # time the run started, origin of the GroundTruth phases
+        self.shards = self.newShards()
+        self.completed = self.newShards()  # src -> {dst: (route, isGood, sentAt)}
+        self.locks = {src: threading.Lock() for src in self.sources}
+
+
+    def newShards(self):
+        """Empty shard of every known source"""
+        return {src: {} for src in self.sources}
+
+
+    def shard(self, src):
+        """(shard, completed shard, lock) of src, created on first use for
+           unknown sources"""
+        try:
+            return self.shards[src], self.completed[src], self.locks[src]
+        except KeyError:
+            return (self.shards.setdefault(src, {}), self.completed.setdefault(src, {}),
+                    self.locks.setdefault(src, threading.Lock()))
+
+
+    def truth(self):
+        """The GroundTruth, loaded once on first use (client threads race
+           on it), or None"""
+        if self.groundTruth is None and self.loadGroundTruth:
+            with self.truthLock:
+                if self.groundTruth is None:
+                    self.groundTruth = self.loadGroundTruth()
+        return self.groundTruth
+
+
+    def correctSet(self, src, dst):
+        """Compiled correct routes of (src, dst), None if there are none"""
+        try:
+            return self.correct[(src, dst)]
+        except KeyError:
+            routes = self.correctRoutes.get((src, dst))
+            correct = set(tuple(route) for route in routes) if routes else None
+            self.correct[(src, dst)] = correct
+            return correct
+
+
+    def isCorrect(self, src, dst, route, timeMillisecs=None):
+        """Whether route is a correct route from src to dst, at time
+           timeMillisecs (default: after the last link change)"""
+        correct = self.correctSet(src, dst)
+        if correct is not None and tuple(route) in correct:
+            return True
+        if self.correctRoutes and not self.equalCost:
+            return False
+        truth = self.truth()
+        if truth is None:
+            return False
+        phase = -1 if timeMillisecs is None else truth.phaseAt(timeMillisecs - self.startedAt)
+        return truth.isCorrect(src, dst, route, phase)
+
+
+    def expectedPairs(self):
+        """(src, dst) pairs that have a correct route"""
+        if self.expected is None:
+            truth = None if self.correctRoutes else self.truth()
+            self.expected = set(truth.reachablePairs() if truth else
+                                (pair for pair in self.correctRoutes if self.correctRoutes[pair]))
+        return self.expected
+
+
+    def update(self, src, dst, route, timeMillisecs, sentAt=None):
+        """Record route, recorded at timeMillisecs, unless a newer one was
+           recorded already.  A completed route sent at sentAt also
+           replaces the completed route sent before it.  Returns whether
+           the route is correct"""
+        isGood = self.isCorrect(src, dst, route, timeMillisecs)
+        shard, completed, lock = self.shard(src)
+        with lock:
+            current = shard.get(dst)
+            if current is None or timeMillisecs > current[2]:
+                shard[dst] = (route, isGood, timeMillisecs)
+            if route and sentAt is not None:
+                current = completed.get(dst)
+                if current is None or sentAt > current[2]:
+                    completed[dst] = (route, isGood, sentAt)
+        return isGood
+
+
+    def snapshot(self, sentSince=None):
+        """Consistent-per-shard copy {(src, dst): (route, isGood, time)}.
+           With sentSince, the completed routes sent at sentSince or later
+           instead, time being their send time"""
+        shards = self.shards if sentSince is None else self.completed
+        routes = {}
+        for src, shard in shards.items():
+            for dst, entry in shard.items():
+                if sentSince is None or entry[2] >= sentSince:
+                    routes[(src, dst)] = entry
+        return routes
+
+
+    def load(self, routes):
+        """Replace the contents with a {(src, dst): entry} dict, such as a
+           snapshot"""
+        shards = self.newShards()
+        for (src, dst), entry in routes.items():
+            shards.setdefault(src, {})[dst] = entry
+        self.shards = shards
+        self.completed = self.newShards()
+
+
+    def reset(self):
+        """Forget all routes"""
+        self.shards = self.newShards()
+        self.completed = self.newShards()
@@ -0,0 +1,193 @@
+import sys
+import time
+import heapq
+import argparse
+
+
+class Simulator:
+    """Discrete-event simulation engine.  Keeps a virtual clock (in ms) and a
+       priority queue of pending events, and calls the handle... methods of
+       routers and clients at exact simulated times.  No threads, no sleeps:
+       a run finishes as fast as the callbacks themselves can execute.
+       With realtime=True the same engine becomes a single-threaded event
+       loop paced to the wall clock: each event waits until its due time,
+       so a whole network runs live (e.g. under the visualizer) in one
+       thread"""
+
+    def __init__(self, tickTime=100, realtime=False):
+        """tickTime is the period (in simulated ms) at which handleTime is
+           called on every router and client, matching the tickTime of
+           Router.runRouter and Client.runClient"""
+        self.now = 0
+        self.realtime = realtime
+        self.startWallTime = None  # wall-clock time of simulated time 0
+        self.events = []       # heap of (time, seqnum, callback, args)
+        self.seqnum = 0        # tie-breaker that keeps same-time events FIFO
+        self.tickTime = tickTime
+        self.routers = {}      # routers indexed by address
+        self.clients = {}      # clients indexed by address
+        self.remote = None     # remote(link, dst, packet, due) for endpoints
+                               # simulated by another process (partition.py)
+        self.trace = None      # TraceWriter recording the run (tracelog.py)
+        self.packetsSent = 0
+        self.routingPacketsSent = 0
+        self.eventsHandled = 0
+        self.stopped = False   # set by stop to end run early
+
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) delay ms from now"""
+        self.scheduleAt(self.now + delay, callback, *args)
+
+
+    def scheduleAt(self, when, callback, *args):
+        """Call callback(*args) at simulated time when"""
+        heapq.heappush(self.events, (max(when, self.now), self.seqnum, callback, args))
+        self.seqnum += 1
+
+
+    def addRouter(self, router):
+        """Register a router and start its periodic handleTime calls"""
+        self.routers[router.addr] = router
+        if self.trace:
+            self.trace.attach(router, lambda: self.now)
+        self.schedule(self.tickTime, self.tick, router)
+
+
+    def addClient(self, client):
+        """Register a client and start its periodic handleTime calls"""
+        self.clients[client.addr] = client
+        self.schedule(self.tickTime, self.tick, client)
+
+
+    def tick(self, node):
+        """Periodic timer event of a router or client"""
+        if node.keepRunning:
+            if self.trace and node.addr in self.routers:
+                self.trace.handleTime(self.now, node.addr)
+            node.handleTime(self.now)
+            self.schedule(self.tickTime, self.tick, node)
+
+
+    def changeLink(self, node, change):
+        """Apply a link change to a router or client at the current time"""
+        self.schedule(0, node.handleLinkChange, change)
+
+
+    def transmit(self, link, packet, src):
+        """Called by Link.send: schedule delivery of packet at the far end of
+           link after the link latency"""
+        endpoint = link.endpointFrom(src)
+        if endpoint is None:
+            return
+        dst, latency = endpoint
+        packet.addToRoute(dst)
+        packet.animateSend(src, dst, latency)
+        self.packetsSent += 1
+        if packet.isRouting():
+            self.routingPacketsSent += 1
+        if self.trace:
+            self.trace.send(self.now, src, dst, latency, packet)
+        if self.remote and dst not in self.routers and dst not in self.clients:
+            self.remote(link, dst, packet, self.now + latency)
+        else:
+            self.schedule(latency, self.deliver, link, dst, packet)
+
+
+    def deliver(self, link, dst, packet):
+        """Hand a packet to the router or client at dst.  Packets arriving on
+           a link the endpoint no longer has are dropped, just like packets
+           left behind in the queue of a removed link in threaded mode"""
+        if dst in self.routers:
+            router = self.routers[dst]
+            port = router.linkPorts.get(link)
+            if port is not None:
+                if self.trace:
+                    self.trace.deliver(self.now, dst, port, packet)
+                router.handlePacket(port, packet)
+        elif dst in self.clients:
+            client = self.clients[dst]
+            if client.link is link:
+                if self.trace:
+                    self.trace.deliver(self.now, dst, -1, packet)
+                client.handlePacket(packet)
+
+
+    def run(self, untilTime, inclusive=True):
+        """Process events in time order up to and including untilTime
+           (or only those before untilTime if inclusive is False)"""
+        while self.events and not self.stopped and (
+                self.events[0][0] < untilTime or (inclusive and self.events[0][0] == untilTime)):
+            when, _, callback, args = heapq.heappop(self.events)
+            if self.realtime:
+                self.waitUntil(when)
+            self.now = when
+            callback(*args)
+            self.eventsHandled += 1
+        if self.stopped:
+            return
+        if self.realtime:
+            self.waitUntil(untilTime)
+        self.now = max(self.now, untilTime)
+
+
+    def stop(self):
+        """End the current run after the event being handled"""
+        self.stopped = True
+
+
+    def waitUntil(self, when):
+        """In realtime mode, sleep until simulated time when is due"""
+        if self.startWallTime is None:
+            self.startWallTime = time.time() - self.now/float(1000)
+        delay = self.startWallTime + when/float(1000) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def main():
+    """Run a network file headless on the simulated clock and print the
+       final routes"""
+    parser = argparse.ArgumentParser(
+        description="Run a network file headless on the simulated clock")
+    parser.add_argument("network", help="network simulation file (.json or .ndjson)")
+    parser.add_argument("algorithm", nargs="?", default=None, help="DV|LS (default: mirror Router)")
+    parser.add_argument("outputs", nargs="*",
+                        help="metrics.json|metrics.prom and/or run.trace files to write")
+    parser.add_argument("-k", "--stop-after-rounds", type=int, default=None,
+                        help="end the run once all routes were correct for this many "
+                             "traceroute rounds after the last link change")
+    parser.add_argument("-m", "--latency-multiplier", type=int, default=100,
+                        help="ms of latency per unit of link cost (default: 100)")
+    parser.add_argument("--shared-spf", action="store_true",
+                        help="link state routers share one SPF service (see spf.py)")
+    parser.add_argument("--vectorized", action="store_true",
+                        help="the shared SPF service computes the paths of every origin in "
+                             "one numpy pass (implies --shared-spf, needs numpy)")
+    args = parser.parse_args()
+    from visualize_network import Network, routerClassFromName
+    routerClass = routerClassFromName(args.algorithm)
+    tracePath = next((path for path in args.outputs if path.endswith(".trace")), None)
+    metricsPath = next((path for path in args.outputs if not path.endswith(".trace")), None)
+    startTime = time.time()
+    net = Network(args.network, routerClass, simulated=True, trace=tracePath,
+                  latencyMultiplier=args.latency_multiplier,
+                  stopAfterRounds=args.stop_after_rounds,
+                  sharedSPF=args.shared_spf or args.vectorized, vectorized=args.vectorized)
+    collector = None
+    if metricsPath:
+        from metrics import MetricsCollector
+        collector = MetricsCollector(net).attach()
+    net.run()
+    if collector:
+        collector.write(metricsPath)
+    print "Simulated {} ms in {:.3f} s ({} events, {} packets)".format(
+        net.simulator.now, time.time() - startTime,
+        net.simulator.eventsHandled, net.simulator.packetsSent)
+    if net.stoppedAt is not None:
+        print "Converged {} ms after the last change, stopped after {} correct rounds".format(
+            net.convergenceTime(), net.roundsCorrect)
+
+
+if __name__ == "__main__":
+    main()
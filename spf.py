@@ -0,0 +1,189 @@
+from array import array
+from collections import OrderedDict
+from heapq import heappush, heappop
+from LSP import LSP
+from LSrouter import COST_MAX
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+UNREACHABLE = -1
+
+
+class SPFGraph(object):
+    """Live links of one LSDB over dense node indexes (addresses in sorted
+       order, so ties break as in LSrouter.runSPF), as CSR adjacency, with
+       the first-hop tables computed so far for it"""
+
+    def __init__(self, lsps):
+        """lsps maps origin -> nbcost of every LSP in the LSDB"""
+        nodes = set(lsps)
+        for nbcost in lsps.values():
+            nodes.update(nbcost)
+        self.nodes = sorted(nodes)
+        self.index = {addr: i for i, addr in enumerate(self.nodes)}
+        self.offsets = array('i', [0])
+        self.targets = array('i')
+        self.weights = array('i')
+        for addr in self.nodes:
+            edges = sorted((self.index[nb], cost)
+                           for nb, cost in lsps.get(addr, {}).items() if cost < COST_MAX)
+            self.targets.extend(nb for nb, _ in edges)
+            self.weights.extend(cost for _, cost in edges)
+            self.offsets.append(len(self.targets))
+        self.origins = sum(1 for u in range(len(self.nodes))
+                           if self.offsets[u] != self.offsets[u + 1])
+        self.tables = {}       # source index -> (cost array, next hop array)
+        self.requests = 0      # routers that asked for this LSDB
+        self.batched = False
+
+
+    def dijkstra(self, src):
+        """(costs, next hops) from node index src, as LSrouter.calPath
+           computes them: paths ordered by cost, then hop count"""
+        size = len(self.nodes)
+        costs = array('i', [UNREACHABLE]) * size
+        hops = array('i', [UNREACHABLE]) * size
+        nexts = array('i', [UNREACHABLE]) * size
+        costs[src] = 0
+        hops[src] = 0
+        nexts[src] = src
+        heap = [(self.weights[i], 1, self.targets[i], src)
+                for i in range(self.offsets[src], self.offsets[src + 1])]
+        heap.sort()
+        while heap:
+            cost, length, node, parent = heappop(heap)
+            if costs[node] != UNREACHABLE and (costs[node], hops[node]) <= (cost, length):
+                continue
+            costs[node] = cost
+            hops[node] = length
+            nexts[node] = node if parent == src else nexts[parent]
+            for i in range(self.offsets[node], self.offsets[node + 1]):
+                nb = self.targets[i]
+                if (costs[nb] == UNREACHABLE or
+                        (costs[nb], hops[nb]) > (cost + self.weights[i], length + 1)):
+                    heappush(heap, (cost + self.weights[i], length + 1, nb, node))
+        return costs, nexts
+
+
+    def batch(self):
+        """(costs, next hops) from every origin at once: min-plus
+           Floyd-Warshall on the dense cost matrix, one vectorized row/column
+           relaxation per intermediate node.  A link weighs cost*size + 1,
+           so path lengths order by cost, then hop count (a path has fewer
+           than size hops), as in dijkstra.  Ties break as there too: the
+           parent of a node is its lowest-index predecessor on a shortest
+           path and its next hop is the parent's.  Nodes without an LSP
+           (clients) have no out-links, so they are never used as transit"""
+        size = len(self.nodes)
+        weights = numpy.full((size, size), numpy.inf)
+        for u in range(size):
+            for i in range(self.offsets[u], self.offsets[u + 1]):
+                v = self.targets[i]
+                weights[u, v] = min(weights[u, v], self.weights[i]*size + 1)
+        dist = weights.copy()
+        numpy.fill_diagonal(dist, 0)
+        for k in range(size):
+            numpy.minimum(dist, dist[:, k, None] + dist[None, k, :], out=dist)
+        tables = {}
+        for src in range(size):
+            if self.offsets[src] == self.offsets[src + 1]:
+                continue
+            row = dist[src]
+            # lowest p with row[p] + weight(p, v) == row[v], for every v
+            parents = numpy.argmax(row[:, None] + weights == row[None, :], axis=0).tolist()
+            costs = array('i', [UNREACHABLE]) * size
+            nexts = array('i', [UNREACHABLE]) * size
+            costs[src] = 0
+            nexts[src] = src
+            order = numpy.argsort(row, kind="mergesort").tolist()
+            for v in order[1:]:
+                if numpy.isinf(row[v]):
+                    break
+                parent = parents[v]
+                costs[v] = int(row[v]) // size
+                nexts[v] = v if parent == src else nexts[parent]
+            tables[src] = (costs, nexts)
+        return tables
+
+
+    def paths(self, src, batch=False):
+        """(costs, next hops) from node index src, computing the tables of
+           every origin at once if batch"""
+        if src not in self.tables:
+            if batch and not self.batched:
+                self.tables.update(self.batch())
+                self.batched = True
+            if src not in self.tables:
+                self.tables[src] = self.dijkstra(src)
+        return self.tables[src]
+
+
+class SPFService(object):
+    """Shortest path trees for all LSrouters of one in-process simulation.
+       Once flooding has converged every router holds the same LSDB, so
+       instead of each running its own Dijkstra the routers hand their LSDB
+       fingerprint (origin and checksum of every LSP) to the service, which
+       keeps one SPFGraph per distinct LSDB (built once for all of them)
+       and returns the first-hop table of the asking router, a Dijkstra
+       over the shared graph.  With vectorized (needs numpy), the tables of
+       every origin are computed in one pass once batchShare of the
+       origins asked for the same LSDB, which only pays off for the
+       converged LSDB most routers end up with.  Ties break as in
+       LSrouter.runSPF, which stays the reference.  Not thread safe: use
+       it with the simulated or event loop runtime"""
+
+    def __init__(self, maxGraphs=16, vectorized=False, batchShare=0.5):
+        """maxGraphs is how many distinct LSDBs are kept, least recently
+           used first out"""
+        if vectorized and numpy is None:
+            raise ValueError("vectorized SPF needs numpy")
+        self.maxGraphs = maxGraphs
+        self.vectorized = vectorized
+        self.batchShare = batchShare
+        self.graphs = OrderedDict()  # fingerprint -> SPFGraph
+        self.builds = 0        # graphs built
+        self.batches = 0       # vectorized all-origin passes
+        self.lookups = 0       # tables served
+        self.computed = 0      # tables computed
+
+
+    def fingerprint(self, router):
+        """Identity of router's LSDB.  The own LSP's checksum is recomputed
+           since its costs change before it is originated again"""
+        lsps = router.routersLSP
+        own = router.addr
+        return frozenset((addr, LSP.checksumOf(lsp.nbcost) if addr == own else lsp.checksum)
+                         for addr, lsp in lsps.items())
+
+
+    def graphFor(self, router):
+        """SPFGraph of router's LSDB, built on first use"""
+        key = self.fingerprint(router)
+        graph = self.graphs.pop(key, None)
+        if graph is None:
+            graph = SPFGraph({addr: lsp.nbcost for addr, lsp in router.routersLSP.items()})
+            self.builds += 1
+            while len(self.graphs) >= self.maxGraphs:
+                self.graphs.popitem(last=False)
+        self.graphs[key] = graph
+        return graph
+
+
+    def paths(self, router):
+        """(destination, cost, next hop) of every router reachable from
+           router, itself included"""
+        graph = self.graphFor(router)
+        graph.requests += 1
+        src = graph.index[router.addr]
+        known, batched = len(graph.tables), graph.batched
+        batch = self.vectorized and graph.requests >= self.batchShare*graph.origins
+        costs, nexts = graph.paths(src, batch)
+        self.lookups += 1
+        self.computed += len(graph.tables) - known
+        self.batches += graph.batched and not batched
+        nodes = graph.nodes
+        return [(nodes[dst], cost, nodes[nexts[dst]])
+                for dst, cost in enumerate(costs) if cost != UNREACHABLE]
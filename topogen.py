@@ -0,0 +1,342 @@
+import sys
+import json
+import math
+import random
+import argparse
+
+
+class Grid:
+    """rows x cols routers, each linked to its right and lower neighbor"""
+
+    def __init__(self, rows, cols=None):
+        self.rows = rows
+        self.cols = cols or rows
+
+
+    def routers(self):
+        """(address, (x, y)) of every router"""
+        for x in range(self.cols):
+            for y in range(self.rows):
+                yield "R{}_{}".format(x, y), (x, y)
+
+
+    def links(self, rng):
+        """(addr1, addr2) of every router to router link"""
+        for x in range(self.cols):
+            for y in range(self.rows):
+                if x + 1 < self.cols:
+                    yield "R{}_{}".format(x, y), "R{}_{}".format(x+1, y)
+                if y + 1 < self.rows:
+                    yield "R{}_{}".format(x, y), "R{}_{}".format(x, y+1)
+
+
+class FatTree:
+    """k-ary fat-tree: (k/2)^2 core routers and k pods of k/2 aggregation
+       and k/2 edge routers.  Clients attach to the edge routers"""
+
+    def __init__(self, k):
+        self.k = k - k % 2
+        self.half = self.k // 2
+
+
+    def routers(self):
+        """(address, (x, y)) of every router: core, aggregation, edge rows"""
+        width = float(self.k*self.half)
+        for i in range(self.half*self.half):
+            yield "C{}".format(i), ((i + 0.5)*width/(self.half*self.half), 0)
+        for pod in range(self.k):
+            for i in range(self.half):
+                yield "A{}_{}".format(pod, i), (pod*self.half + i + 0.5, 1)
+        for pod in range(self.k):
+            for i in range(self.half):
+                yield "E{}_{}".format(pod, i), (pod*self.half + i + 0.5, 2)
+
+
+    def links(self, rng):
+        """Every aggregation router links to all edge routers of its pod and
+           to its group of k/2 core routers"""
+        for pod in range(self.k):
+            for i in range(self.half):
+                for j in range(self.half):
+                    yield "A{}_{}".format(pod, i), "C{}".format(i*self.half + j)
+                for j in range(self.half):
+                    yield "A{}_{}".format(pod, i), "E{}_{}".format(pod, j)
+
+
+    def edgeRouters(self):
+        """Routers clients attach to"""
+        return ["E{}_{}".format(pod, i) for pod in range(self.k) for i in range(self.half)]
+
+
+class Waxman:
+    """n routers placed uniformly at random in a side x side square; u and v
+       are linked with probability beta*exp(-d(u,v)/(alpha*L)), L being the
+       diagonal.  Only pairs closer than the distance at which that drops
+       below epsilon are tried (found through a grid of cells), and the
+       components are joined at the end so the network is connected"""
+
+    def __init__(self, n, alpha=0.1, beta=0.4, epsilon=1e-3, seed=0):
+        self.n = n
+        self.alpha = alpha
+        self.beta = beta
+        self.side = max(1.0, math.sqrt(n))
+        rng = random.Random(seed)
+        self.positions = [(rng.uniform(0, self.side), rng.uniform(0, self.side))
+                          for _ in range(n)]
+        scale = alpha*self.side*math.sqrt(2)
+        self.scale = scale
+        self.cutoff = scale*math.log(beta/epsilon) if beta > epsilon else 0
+
+
+    def routers(self):
+        """(address, (x, y)) of every router"""
+        for i, pos in enumerate(self.positions):
+            yield "R{}".format(i), pos
+
+
+    def links(self, rng):
+        """Random links, then one link between consecutive components"""
+        parent = range(self.n)
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        cellSize = max(self.cutoff, 1e-9)
+        cells = {}
+        for i, (x, y) in enumerate(self.positions):
+            cells.setdefault((int(x/cellSize), int(y/cellSize)), []).append(i)
+        for i, (x, y) in enumerate(self.positions):
+            cx, cy = int(x/cellSize), int(y/cellSize)
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for j in cells.get((cx+dx, cy+dy), ()):
+                        if j <= i:
+                            continue
+                        d = math.hypot(x - self.positions[j][0], y - self.positions[j][1])
+                        if d <= self.cutoff and rng.random() < self.beta*math.exp(-d/self.scale):
+                            parent[find(i)] = find(j)
+                            yield "R{}".format(i), "R{}".format(j)
+        roots = sorted(set(find(i) for i in range(self.n)))
+        for a, b in zip(roots, roots[1:]):
+            yield "R{}".format(a), "R{}".format(b)
+
+
+class ScaleFree:
+    """Barabasi-Albert graph: n routers, each new router linked to m
+       existing ones chosen with probability proportional to their degree"""
+
+    def __init__(self, n, m=2, seed=0):
+        self.n = n
+        self.m = max(1, min(m, n - 1))
+        rng = random.Random(seed)
+        self.positions = [(rng.uniform(0, math.sqrt(n)), rng.uniform(0, math.sqrt(n)))
+                          for _ in range(n)]
+
+
+    def routers(self):
+        """(address, (x, y)) of every router"""
+        for i, pos in enumerate(self.positions):
+            yield "R{}".format(i), pos
+
+
+    def links(self, rng):
+        """Grow from a clique of m + 1 routers"""
+        ends = []              # every link endpoint, so degree-weighted
+        for i in range(self.m + 1):
+            for j in range(i):
+                ends.extend((i, j))
+                yield "R{}".format(j), "R{}".format(i)
+        for i in range(self.m + 1, self.n):
+            targets = set()
+            while len(targets) < self.m:
+                targets.add(rng.choice(ends))
+            for j in sorted(targets):
+                ends.extend((i, j))
+                yield "R{}".format(j), "R{}".format(i)
+
+
+class RingOfRings:
+    """rings rings of ringSize routers each; router 0 of every ring is also
+       on a core ring joining the rings"""
+
+    def __init__(self, rings, ringSize):
+        self.rings = rings
+        self.ringSize = ringSize
+
+
+    def routers(self):
+        """(address, (x, y)) of every router, each ring on its own circle"""
+        radius = self.rings*self.ringSize/(2*math.pi) + 1
+        small = self.ringSize/(2*math.pi) + 0.5
+        for r in range(self.rings):
+            angle = 2*math.pi*r/self.rings
+            cx, cy = radius + radius*math.cos(angle), radius + radius*math.sin(angle)
+            for i in range(self.ringSize):
+                a = angle + math.pi + 2*math.pi*i/self.ringSize
+                yield "R{}_{}".format(r, i), (cx + small*math.cos(a), cy + small*math.sin(a))
+
+
+    def links(self, rng):
+        """Links around every ring and around the core ring"""
+        for r in range(self.rings):
+            if self.ringSize > 1:
+                for i in range(self.ringSize if self.ringSize > 2 else 1):
+                    yield "R{}_{}".format(r, i), "R{}_{}".format(r, (i + 1) % self.ringSize)
+        if self.rings > 1:
+            for r in range(self.rings if self.rings > 2 else 1):
+                yield "R{}_0".format(r), "R{}_0".format((r + 1) % self.rings)
+
+
+FAMILIES = {
+    "grid": lambda args: Grid(args.size, args.cols),
+    "fattree": lambda args: FatTree(args.size),
+    "waxman": lambda args: Waxman(args.size, args.alpha, args.beta, seed=args.seed),
+    "scalefree": lambda args: ScaleFree(args.size, args.degree, seed=args.seed),
+    "ringofrings": lambda args: RingOfRings(args.size, args.ring_size),
+}
+
+
+class JsonListWriter:
+    """Writes the items of a JSON list one at a time"""
+
+    def __init__(self, f, key, first=False):
+        self.f = f
+        self.count = 0
+        f.write('{}"{}":['.format("" if first else ",\n", key))
+
+
+    def add(self, item):
+        """Write the next item"""
+        self.f.write((",\n" if self.count else "\n") + json.dumps(item, separators=(",", ":")))
+        self.count += 1
+
+
+    def close(self):
+        """End the list"""
+        self.f.write("]")
+
+
+def writeNetwork(f, family, numClients=8, minCost=1, maxCost=5, failures=0,
+                 failureStart=None, failureEnd=None, recovery=None, endTime=200,
+                 clientSendRate=5, visualize=False, seed=0):
+    """Write the network config of a topology family to f without ever
+       holding its links in memory: routers and links are written as the
+       family generates them.  numClients clients are attached to routers
+       spread over the network.  failures links picked uniformly (by
+       reservoir sampling while streaming) go down at random times between
+       failureStart and failureEnd and, if recovery is given, come back up
+       recovery time units later.  Returns (routers, clients, links)"""
+    rng = random.Random(seed)
+    failureRng = random.Random(seed + 1)  # keeps the topology independent of failures
+    locations = {}
+    f.write("{")
+    routers = []
+    writer = JsonListWriter(f, "routers", first=True)
+    for addr, pos in family.routers():
+        writer.add(addr)
+        routers.append(addr)
+        if visualize:
+            locations[addr] = pos
+    writer.close()
+
+    candidates = family.edgeRouters() if hasattr(family, "edgeRouters") else routers
+    numClients = min(numClients, len(candidates))
+    attach = [candidates[i*len(candidates)//numClients] for i in range(numClients)]
+    clients = ["c{}".format(i) for i in range(numClients)]
+    writer = JsonListWriter(f, "clients")
+    for client in clients:
+        writer.add(client)
+    writer.close()
+    f.write(',\n"clientSendRate":{},\n"endTime":{}'.format(clientSendRate, endTime))
+
+    ports = {}
+    def nextPort(addr):
+        ports[addr] = ports.get(addr, 0) + 1
+        return ports[addr]
+    sample = []
+    writer = JsonListWriter(f, "links")
+    for addr1, addr2 in family.links(rng):
+        cost = rng.randint(minCost, maxCost)
+        link = [addr1, addr2, nextPort(addr1), nextPort(addr2), cost, cost]
+        writer.add(link)
+        if len(sample) < failures:
+            sample.append(link)
+        elif failures:
+            i = failureRng.randint(0, writer.count - 1)
+            if i < failures:
+                sample[i] = link
+    for client, router in zip(clients, attach):
+        writer.add([client, router, 1, nextPort(router), 1, 1])
+        if visualize:
+            x, y = locations[router]
+            locations[client] = (x + 0.3, y + 0.3)
+    numLinks = writer.count
+    writer.close()
+
+    failureStart = endTime//4 if failureStart is None else failureStart
+    failureEnd = endTime//2 if failureEnd is None else failureEnd
+    changes = []
+    for link in sample:
+        down = failureRng.randint(failureStart, failureEnd)
+        changes.append([down, link[:2], "down"])
+        if recovery:
+            changes.append([down + recovery, link, "up"])
+    writer = JsonListWriter(f, "changes")
+    for change in sorted(changes):
+        writer.add(change)
+    writer.close()
+
+    if visualize:
+        gridSize = int(max(max(x, y) for x, y in locations.values())) + 2
+        f.write(',\n"visualize":')
+        json.dump({"gridSize": gridSize, "locations": locations, "canvasWidth": 800,
+                   "canvasHeight": 800, "timeMultiplier": 20, "latencyCorrection": 1.5,
+                   "animateRate": 40, "routerColor": "red", "clientColor": "DodgerBlue2",
+                   "lineColor": "orange", "inactiveColor": "gray", "lineWidth": 2,
+                   "lineFontSize": 8}, f)
+    f.write("}\n")
+    return len(routers), len(clients), numLinks
+
+
+def main():
+    """Parse the command line and write the network config"""
+    parser = argparse.ArgumentParser(
+        description="Generate a network config for a synthetic topology")
+    parser.add_argument("family", choices=sorted(FAMILIES))
+    parser.add_argument("size", type=int,
+                        help="grid rows, fat-tree k, routers (waxman, scalefree) or rings")
+    parser.add_argument("-o", "--out", default="-", help="output file (default: stdout)")
+    parser.add_argument("--cols", type=int, default=None, help="grid columns (default: size)")
+    parser.add_argument("--ring-size", type=int, default=8, help="routers per ring")
+    parser.add_argument("--alpha", type=float, default=0.1, help="Waxman alpha")
+    parser.add_argument("--beta", type=float, default=0.4, help="Waxman beta")
+    parser.add_argument("--degree", type=int, default=2, help="scale-free links per new router")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--min-cost", type=int, default=1)
+    parser.add_argument("--max-cost", type=int, default=5)
+    parser.add_argument("--end-time", type=int, default=200)
+    parser.add_argument("--client-send-rate", type=int, default=5)
+    parser.add_argument("--failures", type=int, default=0, help="links to fail")
+    parser.add_argument("--failure-start", type=int, default=None)
+    parser.add_argument("--failure-end", type=int, default=None)
+    parser.add_argument("--recovery", type=int, default=None,
+                        help="time after which failed links come back up")
+    parser.add_argument("--visualize", action="store_true", help="add visualize locations")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    family = FAMILIES[args.family](args)
+    out = sys.stdout if args.out == "-" else open(args.out, "w")
+    try:
+        counts = writeNetwork(out, family, args.clients, args.min_cost, args.max_cost,
+                              args.failures, args.failure_start, args.failure_end,
+                              args.recovery, args.end_time, args.client_send_rate,
+                              args.visualize, args.seed)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    sys.stderr.write("{} routers, {} clients, {} links\n".format(*counts))
+
+
+if __name__ == "__main__":
+    main()
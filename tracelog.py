@@ -0,0 +1,391 @@
+import sys
+import json
+import mmap
+import time
+import struct
+import argparse
+from collections import deque
+from packet import Packet
+
+MAGIC = "RTTRACE1"
+
+# record types
+META = 0          # JSON settings of the run
+ADDRESS = 1       # node id -> role and address
+SEND = 2          # node sent a packet: dst, latency, packet
+DELIVER = 3       # handlePacket of node: port (-1 for clients), packet
+TIME = 4          # handleTime of a router
+NEW_LINK = 5      # handleNewLink of a router: port, endpoint, cost
+REMOVE_LINK = 6   # handleRemoveLink of a router: port
+LINK_CHANGE = 7   # link change of the network: up, addr1, addr2, c12, c21
+
+NAMES = {META: "meta", ADDRESS: "address", SEND: "send", DELIVER: "deliver", TIME: "time",
+         NEW_LINK: "newlink", REMOVE_LINK: "removelink", LINK_CHANGE: "linkchange"}
+
+RECORD = struct.Struct("<BqiI")      # type, simulated time, node id, payload length
+PACKET = struct.Struct("<BiiIH")     # kind, src id, dst id, content length, route length
+SEND_HEAD = struct.Struct("<ii")     # dst id, latency
+PORT = struct.Struct("<i")
+NEW_LINK_BODY = struct.Struct("<iii")         # port, endpoint id, cost
+LINK_CHANGE_BODY = struct.Struct("<Biiii")    # up, addr1 id, addr2 id, c12, c21
+
+
+class TraceWriter(object):
+    """Append-only binary trace of a simulated run: every packet sent and
+       delivered, every handle... call of the routers and every link
+       change, stamped with simulated time.  Each record is a fixed
+       header (type, time, node id, payload length) followed by its
+       payload; addresses are written once as ADDRESS records and then
+       referred to by id.  Routes are kept for traceroute packets only.
+       The Simulator calls the record methods (see simulator.py)"""
+
+    def __init__(self, filepath, meta, routers=(), clients=()):
+        """meta is a JSON-able dict of run settings (router class,
+           heartbeat time...).  Routers and clients are given ids first,
+           in order, so a replay interns the addresses in the same order"""
+        self.f = open(filepath, "wb")
+        self.f.write(MAGIC)
+        self.ids = {}
+        self.records = 0
+        self.write(META, 0, -1, json.dumps(meta))
+        for addr in routers:
+            self.addressId(addr, "r")
+        for addr in clients:
+            self.addressId(addr, "c")
+
+
+    def write(self, kind, now, node, payload=""):
+        """Append one record"""
+        self.f.write(RECORD.pack(kind, now, node, len(payload)))
+        self.f.write(payload)
+        self.records += 1
+
+
+    def addressId(self, addr, role="?"):
+        """Id of addr, written as an ADDRESS record when first seen"""
+        addrId = self.ids.get(addr)
+        if addrId is None:
+            addrId = self.ids[addr] = len(self.ids)
+            self.write(ADDRESS, 0, addrId, role + addr.encode("utf-8"))
+        return addrId
+
+
+    def packet(self, packet):
+        """Payload bytes of packet"""
+        content = packet.content or ""
+        route = [self.addressId(addr) for addr in packet.getRoute()] if packet.isTraceroute() else []
+        return (PACKET.pack(packet.kind, self.addressId(packet.srcAddr),
+                            self.addressId(packet.dstAddr), len(content), len(route)) +
+                content + struct.pack("<{}i".format(len(route)), *route))
+
+
+    def send(self, now, src, dst, latency, packet):
+        """packet left src towards dst"""
+        self.write(SEND, now, self.addressId(src),
+                   SEND_HEAD.pack(self.addressId(dst), latency) + self.packet(packet))
+
+
+    def deliver(self, now, dst, port, packet):
+        """packet is handed to dst (port is -1 for clients)"""
+        self.write(DELIVER, now, self.addressId(dst), PORT.pack(port) + self.packet(packet))
+
+
+    def handleTime(self, now, addr):
+        """handleTime of router addr"""
+        self.write(TIME, now, self.addressId(addr))
+
+
+    def linkChange(self, now, change, target):
+        """Link change of the network, as in the config changes"""
+        if change == "up":
+            addr1, addr2, _, _, c12, c21 = target
+        else:
+            (addr1, addr2), c12, c21 = target, 0, 0
+        self.write(LINK_CHANGE, now, -1, LINK_CHANGE_BODY.pack(
+            change == "up", self.addressId(addr1), self.addressId(addr2), c12, c21))
+
+
+    def attach(self, router, clock):
+        """Record the handleNewLink and handleRemoveLink calls of router;
+           clock returns the current simulated time"""
+        handleNewLink, handleRemoveLink = router.handleNewLink, router.handleRemoveLink
+        def newLink(port, endpoint, cost):
+            self.write(NEW_LINK, clock(), self.addressId(router.addr),
+                       NEW_LINK_BODY.pack(port, self.addressId(endpoint), cost))
+            return handleNewLink(port, endpoint, cost)
+        def removeLink(port):
+            self.write(REMOVE_LINK, clock(), self.addressId(router.addr), PORT.pack(port))
+            return handleRemoveLink(port)
+        router.handleNewLink = newLink
+        router.handleRemoveLink = removeLink
+
+
+    def close(self):
+        """Flush and close the trace"""
+        if not self.f.closed:
+            self.f.close()
+
+
+class TraceReader(object):
+    """Memory-mapped reader of a trace written by TraceWriter.  The META
+       and leading ADDRESS records are read on open; records() decodes the
+       rest lazily, in the order they were written"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = open(filepath, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a trace file".format(filepath))
+        self.addresses = []    # id -> address
+        self.roles = {}        # address -> "r" (router), "c" (client) or "?"
+        self.meta = {}
+        self.start = len(MAGIC)
+        for kind, now, node, offset, length in self.headers(self.start):
+            if kind == META:
+                self.meta = json.loads(self.data[offset:offset + length])
+            elif kind == ADDRESS:
+                self.address(node, offset, length)
+            else:
+                break
+            self.start = offset + length
+
+
+    def headers(self, offset):
+        """(type, time, node id, payload offset, payload length) of the
+           records from offset on, without decoding them"""
+        data, size = self.data, len(self.data)
+        while offset + RECORD.size <= size:
+            kind, now, node, length = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            yield kind, now, node, offset, length
+            offset += length
+
+
+    def address(self, node, offset, length):
+        """Learn an ADDRESS record"""
+        addr = self.data[offset + 1:offset + length].decode("utf-8")
+        if node == len(self.addresses):
+            self.addresses.append(addr)
+        self.roles[addr] = self.data[offset]
+
+
+    def routers(self):
+        """Router addresses, in id order"""
+        return [addr for addr in self.addresses if self.roles[addr] == "r"]
+
+
+    def packet(self, offset):
+        """Packet decoded from the payload at offset"""
+        kind, src, dst, contentLength, routeLength = PACKET.unpack_from(self.data, offset)
+        offset += PACKET.size
+        content = self.data[offset:offset + contentLength] or None
+        packet = Packet(kind, self.addresses[src], self.addresses[dst], content)
+        if routeLength:
+            route = struct.unpack_from("<{}i".format(routeLength), self.data, offset + contentLength)
+            cell = None
+            for addrId in route:
+                cell = (self.addresses[addrId], cell)
+            packet.routeTail = cell
+        return packet
+
+
+    def records(self, kinds=None):
+        """(type, time, node address, args) of every record, or of those
+           whose type is in kinds (the others are skipped undecoded):
+             SEND         (dst, latency, packet)
+             DELIVER      (port, packet)
+             TIME         ()
+             NEW_LINK     (port, endpoint, cost)
+             REMOVE_LINK  (port,)
+             LINK_CHANGE  ("up"|"down", addr1, addr2, c12, c21), node None"""
+        data, addresses = self.data, self.addresses
+        offset, size = self.start, len(data)
+        while offset + RECORD.size <= size:
+            kind, now, node, length = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            body, offset = offset, offset + length
+            if kind == ADDRESS:
+                self.address(node, body, length)
+                continue
+            if kinds is not None and kind not in kinds:
+                continue
+            addr = addresses[node] if node >= 0 else None
+            if kind == SEND:
+                dst, latency = SEND_HEAD.unpack_from(data, body)
+                args = (addresses[dst], latency, self.packet(body + SEND_HEAD.size))
+            elif kind == DELIVER:
+                args = (PORT.unpack_from(data, body)[0], self.packet(body + PORT.size))
+            elif kind == TIME:
+                args = ()
+            elif kind == NEW_LINK:
+                port, endpoint, cost = NEW_LINK_BODY.unpack_from(data, body)
+                args = (port, addresses[endpoint], cost)
+            elif kind == REMOVE_LINK:
+                args = PORT.unpack_from(data, body)
+            elif kind == LINK_CHANGE:
+                up, addr1, addr2, c12, c21 = LINK_CHANGE_BODY.unpack_from(data, body)
+                args = ("up" if up else "down", addresses[addr1], addresses[addr2], c12, c21)
+            else:
+                continue
+            yield kind, now, addr, args
+
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+class ReplayDivergence(Exception):
+    """A replayed router did not send what the recorded one sent"""
+
+
+class Replay(object):
+    """Drive fresh routers with the recorded inputs of a trace: every
+       handleTime, handlePacket, handleNewLink and handleRemoveLink call is
+       repeated with the recorded arguments, in the recorded order, with
+       no threads, links or clock.  With verify=True the packets every
+       router sends are checked against the recorded sends, and the first
+       difference raises ReplayDivergence; with verify=False the sends are
+       only counted, which replays a captured workload at maximum speed"""
+
+    def __init__(self, tracePath, routerClass=None, verify=True):
+        """routerClass defaults to the class the trace was recorded with"""
+        from codec import resetAddresses
+        self.reader = TraceReader(tracePath)
+        self.verify = verify
+        meta = self.reader.meta
+        # address IDs (used by the binary codec) must match the recording
+        resetAddresses(self.reader.addresses)
+        if routerClass is None:
+            routerClass = routerClassFromName(meta.get("routerClass"))
+        self.routers = {}
+        self.ports = {}        # router -> {port: endpoint}
+        self.sent = {}         # router -> deque of sends not matched yet
+        for addr in self.reader.routers():
+            self.ports[addr] = {}
+            self.sent[addr] = deque()
+            router = routerClass(addr, heartbeatTime=meta.get("heartbeatTime"))
+            router.send = self.sender(addr)
+            self.routers[addr] = router
+        self.handlerCalls = 0
+        self.packetsSent = 0
+        self.seconds = 0.0
+
+
+    def sender(self, addr):
+        """Replacement for the send method of router addr"""
+        ports, sent = self.ports[addr], self.sent
+        def send(port, packet):
+            if port not in ports:
+                return
+            self.packetsSent += 1
+            if self.verify:
+                sent[addr].append((ports[port], packet.kind, packet.srcAddr,
+                                   packet.dstAddr, packet.content))
+        return send
+
+
+    def run(self):
+        """Replay the whole trace"""
+        kinds = (SEND, DELIVER, TIME, NEW_LINK, REMOVE_LINK) if self.verify else \
+                (DELIVER, TIME, NEW_LINK, REMOVE_LINK)
+        startTime = time.time()
+        for kind, now, addr, args in self.reader.records(kinds):
+            router = self.routers.get(addr)
+            if router is None:
+                continue
+            if kind == SEND:
+                self.match(addr, now, args)
+                continue
+            if self.verify and self.sent[addr]:
+                self.diverged(addr, now, "sent unrecorded packet {}".format(self.sent[addr][0]))
+            self.handlerCalls += 1
+            if kind == TIME:
+                router.handleTime(now)
+            elif kind == DELIVER:
+                router.handlePacket(*args)
+            elif kind == NEW_LINK:
+                port, endpoint, cost = args
+                self.ports[addr][port] = endpoint
+                router.handleNewLink(port, endpoint, cost)
+            elif kind == REMOVE_LINK:
+                self.ports[addr].pop(args[0], None)
+                router.handleRemoveLink(args[0])
+        if self.verify:
+            for addr, sent in self.sent.items():
+                if sent:
+                    self.diverged(addr, None, "sent unrecorded packet {}".format(sent[0]))
+        self.seconds = time.time() - startTime
+
+
+    def match(self, addr, now, args):
+        """Check a recorded send of addr against the replayed ones"""
+        dst, _, packet = args
+        recorded = (dst, packet.kind, packet.srcAddr, packet.dstAddr, packet.content)
+        if not self.sent[addr]:
+            self.diverged(addr, now, "did not send {}".format(recorded))
+        replayed = self.sent[addr].popleft()
+        if replayed != recorded:
+            self.diverged(addr, now, "sent {} instead of {}".format(replayed, recorded))
+
+
+    def diverged(self, addr, now, message):
+        raise ReplayDivergence("{} at {} ms: {}".format(addr, now, message))
+
+
+def routerClassFromName(name):
+    """Router class recorded in a trace's META record"""
+    from router import Router
+    from DVrouter import DVrouter
+    from LSrouter import LSrouter
+    return {"DVrouter": DVrouter, "LSrouter": LSrouter}.get(name, Router)
+
+
+def dump(tracePath, limit=None):
+    """Print the records of a trace, one per line"""
+    reader = TraceReader(tracePath)
+    print json.dumps(reader.meta)
+    for i, (kind, now, addr, args) in enumerate(reader.records()):
+        if limit is not None and i >= limit:
+            break
+        if kind in (SEND, DELIVER):
+            packet = args[-1]
+            args = args[:-1] + ("traceroute" if packet.isTraceroute() else "routing",
+                                packet.srcAddr, packet.dstAddr, len(packet.content or ""))
+        print "{:>10} {:<10} {:<6} {}".format(now, NAMES[kind], addr, " ".join(str(a) for a in args))
+
+
+def main():
+    """Dump or replay a trace"""
+    parser = argparse.ArgumentParser(description="Inspect or replay a simulation trace")
+    parser.add_argument("command", choices=["dump", "replay"])
+    parser.add_argument("trace", help="trace file written by simulator.py")
+    parser.add_argument("-n", "--limit", type=int, default=None,
+                        help="dump: only the first records")
+    parser.add_argument("-a", "--algorithm", default=None,
+                        help="replay: router class DV|LS (default: the recorded one)")
+    parser.add_argument("--fast", action="store_true",
+                        help="replay: do not check the sent packets against the trace")
+    args = parser.parse_args()
+    if args.command == "dump":
+        dump(args.trace, args.limit)
+        return 0
+    routerClass = None
+    if args.algorithm:
+        from visualize_network import routerClassFromName as fromName
+        routerClass = fromName(args.algorithm)
+    replay = Replay(args.trace, routerClass, verify=not args.fast)
+    try:
+        replay.run()
+    except ReplayDivergence as e:
+        print "Diverged: {}".format(e)
+        return 1
+    print "Replayed {} handler calls ({} packets sent) of {} routers in {:.3f} s{}".format(
+        replay.handlerCalls, replay.packetsSent, len(replay.routers), replay.seconds,
+        "" if args.fast else ", identical to the recording")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
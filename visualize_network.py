@@ -1,59 +1,118 @@
 import sys
 import tkFont
-import json
 import thread
 import time
 import threading
 import pickle
 import signal
 import os.path
-import Queue
+from collections import deque
 from Tkinter import *
-from collections import defaultdict
 from client import Client
 from router import Router
 from packet import Packet
 from link import Link
 from DVrouter import DVrouter
 from LSrouter import LSrouter
+from simulator import Simulator
+from codec import resetAddresses
+from routes import RouteStore
+from spf import SPFService
+from tracelog import TraceReader
+from analytics import TraceAnalysis, TracePlayback, groundTruthFor
+from netconfig import loadConfig
 
 # DVRouter and LSRouter imports placed in main and conditioned by DV|LS
 
 class Network:
     """Network class maintains all clients, routers, links, and confguration"""
 
-    def __init__(self, netJsonFilepath, routerClass, visualize=False):
+    def __init__(self, netJsonFilepath, routerClass, visualize=False, simulated=False,
+                 realtime=False, localNodes=None, sharedSPF=False, vectorized=False,
+                 trace=None, latencyMultiplier=100, stopAfterRounds=None):
         """Create a new network from the parameters in the file at
            netJsonFilepath.  routerClass determines whether to use DVrouter,
-           LSrouter, or the default Router"""
-
-        # parse configuration details
-        netJsonFile = open(netJsonFilepath, 'r')
-        netJson = json.load(netJsonFile)
-        self.latencyMultiplier = 100
-        self.endTime = netJson["endTime"] * self.latencyMultiplier
+           LSrouter, or the default Router.  If simulated is True the network
+           runs on the virtual clock of a discrete-event Simulator instead
+           of threads and wall-clock sleeps.  If realtime is True it runs on
+           the same Simulator paced to the wall clock: a single-threaded
+           event loop in place of one thread per router and client.
+           If localNodes is given, only the routers and clients in it are
+           created (see partition.py).  If sharedSPF is True, link state
+           routers compute their shortest paths through one SPFService
+           (see spf.py) instead of each on its own; this needs the
+           simulated or event loop runtime.  vectorized lets that service
+           compute the paths of every origin of a shared LSDB in one numpy
+           pass (needs sharedSPF and numpy).  trace is the path of a
+           binary trace to record the run in (see tracelog.py), also only
+           on the simulator.  latencyMultiplier is the ms of link latency
+           per unit of link cost; times in the config, the heartbeat and
+           the handleTime period scale with it, so a smaller one runs the
+           same scenario faster.  If stopAfterRounds is given, a headless
+           run ends as soon as every pair's traceroutes were correct for
+           that many consecutive rounds after the last link change"""
+
+        # parse configuration details (.ndjson configs are streamed, see
+        # netconfig.py)
+        self.config = loadConfig(netJsonFilepath)
+        self.latencyMultiplier = latencyMultiplier
+        self.tickTime = latencyMultiplier  # ms between handleTime calls
+        self.endTime = self.config.endTime * self.latencyMultiplier
         self.visualize = visualize
         if visualize:
-            self.latencyMultiplier *= netJson["visualize"]["timeMultiplier"]
-        self.clientSendRate = netJson["clientSendRate"]*self.latencyMultiplier
+            self.latencyMultiplier *= self.config.visualize["timeMultiplier"]
+        self.clientSendRate = self.config.clientSendRate*self.latencyMultiplier
+        self.simulator = Simulator(self.tickTime, realtime) if (simulated or realtime) else None
+        self.netJsonFilepath = netJsonFilepath
+        self.routerClass = routerClass
+        self.localNodes = localNodes
+        if sharedSPF and self.simulator is None:
+            raise ValueError("sharedSPF needs the simulated or event loop runtime")
+        if vectorized and not sharedSPF:
+            raise ValueError("vectorized needs sharedSPF")
+        self.spf = SPFService(vectorized=vectorized) if sharedSPF else None
+        if trace and self.simulator is None:
+            raise ValueError("trace needs the simulated or event loop runtime")
+
+        # intern all addresses in file order, so that address IDs (used by
+        # the binary codec) are the same in every process, and only this
+        # network's addresses are in the table
+        resetAddresses(self.config.routers + self.config.clients)
 
         # parse and create routers, clients, and links
-        self.routers = self.parseRouters(netJson["routers"], routerClass)
-        self.clients = self.parseClients(netJson["clients"], self.clientSendRate)
-        self.links = self.parseLinks(netJson["links"])
-
-        # parse link changes
-        if "changes" in netJson:
-            self.changes = self.parseChanges(netJson["changes"])
-        else:
-            self.changes = None
-
-        # parse correct routes and create some tracking fields
-        self.correctRoutes = self.parseCorrectRoutes(netJson["correctRoutes"])
+        self.routers = self.parseRouters(self.config.routers, routerClass)
+        self.clients = self.parseClients(self.config.clients, self.clientSendRate)
+        self.links = self.parseLinks(self.config.links())
+
+        if trace:
+            from tracelog import TraceWriter
+            routerName = getattr(routerClass, "func", routerClass).__name__
+            meta = {"network": netJsonFilepath, "routerClass": routerName,
+                    "heartbeatTime": self.latencyMultiplier*10,
+                    "latencyMultiplier": self.latencyMultiplier}
+            self.simulator.trace = TraceWriter(trace, meta, self.config.routers, self.config.clients)
+
+        # link changes, pulled in time order as they are applied
+        self.changes = self.config.changeQueue()
+
+        # correct routes (computed from the links when the config has none)
+        # and some tracking fields
+        self.correctRoutes = self.config.correctRoutes()
         self.threads = []
-        self.routes = {}
-        self.routesLock = threading.Lock()
-        netJsonFile.close()
+        self.routeStore = RouteStore(self.config.clients, self.correctRoutes, self.loadGroundTruth,
+                                     any(getattr(router, "ecmp", False) for router in self.routers.values()))
+        self.trackLock = threading.Lock()  # guards the convergence and round tracking
+        self.routesSeen = set()       # expected pairs correct since the latest change
+        self.routesIncorrect = set()  # pairs whose last traceroute was incorrect
+        self.convergedAt = None  # time since which every traceroute was correct
+        self.startedAt = 0       # currentTime() at the start of the run
+        self.changedAt = 0       # currentTime() of the latest link change
+        self.lastChangeAt = self.config.lastChangeTime()*self.latencyMultiplier
+        self.stopAfterRounds = stopAfterRounds
+        self.roundPairs = set()  # pairs correct in the current round
+        self.roundsCorrect = 0   # consecutive all-correct rounds so far
+        self.stoppedAt = None    # run time at which the run ended early
+        self.stopEvent = threading.Event()
 
 
     def parseRouters(self, routerParams, routerClass):
@@ -61,7 +120,14 @@ class Network:
         routers = {}
         for addr in routerParams:
             #print "Router {}".format(addr)
-            routers[addr] = routerClass(addr, heartbeatTime=self.latencyMultiplier*10)
+            if self.localNodes is not None and addr not in self.localNodes:
+                continue
+            if self.spf is not None and issubclass(getattr(routerClass, "func", routerClass), LSrouter):
+                routers[addr] = routerClass(addr, heartbeatTime=self.latencyMultiplier*10,
+                                            spf=self.spf)
+            else:
+                routers[addr] = routerClass(addr, heartbeatTime=self.latencyMultiplier*10)
+            routers[addr].tickTime = self.tickTime
         return routers
 
 
@@ -70,7 +136,10 @@ class Network:
         clients = {}
         for addr in clientParams:
             #print "Client {}".format(addr)
+            if self.localNodes is not None and addr not in self.localNodes:
+                continue
             clients[addr] = Client(addr, clientParams, clientSendRate, self.updateRoute)
+            clients[addr].tickTime = self.tickTime
         return clients
 
 
@@ -80,32 +149,37 @@ class Network:
         for addr1, addr2, p1, p2, c12, c21 in linkParams:
             #print "{}:{} --cost:{}--> {}:{} --cost:{}--> {}:{}".format(
                    #addr1, p1, c12, addr2, p2, c21, addr1, p1)
-            link = Link(addr1, addr2, c12, c21, self.latencyMultiplier)
+            link = self.makeLink(addr1, addr2, c12, c21)
             links[(addr1,addr2)] = (p1, p2, c12, c21, link)
         return links
 
 
-    def parseChanges(self, changesParams):
-        """Parse link changes from changesParams dict"""
-        changes = Queue.PriorityQueue()
-        for change in changesParams:
-            #print change
-            changes.put(change)
-        return changes
+    def makeLink(self, addr1, addr2, c12, c21):
+        """Create a link, attached to the simulator in simulated mode"""
+        return Link(addr1, addr2, c12, c21, self.latencyMultiplier, scheduler=self.simulator)
 
 
-    def parseCorrectRoutes(self, routesParams):
-        """parse correct routes, from routesParams dict"""
-        correctRoutes = defaultdict(list)
-        for route in routesParams:
-            src, dst = route[0], route[-1]
-            correctRoutes[(src,dst)].append(route)
-        return correctRoutes
+    def loadGroundTruth(self):
+        """GroundTruth of every phase of the topology, with this run's
+           timing, read from the file named by the config's "groundTruth"
+           entry or computed from its links"""
+        from groundtruth import GroundTruth
+        if self.config.groundTruth:
+            path = os.path.join(os.path.dirname(self.netJsonFilepath), self.config.groundTruth)
+            with open(path) as f:
+                return GroundTruth.load(f, self.latencyMultiplier)
+        return GroundTruth.fromConfig(self.config, self.latencyMultiplier)
 
 
     def run(self):
         """Run the network.  Start threads for each client and router. Start
            thread to track link changes.  """
+        if self.simulator:
+            self.runSimulated()
+            if not self.visualize:
+                sys.stdout.write("\n"+self.getRouteString()+"\n")
+            return
+        self.startedAt = self.routeStore.startedAt = self.currentTime()
         for router in self.routers.values():
             thread = router_thread(router)
             thread.start()
@@ -120,25 +194,94 @@ class Network:
             self.handleChangesThread.start()
         if not self.visualize:
             signal.signal(signal.SIGINT, self.handleInterrupt)
-            time.sleep(self.endTime/float(1000))
-            self.finalRoutes()
+            self.stopEvent.wait(self.endTime/float(1000))
+            if self.stoppedAt is None:
+                self.finalRoutes()
             sys.stdout.write("\n"+self.getRouteString()+"\n")
             self.joinAll()
 
 
 
+    def runSimulated(self):
+        """Run the network on the simulator's virtual clock.  Link changes
+           are scheduled at their exact simulated times and the run returns
+           as soon as the event queue has been processed up to endTime"""
+        self.startSimulated()
+        self.simulator.run(self.endTime)
+        if self.stoppedAt is None:
+            self.finalRoutes()
+        if self.simulator.trace:
+            self.simulator.trace.close()
+
+
+    def startSimulated(self):
+        """Register routers and clients with the simulator and schedule the
+           initial links and all link changes"""
+        for router in self.routers.values():
+            self.simulator.addRouter(router)
+        for client in self.clients.values():
+            self.simulator.addClient(client)
+        self.addLinks()
+        if self.changes:
+            self.scheduleNextChange()
+
+
+    def scheduleNextChange(self):
+        """Schedule the earliest link change not scheduled yet.  Changes are
+           pulled from the config one at a time, each when the previous one
+           is applied"""
+        if not self.changes.empty():
+            changeTime, target, change = self.changes.get()
+            self.simulator.scheduleAt(changeTime*self.latencyMultiplier,
+                                      self.applyScheduledChange, change, target)
+
+
+    def applyScheduledChange(self, change, target):
+        """Simulator event of a link change"""
+        self.scheduleNextChange()
+        self.applyChange(change, target)
+
+
+    def runPartitioned(self, workers=None):
+        """Run the network on workers simulator processes (default: one per
+           core) and collect the final routes.  Build the network with
+           localNodes=() to avoid creating its routers in this process"""
+        from partition import PartitionedRun
+        partitionedRun = PartitionedRun(self.netJsonFilepath, self.routerClass, workers,
+                                        sharedSPF=self.spf is not None,
+                                        vectorized=self.spf is not None and self.spf.vectorized)
+        self.routeStore.load(partitionedRun.run())
+        return partitionedRun
+
+
+    def currentTime(self):
+        """Current time in ms: simulated time in simulated mode,
+           wall-clock time otherwise"""
+        if self.simulator:
+            return self.simulator.now
+        return int(round(time.time() * 1000))
+
+
+    def changeLink(self, node, change):
+        """Pass a link change to a router or client"""
+        if self.simulator:
+            self.simulator.changeLink(node, change)
+        else:
+            node.changeLink(change)
+
+
     def addLinks(self):
         """Add links to clients and routers"""
         for addr1, addr2 in self.links:
             p1, p2, c12, c21, link = self.links[(addr1, addr2)]
             if addr1 in self.clients:
-                self.clients[addr1].changeLink(("add", link))
+                self.changeLink(self.clients[addr1], ("add", link))
             if addr2 in self.clients:
-                self.clients[addr2].changeLink(("add", link))
+                self.changeLink(self.clients[addr2], ("add", link))
             if addr1 in self.routers:
-                self.routers[addr1].changeLink(("add", p1, addr2, link, c12))
+                self.changeLink(self.routers[addr1], ("add", p1, addr2, link, c12))
             if addr2 in self.routers:
-                self.routers[addr2].changeLink(("add", p2, addr1, link, c21))
+                self.changeLink(self.routers[addr2], ("add", p2, addr1, link, c21))
 
 
     def handleChanges(self):
@@ -151,84 +294,166 @@ class Network:
             waitTime = (changeTime*self.latencyMultiplier + startTime) - currentTime
             if waitTime > 0:
                 time.sleep(waitTime/float(1000))
-            # link changes
-            if change == "up":
-                addr1, addr2, p1, p2, c12, c21 = target
-                link = Link(addr1, addr2, c12, c21, self.latencyMultiplier)
-                self.links[(addr1,addr2)] = (p1, p2, c12, c21, link)
-                self.routers[addr1].changeLink(("add", p1, addr2, link, c12))
-                self.routers[addr2].changeLink(("add", p2, addr1, link, c21))
-            elif change == "down":
-                addr1, addr2, = target
-                p1, p2, _, _, link = self.links[(addr1, addr2)]
-                self.routers[addr1].changeLink(("remove", p1))
-                self.routers[addr2].changeLink(("remove", p2))
-            # update visualization
-            if hasattr(Network, "visualizeChangesCallback"):
-                Network.visualizeChangesCallback(change, target)
+            self.applyChange(change, target)
+
+
+    def applyChange(self, change, target):
+        """Apply a single "up" or "down" link change"""
+        with self.trackLock:
+            # routes have to converge again, with traceroutes sent after it
+            self.convergedAt = None
+            self.routesSeen = set()
+            self.changedAt = self.currentTime()
+        if self.simulator and self.simulator.trace:
+            self.simulator.trace.linkChange(self.simulator.now, change, target)
+        if change == "up":
+            addr1, addr2, p1, p2, c12, c21 = target
+            link = self.makeLink(addr1, addr2, c12, c21)
+            self.links[(addr1,addr2)] = (p1, p2, c12, c21, link)
+            if addr1 in self.routers:
+                self.changeLink(self.routers[addr1], ("add", p1, addr2, link, c12))
+            if addr2 in self.routers:
+                self.changeLink(self.routers[addr2], ("add", p2, addr1, link, c21))
+        elif change == "down":
+            addr1, addr2, = target
+            p1, p2, _, _, link = self.links[(addr1, addr2)]
+            if addr1 in self.routers:
+                self.changeLink(self.routers[addr1], ("remove", p1))
+            if addr2 in self.routers:
+                self.changeLink(self.routers[addr2], ("remove", p2))
+        # update visualization
+        if hasattr(Network, "visualizeChangesCallback"):
+            Network.visualizeChangesCallback(change, target)
 
 
-    def updateRoute(self, src, dst, route):
+    def updateRoute(self, src, dst, route, sentAt=None):
         """Callback function used by clients to update the
-           current routes taken by traceroute packets"""
-        self.routesLock.acquire()
-        timeMillisecs = int(round(time.time() * 1000))
-        isGood = route in self.correctRoutes[(src,dst)]  
-
-        try:
-            _, _, currentTime = self.routes[(src,dst)]
-            if timeMillisecs > currentTime:
-                self.routes[(src,dst)] = (route, isGood, timeMillisecs)
-        except KeyError:
-            self.routes[(src,dst)] = (route, isGood, timeMillisecs)
-        finally:
-            self.routesLock.release()
+           current routes taken by traceroute packets.  sentAt is when the
+           traceroute was sent (now for the placeholders clients record
+           when sending).  Locks the source's shard of the RouteStore and
+           the convergence tracking"""
+        timeMillisecs = self.currentTime()
+        if sentAt is None:
+            sentAt = timeMillisecs
+        isGood = self.routeStore.update(src, dst, route, timeMillisecs, sentAt)
+        if route:
+            with self.trackLock:
+                self.trackConvergence(src, dst, isGood, sentAt, timeMillisecs)
+                if self.stopAfterRounds:
+                    self.countRound(src, dst, isGood, sentAt)
+
+
+    def trackConvergence(self, src, dst, isGood, sentAt, timeMillisecs):
+        """Record the outcome of a completed traceroute (not the empty
+           placeholder routes clients record when sending), sent at sentAt
+           and received at timeMillisecs.  The network has converged once
+           every pair with a correct route had a correct traceroute sent
+           after the latest link change and none was incorrect since"""
+        if sentAt >= self.changedAt and (src,dst) in self.routeStore.expectedPairs():
+            self.routesSeen.add((src,dst))
+        if not isGood:
+            self.routesIncorrect.add((src,dst))
+            self.convergedAt = None
+            return
+        self.routesIncorrect.discard((src,dst))
+        if (self.convergedAt is None and not self.routesIncorrect
+                and len(self.routesSeen) >= len(self.routeStore.expectedPairs())):
+            self.convergedAt = timeMillisecs
+
+
+    def countRound(self, src, dst, isGood, sentAt):
+        """Early termination: among the traceroutes sent after the last
+           link change, a round ends once every pair with a correct route
+           had a correct one since the previous round.  An incorrect
+           traceroute starts the count over; stopAfterRounds rounds in a
+           row end the run"""
+        if self.stoppedAt is not None or sentAt - self.startedAt < self.lastChangeAt:
+            return
+        if not isGood:
+            self.roundPairs.clear()
+            self.roundsCorrect = 0
+            return
+        self.roundPairs.add((src, dst))
+        if self.roundPairs >= self.routeStore.expectedPairs():
+            self.roundPairs.clear()
+            self.roundsCorrect += 1
+            if self.roundsCorrect >= self.stopAfterRounds:
+                self.stop(self.currentTime())
+
+
+    def stop(self, timeMillisecs):
+        """End the run early: the simulator stops after the current event,
+           a threaded run wakes up and shuts the threads down"""
+        self.stoppedAt = timeMillisecs - self.startedAt
+        if self.simulator:
+            self.simulator.stop()
+        self.stopEvent.set()
+
+
+    def convergenceTime(self):
+        """Time from the last link change (or from the start) until every
+           traceroute was correct, or None if the network did not converge
+           after the last change"""
+        if self.convergedAt is None or self.convergedAt - self.startedAt < self.lastChangeAt:
+            return None
+        return self.convergedAt - self.startedAt - self.lastChangeAt
 
 
     def getRouteString(self, labelIncorrect=True):
         """Create a string with all the current routes found by traceroute
            packets and whether they are correct"""
-        self.routesLock.acquire()
+        routes = self.getRoutes()
         routeStrings = []
         allCorrect = True
-        for src,dst in self.routes:
-            route, isGood, _ = self.routes[(src,dst)]
+        for src,dst in routes:
+            route, isGood, _ = routes[(src,dst)]
             routeStrings.append("{} -> {}: {} {}".format(src, dst, route,
                 "" if (isGood or not labelIncorrect) else "Incorrect Route"))     # check if the routing is correct
             if not isGood:
                 allCorrect = False
         routeStrings.sort()
-        if allCorrect and len(self.routes) > 0:
+        if allCorrect and len(routes) > 0:
             routeStrings.append("\nSUCCESS: All Routes correct!")
         else:
             routeStrings.append("\nFAILURE: Not all routes are correct")
-        routeString = "\n".join(routeStrings)
-        self.routesLock.release()
-        return routeString
+        return "\n".join(routeStrings)
+
+
+    def getRoutes(self):
+        """Snapshot {(src, dst): (route, isGood, timeMillisecs)} of the
+           current routes found by traceroute packets.  After an early
+           stop, the latest completed routes sent after the last link
+           change (not the placeholders of traceroutes still in flight);
+           pairs with a correct route but none of those are incorrect"""
+        if self.stoppedAt is None:
+            return self.routeStore.snapshot()
+        routes = self.routeStore.snapshot(sentSince=self.startedAt + self.lastChangeAt)
+        for pair in self.routeStore.expectedPairs():
+            routes.setdefault(pair, ([], False, None))
+        return routes
 
 
     def getRoutePickle(self):
         """Create a pickle with the current routes
            found by traceroute packets"""
-        self.routesLock.acquire()
-        routePickle = pickle.dumps(self.routes)
-        self.routesLock.release()
-        return routePickle
+        return pickle.dumps(self.getRoutes())
 
 
     def resetRoutes(self):
         """Reset the routes foudn by traceroute packets"""
-        self.routesLock.acquire()
-        self.routes = {}
-        self.routesLock.release()
+        self.routeStore.reset()
 
 
     def finalRoutes(self):
         """Have the clients send one final batch of traceroute packets"""
+        self.stopAfterRounds = None  # the final batch is never cut short
         self.resetRoutes()
         for client in self.clients.values():
             client.lastSend()
-        time.sleep(4*self.clientSendRate/float(1000))
+        if self.simulator:
+            self.simulator.run(self.simulator.now + 4*self.clientSendRate)
+        else:
+            time.sleep(4*self.clientSendRate/float(1000))
 
     def joinAll(self):
         if self.changes:
@@ -282,10 +507,23 @@ class handle_changes_thread(threading.Thread):
         self.network.handleChanges()
 
 class App:
-    """Tkinter GUI application for network simulation visualizations"""
-
-    def __init__(self, root, network, networkParams):
+    """Tkinter GUI application for network simulation visualizations.
+       Only the Tk thread touches the widgets: the network threads hand
+       packets and link changes over through deques, and everything on
+       screen is updated by root.after callbacks.  In-flight packets are
+       rows of a sprite table, moved together once per frame, and drawn
+       with canvas items taken from a pool instead of created per packet.
+       Given a TracePlayback (see analytics.py) in place of the network it
+       plays a recorded run back, with a time scale to pause and seek"""
+
+    def __init__(self, root, network, networkParams, frameRate=30, maxSprites=500):
+        """frameRate is the animation frames per second.  At most
+           maxSprites packets are animated at once; packets sent during
+           one frame over the same link in the same direction share one
+           sprite, and packets beyond the budget are not drawn"""
+        self.root = root
         self.network = network
+        self.playback = network if isinstance(network, TracePlayback) else None
         self.networkParams = networkParams
         Packet.animate = self.packetSend
         Network.visualizeChangesCallback = self.visualizeChanges
@@ -295,6 +533,14 @@ class App:
         self.routerFollowing = None
         self.displayCurrentRoutesRate = 100
         self.displayCurrentDebugRate = 50
+        self.frameTime = min(self.animateRate, 1000/frameRate)
+        self.maxSprites = maxSprites
+        self.sentPackets = deque()    # (time, src, dst, color, latency) from packetSend
+        self.linkChanges = deque()    # (change, target) from visualizeChanges
+        self.sprites = []             # [item, x0, y0, dx, dy, t0, duration]
+        self.spritePool = []          # hidden packet items ready for reuse
+        self.packetsAggregated = 0
+        self.packetsDropped = 0
 
         # enclosing frame
         self.frame = Frame(root)
@@ -327,9 +573,13 @@ class App:
         self.rects = self.drawRectangles()
 
         #self.drawNetwork()
-        thread.start_new_thread(self.network.run, ())
-        thread.start_new_thread(self.displayCurrentRoutes, ())
-        thread.start_new_thread(self.displayCurrentDebug, ())
+        if self.playback:
+            self.makePlaybackControls()
+        else:
+            thread.start_new_thread(self.network.run, ())
+        self.root.after(self.frameTime, self.animate)
+        self.root.after(self.displayCurrentRoutesRate, self.displayCurrentRoutes)
+        self.root.after(self.displayCurrentDebugRate, self.displayCurrentDebug)
 
     def calcRectCenters(self):
         """Compute the centers of the rectangles representing clients/routers"""
@@ -405,92 +655,218 @@ class App:
                 self.routerFollowing = None
 
 
+    def packetColor(self, kind, dstAddr):
+        """Fill color of a packet of kind towards dstAddr, None if it is
+           not shown"""
+        if self.clientFollowing:
+            if dstAddr == self.clientFollowing and kind == Packet.TRACEROUTE:
+                return "green"
+            return None
+        if kind == Packet.TRACEROUTE:
+            return "DodgerBlue2"
+        if kind == Packet.ROUTING:
+            return "red"
+
+
     def packetSend(self, packet, src, dst, latency):
         """Callback function used by Packet to tell the visualization that
-           a packet is being sent"""
-        if self.clientFollowing:
-            if packet.dstAddr == self.clientFollowing and packet.isTraceroute():
-                fillColor = "green"
-            else:
-                 return
-        else:
-            if packet.isTraceroute():
-                fillColor = "DodgerBlue2"
-            if packet.isRouting():
-                fillColor = "red"
-      
-        latency = latency/self.latencyCorrection
-        cx, cy = self.rectCenters[src]
-        dx, dy = self.rectCenters[dst]
-        packetRect = self.canvas.create_rectangle(cx-6, cy-6, cx+6, cy+6, fill=fillColor)
-        distx, disty = dx-cx, dy-cy
-        velocityx, velocityy = (distx*self.animateRate)/float(latency), (disty*self.animateRate/float(latency))
-        numSteps, stepTime = latency / self.animateRate, self.animateRate/float(1000)
-        thread.start_new_thread(self.movePacket, (packetRect, velocityx, velocityy, numSteps, stepTime))
-
-
-    def movePacket(self, packetRect, vx, vy, numSteps, stepTime):
-        """Animate a moving packet.  This should be run on a separate thread"""
-        s = numSteps
-        while s > 0:
-            time.sleep(stepTime)
-            self.canvas.move(packetRect, vx, vy)
-            s -= 1
-        self.canvas.delete(packetRect)
+           a packet is being sent.  Called from the network threads: only
+           queues the packet for the animation loop"""
+        fillColor = self.packetColor(packet.kind, packet.dstAddr)
+        if fillColor:
+            self.sentPackets.append((time.time(), src, dst, fillColor, latency/self.latencyCorrection))
+
+
+    def makePlaybackControls(self):
+        """Time scale and play/pause button of the playback"""
+        playback = self.playback
+        playback.speed = 1.0/self.networkParams["visualize"]["timeMultiplier"]
+        self.playing = True
+        self.lastFrame = time.time()
+        self.scaleValue = 0
+        self.timeScale = Scale(self.frame, from_=0, to=playback.endTime, orient=HORIZONTAL,
+                               length=self.canvasWidth, label="time (ms)", command=self.seek)
+        self.timeScale.grid(column=1, row=5)
+        self.playButton = Button(self.frame, text="Pause", command=self.togglePlay)
+        self.playButton.grid(column=3, row=5)
+
+
+    def togglePlay(self):
+        """Pause or resume the playback"""
+        self.playing = not self.playing
+        self.playButton.config(text="Pause" if self.playing else "Play")
+
+
+    def seek(self, value):
+        """Jump to the time picked on the time scale: no packets are in
+           flight, links are as they were at that time"""
+        position = int(float(value))
+        if position == self.scaleValue:
+            return
+        self.scaleValue = position
+        self.playback.position = position
+        self.sentPackets.clear()
+        for sprite in self.sprites:
+            self.canvas.itemconfig(sprite[0], state=HIDDEN)
+            self.spritePool.append(sprite[0])
+        self.sprites = []
+        for line in self.lines.values() + self.lineLabels.values():
+            self.canvas.delete(line)
+        self.lines, self.lineLabels = self.drawLines()
+        self.linkChanges.extend(self.playback.linkChanges(0, position + 1))
+
+
+    def playbackStep(self):
+        """Advance the playback by the wall time since the last frame and
+           queue the packets sent and links changed meanwhile"""
+        playback = self.playback
+        now = time.time()
+        elapsed, self.lastFrame = now - self.lastFrame, now
+        if not self.playing or playback.position >= playback.endTime:
+            return
+        start = playback.position
+        playback.position = min(playback.endTime + 1, start + elapsed*1000*playback.speed)
+        for sentTime, src, dst, kind, dstAddr, latency in playback.sends(start, playback.position):
+            fillColor = self.packetColor(kind, dstAddr)
+            if fillColor:
+                wallTime = now - (playback.position - sentTime)/playback.speed/1000
+                self.sentPackets.append((wallTime, src, dst, fillColor,
+                                         latency/playback.speed/self.latencyCorrection))
+        self.linkChanges.extend(playback.linkChanges(start, playback.position))
+        self.scaleValue = int(playback.position)
+        self.timeScale.set(self.scaleValue)
+
+
+    def animate(self):
+        """One animation frame: start sprites for the packets sent since the
+           last frame, then move every sprite in flight and put the ones
+           that arrived back into the pool.  Reschedules itself"""
+        if self.playback:
+            self.playbackStep()
+        self.showLinkChanges()
+        self.startSprites()
+        now = time.time()
+        coords = self.canvas.coords
+        inFlight = []
+        for sprite in self.sprites:
+            item, x0, y0, dx, dy, t0, duration = sprite
+            progress = (now - t0)/duration
+            if progress >= 1:
+                self.canvas.itemconfig(item, state=HIDDEN)
+                self.spritePool.append(item)
+                continue
+            x, y = x0 + dx*progress, y0 + dy*progress
+            coords(item, x-6, y-6, x+6, y+6)
+            inFlight.append(sprite)
+        self.sprites = inFlight
+        self.root.after(self.frameTime, self.animate)
+
+
+    def startSprites(self):
+        """Turn the queued packets into sprites, one per link direction and
+           color per frame, within the sprite budget"""
+        started = {}
+        while self.sentPackets:
+            sentTime, src, dst, fillColor, latency = self.sentPackets.popleft()
+            key = (src, dst, fillColor)
+            if key in started:
+                self.packetsAggregated += 1
+                continue
+            if len(self.sprites) >= self.maxSprites or latency <= 0:
+                self.packetsDropped += 1
+                continue
+            cx, cy = self.rectCenters[src]
+            dx, dy = self.rectCenters[dst]
+            item = self.spriteItem(fillColor)
+            self.canvas.coords(item, cx-6, cy-6, cx+6, cy+6)
+            started[key] = item
+            self.sprites.append([item, cx, cy, dx-cx, dy-cy, sentTime, latency/1000.0])
+
+
+    def spriteItem(self, fillColor):
+        """A visible packet rectangle of fillColor, reused from the pool
+           when one is free"""
+        if self.spritePool:
+            item = self.spritePool.pop()
+            self.canvas.itemconfig(item, fill=fillColor, state=NORMAL)
+            self.canvas.tag_raise(item)
+            return item
+        return self.canvas.create_rectangle(0, 0, 12, 12, fill=fillColor)
 
 
     def displayCurrentRoutes(self):
-        """Display the current routes found by traceroute packets"""
-        while True:
-            routeString = self.network.getRouteString(labelIncorrect=False)
-            pos = self.routeScrollbar.get()
-            self.routeText.delete(1.0,END)
-            self.routeText.insert(1.0, routeString)
-            self.routeText.yview_moveto(pos[0])
-            time.sleep(self.displayCurrentRoutesRate/float(1000))
+        """Display the current routes found by traceroute packets.
+           Reschedules itself"""
+        routeString = self.network.getRouteString(labelIncorrect=False)
+        pos = self.routeScrollbar.get()
+        self.routeText.delete(1.0,END)
+        self.routeText.insert(1.0, routeString)
+        self.routeText.yview_moveto(pos[0])
+        self.root.after(self.displayCurrentRoutesRate, self.displayCurrentRoutes)
 
 
     def displayCurrentDebug(self):
-        """Display the debug string of the currently selected router"""
-        while True:
-            if self.routerFollowing:
-                debugText = self.network.routers[self.routerFollowing].debugString()
-                pos = self.debugScrollbar.get()
-                self.debugText.delete(1.0,END)
-                self.debugText.insert(END, debugText + "\n")
-                self.debugText.yview_moveto(pos[0])
-            time.sleep(self.displayCurrentDebugRate/float(1000))
+        """Display the debug string of the currently selected router.
+           Reschedules itself"""
+        if self.routerFollowing:
+            debugText = self.network.routers[self.routerFollowing].debugString()
+            pos = self.debugScrollbar.get()
+            self.debugText.delete(1.0,END)
+            self.debugText.insert(END, debugText + "\n")
+            self.debugText.yview_moveto(pos[0])
+        self.root.after(self.displayCurrentDebugRate, self.displayCurrentDebug)
 
 
     def visualizeChanges(self, change, target):
+        """Callback function used by Network on link additions and removals.
+           Called from the network threads: only queues the change for
+           the animation loop"""
+        self.linkChanges.append((change, target))
+
+
+    def showLinkChanges(self):
         """Make color and text changes to links upon additions, removals,
            and cost changes"""
-        if change == "up":
-            addr1, addr2, _, _, c12, c21 = target
-            newLine, newLabel = self.drawLine(addr1, addr2, c12, c21)
-            self.lines[(addr1, addr2)] = newLine
-            self.linesLabel = newLabel
-        elif change == "down":
-            addr1, addr2, = target
-            self.canvas.delete(self.lines[(addr1, addr2)])
-            self.canvas.delete(self.lineLabels[(addr1, addr2)])
+        while self.linkChanges:
+            change, target = self.linkChanges.popleft()
+            if change == "up":
+                addr1, addr2, _, _, c12, c21 = target
+                newLine, newLabel = self.drawLine(addr1, addr2, c12, c21)
+                self.lines[(addr1, addr2)] = newLine
+                self.lineLabels[(addr1, addr2)] = newLabel
+            elif change == "down":
+                addr1, addr2, = target
+                self.canvas.delete(self.lines[(addr1, addr2)])
+                self.canvas.delete(self.lineLabels[(addr1, addr2)])
+
+
+def routerClassFromName(name):
+    """Map a command line router name (DV|LS) to a router class"""
+    if name == "DV":
+        return DVrouter
+    elif name == "LS":
+        return LSrouter
+    return Router
 
 
 def main():
     """Main function parses command line arguments and
        runs the network visualizer"""
     if len(sys.argv) < 2:
-        print "Usage: python visualize_network.py [networkSimulationFile.json] [DV|LS (router class, optional)]"
+        print "Usage: python visualize_network.py [networkSimulationFile.json] [DV|LS (router class, optional)] [threads|eventloop (runtime, optional)]"
+        print "       python visualize_network.py [networkSimulationFile.json] playback [run.trace]"
         return
     netCfgFilepath = sys.argv[1]
-    visualizeParams = json.load(open(netCfgFilepath))
-    routerClass = Router   # choose router algorithm
-    if len(sys.argv) == 3: 
-        if sys.argv[2] == "DV":
-            routerClass = DVrouter
-        elif sys.argv[2] == "LS":
-            routerClass = LSrouter
-    net = Network(netCfgFilepath, routerClass, visualize=True)
+    config = loadConfig(netCfgFilepath)
+    visualizeParams = {"visualize": config.visualize, "links": list(config.links())}
+    if len(sys.argv) >= 4 and sys.argv[2] == "playback":
+        reader = TraceReader(sys.argv[3])
+        net = TracePlayback(TraceAnalysis(reader, groundTruthFor(reader)))
+    else:
+        # choose router algorithm
+        routerClass = routerClassFromName(sys.argv[2] if len(sys.argv) >= 3 else None)
+        eventLoop = len(sys.argv) >= 4 and sys.argv[3] == "eventloop"
+        net = Network(netCfgFilepath, routerClass, visualize=True, realtime=eventLoop)
     root = Tk()
     root.wm_title("Commun. & Netw. PROJECT")
     app = App(root, net, visualizeParams)